@@ -0,0 +1,553 @@
+"""
+An in-memory stand-in for the AWS APIs used by the Lambda functions.
+
+It is installed as the "boto3" and "botocore" modules, so the Lambda
+functions can be imported and run without AWS credentials or network
+access. Every API call is counted, and can be given a simulated latency
+so that the effect of concurrent requests can be measured.
+
+"""
+
+import io
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+
+class ClientError(Exception):
+    def __init__(self, code, message, operation_name):
+        super().__init__(f"An error occurred ({code}) when calling {operation_name}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+        self.operation_name = operation_name
+
+
+class FakeEvents:
+    """
+    A minimal botocore event system, supporting "before-call" handlers.
+
+    """
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for prefix, handler in self.handlers:
+            if event_name == prefix or event_name.startswith(prefix + "."):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakePaginator:
+    def __init__(self, client, operation_name):
+        self.client = client
+        self.operation_name = operation_name
+
+    def paginate(self, **kwargs):
+        marker = None
+        while True:
+            page = getattr(self.client, self.operation_name)(Marker=marker, **kwargs)
+            yield page
+            marker = page.get("NextMarker")
+            if marker is None:
+                break
+
+
+class FakeClient:
+    """
+    A boto3 client for one service. Operations are looked up as methods
+    named "<service>_<operation>" on the FakeAWS object.
+
+    """
+
+    def __init__(self, aws, service_name):
+        self.aws = aws
+        self.service_name = service_name.replace("elbv2", "elb")
+        self.exceptions = types.SimpleNamespace(ClientError=ClientError)
+        self.meta = types.SimpleNamespace(events=FakeEvents())
+
+    def __getattr__(self, name):
+        handler = getattr(self.aws, f"{self.service_name}_{name}", None)
+        if handler is None:
+            raise AttributeError(f"{self.service_name} has no operation {name}")
+        operation_name = "".join(part.title() for part in name.split("_"))
+
+        def call(**kwargs):
+            self.meta.events.emit(
+                f"before-call.{self.service_name}.{operation_name}", params=kwargs
+            )
+            self.aws.record(f"{self.service_name}.{operation_name}")
+            return handler(**kwargs)
+
+        return call
+
+    def get_paginator(self, name):
+        return FakePaginator(self, name)
+
+
+class FakeAWS:
+    """
+    Holds the state of the fake AWS account and counts API calls.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = 0.0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = Counter()
+            self.sleeps = 0.0
+            self.job_results = []
+            self.objects = {}
+            self.parameters = {}
+            self.stacks = {}
+            self.images = {}
+            self.image_copies = {}
+            self.image_copy_seconds = 30
+            self.image_ready_at = {}
+            self.fast_snapshot_restores = {}
+            self.fast_snapshot_restore_seconds = 15
+            self.auto_scaling_groups = {}
+            self.instance_refreshes = {}
+            self.target_groups = {}
+            self.target_health_polls = Counter()
+            self.healthy_after_polls = 1
+            self.invalid_instances = set()
+            self.terminating_wait_polls = 0
+            self.uploads = {}
+            self.responses = []
+            self.response_failures = 0
+            self.rules = {}
+
+    def record(self, api_call):
+        with self.lock:
+            self.calls[api_call] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleeps += seconds
+
+    # Helpers for setting up scenarios.
+
+    def put_s3_object(
+        self, bucket, key, body=None, size=None, metadata=None, content_type=None
+    ):
+        version = {
+            "Body": body,
+            "ContentType": content_type or "binary/octet-stream",
+            "Metadata": dict(metadata or {}),
+            "Size": len(body) if body is not None else size,
+            "VersionId": uuid.uuid4().hex,
+        }
+        with self.lock:
+            self.objects.setdefault((bucket, key), []).insert(0, version)
+        return version["VersionId"]
+
+    def get_s3_version(self, bucket, key, version_id=None):
+        versions = self.objects.get((bucket, key))
+        if not versions:
+            raise ClientError("NoSuchKey", key, "GetObject")
+        if version_id is None:
+            return versions[0]
+        for version in versions:
+            if version["VersionId"] == version_id:
+                return version
+        raise ClientError("NoSuchVersion", version_id, "GetObject")
+
+    # Auto Scaling
+
+    def autoscaling_describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        groups = []
+        with self.lock:
+            self.terminating_wait_polls -= 1
+            waiting = self.terminating_wait_polls > 0
+        for name in AutoScalingGroupNames:
+            if name in self.auto_scaling_groups:
+                asg = dict(self.auto_scaling_groups[name])
+                asg["Instances"] = [
+                    dict(
+                        instance,
+                        LifecycleState="Terminating:Wait"
+                        if waiting and instance.get("Draining")
+                        else instance["LifecycleState"],
+                    )
+                    for instance in asg["Instances"]
+                ]
+                groups.append(asg)
+        return {"AutoScalingGroups": groups}
+
+    def autoscaling_cancel_instance_refresh(self, AutoScalingGroupName):
+        raise ClientError(
+            "ActiveInstanceRefreshNotFound", "No refresh", "CancelInstanceRefresh"
+        )
+
+    def autoscaling_describe_auto_scaling_instances(self, InstanceIds):
+        instances = []
+        for asg in self.auto_scaling_groups.values():
+            for instance in asg.get("Instances", []):
+                if instance["InstanceId"] in InstanceIds:
+                    instances.append(
+                        dict(instance, AutoScalingGroupName=asg["AutoScalingGroupName"])
+                    )
+        return {"AutoScalingInstances": instances}
+
+    def autoscaling_describe_instance_refreshes(
+        self, AutoScalingGroupName, InstanceRefreshIds
+    ):
+        return {
+            "InstanceRefreshes": [
+                self.instance_refreshes[refresh_id] for refresh_id in InstanceRefreshIds
+            ]
+        }
+
+    def autoscaling_start_instance_refresh(self, AutoScalingGroupName, Preferences):
+        refresh_id = str(uuid.uuid4())
+        with self.lock:
+            self.instance_refreshes[refresh_id] = {
+                "AutoScalingGroupName": AutoScalingGroupName,
+                "InstanceRefreshId": refresh_id,
+                "PercentageComplete": 0,
+                "Preferences": Preferences,
+                "Status": "Pending",
+            }
+        return {"InstanceRefreshId": refresh_id}
+
+    def autoscaling_terminate_instance_in_auto_scaling_group(
+        self, InstanceId, ShouldDecrementDesiredCapacity
+    ):
+        return {"Activity": {"Description": f"Terminating EC2 instance: {InstanceId}"}}
+
+    # CloudFormation
+
+    def cloudformation_describe_stacks(self, StackName):
+        return {"Stacks": [self.stacks[StackName]]}
+
+    def cloudformation_get_template(self, StackName):
+        return {"TemplateBody": self.stacks[StackName]["TemplateBody"]}
+
+    def cloudformation_signal_resource(self, **kwargs):
+        return {}
+
+    def cloudformation_respond(self, body):
+        with self.lock:
+            self.responses.append(body)
+
+    # CodePipeline
+
+    def codepipeline_put_job_failure_result(self, jobId, failureDetails):
+        with self.lock:
+            self.job_results.append(("FAILURE", failureDetails["message"]))
+        return {}
+
+    def codepipeline_put_job_success_result(self, jobId, **kwargs):
+        with self.lock:
+            self.job_results.append(("SUCCESS", None))
+        return {}
+
+    # EC2
+
+    def ec2_copy_image(self, ClientToken, Name, SourceImageId, SourceRegion):
+        with self.lock:
+            if ClientToken not in self.image_copies:
+                image_id = f"ami-{uuid.uuid4().hex[:17]}"
+                self.images[image_id] = Name
+                self.image_copies[ClientToken] = image_id
+                self.image_ready_at[image_id] = self.sleeps + self.image_copy_seconds
+            return {"ImageId": self.image_copies[ClientToken]}
+
+    def ec2_describe_fast_snapshot_restores(self, Filters):
+        snapshot_ids = Filters[0]["Values"]
+        with self.lock:
+            items = []
+            for (snapshot_id, zone), ready_at in self.fast_snapshot_restores.items():
+                if snapshot_id in snapshot_ids:
+                    items.append(
+                        {
+                            "AvailabilityZone": zone,
+                            "SnapshotId": snapshot_id,
+                            "State": "enabled"
+                            if self.sleeps >= ready_at
+                            else "optimizing",
+                        }
+                    )
+        return {"FastSnapshotRestores": items}
+
+    def ec2_describe_images(self, ImageIds):
+        images = []
+        with self.lock:
+            for image_id in ImageIds:
+                if image_id not in self.images:
+                    raise ClientError(
+                        "InvalidAMIID.NotFound", image_id, "DescribeImages"
+                    )
+                pending = self.sleeps < self.image_ready_at.get(image_id, 0)
+                images.append(
+                    {
+                        "BlockDeviceMappings": [
+                            {
+                                "DeviceName": "/dev/xvda",
+                                "Ebs": {"SnapshotId": image_id.replace("ami", "snap")},
+                            }
+                        ],
+                        "ImageId": image_id,
+                        "Name": self.images[image_id],
+                        "State": "pending" if pending else "available",
+                    }
+                )
+        return {"Images": images}
+
+    def ec2_enable_fast_snapshot_restores(self, AvailabilityZones, SourceSnapshotIds):
+        with self.lock:
+            for snapshot_id in SourceSnapshotIds:
+                for zone in AvailabilityZones:
+                    self.fast_snapshot_restores[(snapshot_id, zone)] = (
+                        self.sleeps + self.fast_snapshot_restore_seconds
+                    )
+        return {"Successful": [], "Unsuccessful": []}
+
+    # Elastic Load Balancing
+
+    def elb_describe_target_groups(self, TargetGroupArns):
+        return {"TargetGroups": [self.target_groups[arn] for arn in TargetGroupArns]}
+
+    def elb_describe_target_health(self, TargetGroupArn, Targets=None):
+        # Without a list of targets, all registered targets are described.
+        if Targets is None:
+            Targets = self.target_groups[TargetGroupArn].get("Targets", [])
+        for target in Targets:
+            if target["Id"] in self.invalid_instances:
+                raise ClientError(
+                    "InvalidInstance", target["Id"], "DescribeTargetHealth"
+                )
+        descriptions = []
+        for target in Targets:
+            with self.lock:
+                self.target_health_polls[(TargetGroupArn, target["Id"])] += 1
+                polls = self.target_health_polls[(TargetGroupArn, target["Id"])]
+            state = "healthy" if polls >= self.healthy_after_polls else "initial"
+            descriptions.append({"Target": target, "TargetHealth": {"State": state}})
+        return {"TargetHealthDescriptions": descriptions}
+
+    # EventBridge
+
+    def events_disable_rule(self, Name):
+        self.rules[Name] = False
+        return {}
+
+    def events_enable_rule(self, Name):
+        self.rules[Name] = True
+        return {}
+
+    # S3
+
+    def s3_abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def s3_complete_multipart_upload(self, Bucket, Key, MultipartUpload, UploadId):
+        upload = self.uploads.pop(UploadId)
+        parts = MultipartUpload["Parts"]
+        size = sum(upload["Parts"][part["PartNumber"]] for part in parts)
+        version_id = self.put_s3_object(
+            Bucket,
+            Key,
+            size=size,
+            metadata=upload["Metadata"],
+            content_type=upload["ContentType"],
+        )
+        return {"VersionId": version_id}
+
+    def s3_copy_object(self, CopySource, Bucket, Key, **kwargs):
+        source = self.get_s3_version(CopySource["Bucket"], CopySource["Key"])
+        if source["Size"] > 5 * 1024 ** 3:
+            raise ClientError("InvalidRequest", "Too large", "CopyObject")
+        version_id = self.put_s3_object(
+            Bucket,
+            Key,
+            body=source["Body"],
+            size=source["Size"],
+            metadata=kwargs.get("Metadata", source["Metadata"]),
+            content_type=kwargs.get("ContentType", source["ContentType"]),
+        )
+        return {"VersionId": version_id}
+
+    def s3_create_multipart_upload(
+        self, Bucket, Key, ContentType=None, Metadata=None, **kwargs
+    ):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {
+            "ContentType": ContentType,
+            "Metadata": Metadata or {},
+            "Parts": {},
+        }
+        return {"UploadId": upload_id}
+
+    def s3_delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for obj in Delete["Objects"]:
+                versions = self.objects.get((Bucket, obj["Key"]), [])
+                versions[:] = [
+                    v for v in versions if v["VersionId"] != obj.get("VersionId")
+                ]
+        return {}
+
+    def s3_get_object(self, Bucket, Key, Range=None, VersionId=None):
+        version = self.get_s3_version(Bucket, Key, VersionId)
+        body = version["Body"]
+        if body is None:
+            body = bytes(version["Size"])
+        if Range:
+            first, last = re.match(r"bytes=(\d+)-(\d+)", Range).groups()
+            body = body[int(first) : int(last) + 1]
+        return {
+            "Body": io.BytesIO(body),
+            "ContentLength": len(body),
+            "ContentType": version["ContentType"],
+            "Metadata": version["Metadata"],
+        }
+
+    def s3_head_object(self, Bucket, Key, VersionId=None):
+        version = self.get_s3_version(Bucket, Key, VersionId)
+        return {
+            "ContentLength": version["Size"],
+            "ContentType": version["ContentType"],
+            "ETag": '"%s"' % version["VersionId"],
+            "Metadata": version["Metadata"],
+            "VersionId": version["VersionId"],
+        }
+
+    def s3_list_object_versions(self, Bucket, Prefix="", Marker=None):
+        page_size = 1000
+        versions = []
+        for (bucket, key), key_versions in sorted(self.objects.items()):
+            if bucket == Bucket and key.startswith(Prefix):
+                for version in key_versions:
+                    versions.append({"Key": key, "VersionId": version["VersionId"]})
+        start = Marker or 0
+        page = {"Versions": versions[start : start + page_size]}
+        if start + page_size < len(versions):
+            page["NextMarker"] = start + page_size
+        return page
+
+    def s3_list_objects_v2(self, Bucket, Prefix="", Marker=None):
+        page_size = 1000
+        keys = [
+            key
+            for (bucket, key), key_versions in sorted(self.objects.items())
+            if bucket == Bucket and key.startswith(Prefix) and key_versions
+        ]
+        start = Marker or 0
+        page = {"Contents": [{"Key": key} for key in keys[start : start + page_size]]}
+        if start + page_size < len(keys):
+            page["NextMarker"] = start + page_size
+        return page
+
+    def s3_put_object(
+        self, Bucket, Key, Body, ContentType=None, Metadata=None, **kwargs
+    ):
+        version_id = self.put_s3_object(
+            Bucket, Key, body=Body, metadata=Metadata, content_type=ContentType
+        )
+        return {"VersionId": version_id}
+
+    def s3_upload_part_copy(self, CopySourceRange, PartNumber, UploadId, **kwargs):
+        first, last = re.match(r"bytes=(\d+)-(\d+)", CopySourceRange).groups()
+        self.uploads[UploadId]["Parts"][PartNumber] = int(last) - int(first) + 1
+        return {"CopyPartResult": {"ETag": f'"{PartNumber}"'}}
+
+    # SSM
+
+    def ssm_delete_parameter(self, Name):
+        with self.lock:
+            del self.parameters[Name]
+        return {}
+
+    def ssm_get_parameter(self, Name):
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def ssm_get_parameters(self, Names):
+        return {
+            "Parameters": [
+                {"Name": name, "Value": self.parameters[name]}
+                for name in Names
+                if name in self.parameters
+            ],
+            "InvalidParameters": [
+                name for name in Names if name not in self.parameters
+            ],
+        }
+
+    def ssm_get_parameters_by_path(self, Path, Marker=None):
+        names = sorted(name for name in self.parameters if name.startswith(Path + "/"))
+        page_size = 10
+        start = Marker or 0
+        page = {
+            "Parameters": [
+                {"Name": name, "Value": self.parameters[name]}
+                for name in names[start : start + page_size]
+            ]
+        }
+        if start + page_size < len(names):
+            page["NextMarker"] = start + page_size
+        return page
+
+    def ssm_put_parameter(self, Name, Value, **kwargs):
+        with self.lock:
+            self.parameters[Name] = Value
+        return {"Version": 1}
+
+    # STS
+
+    def sts_assume_role(self, RoleArn, RoleSessionName, DurationSeconds=900):
+        expiration = datetime.now(timezone.utc) + timedelta(seconds=DurationSeconds)
+        return {
+            "Credentials": {
+                "AccessKeyId": "ASIAFAKE",
+                "Expiration": expiration,
+                "SecretAccessKey": "fake",
+                "SessionToken": "fake",
+            }
+        }
+
+
+class FakeSession:
+    def __init__(self, aws, **kwargs):
+        self.aws = aws
+
+    def client(self, service_name, **kwargs):
+        return FakeClient(self.aws, service_name)
+
+
+def install(aws):
+    """
+    Installs fake boto3 and botocore modules backed by the FakeAWS object.
+
+    """
+
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda service_name, **kwargs: FakeClient(aws, service_name)
+    boto3.Session = lambda **kwargs: FakeSession(aws, **kwargs)
+
+    botocore = types.ModuleType("botocore")
+    botocore_config = types.ModuleType("botocore.config")
+    botocore_config.Config = lambda **kwargs: kwargs
+    botocore_exceptions = types.ModuleType("botocore.exceptions")
+    botocore_exceptions.ClientError = ClientError
+    botocore.config = botocore_config
+    botocore.exceptions = botocore_exceptions
+
+    sys.modules["boto3"] = boto3
+    sys.modules["botocore"] = botocore
+    sys.modules["botocore.config"] = botocore_config
+    sys.modules["botocore.exceptions"] = botocore_exceptions
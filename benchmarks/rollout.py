@@ -0,0 +1,431 @@
+"""
+Simulates CloudFormation rolling updates of an Auto Scaling Group.
+
+Each simulated deployment replaces every instance in the group, batch by
+batch, with random boot times, target group health checks, failed instances
+and connection draining. The results predict how long a deployment takes,
+and the lowest number of healthy instances in service during it, for a
+rolling update policy. MinInstancesInService and MaxBatchSize values of -1
+are planned by the cfn_params function's own logic, as they would be when
+deploying. With --search, policies are compared to find the fastest one
+that keeps the required capacity.
+
+Usage:
+
+    python benchmarks/rollout.py [OPTIONS]
+    python benchmarks/rollout.py --search --required-capacity 75 [OPTIONS]
+
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import re
+import statistics
+
+from run import ASG_DIR, load_function
+
+# Policies are searched with these capacity_floor_percent values.
+SEARCH_FLOOR_PERCENTS = range(0, 101, 5)
+
+
+def load_functions(poll_interval):
+    """
+    Imports the cfn_params and cfn_signal functions, to reuse their logic.
+    They make no API calls here.
+
+    """
+
+    cfn_params = load_function(
+        os.path.join(ASG_DIR, "cfn_params"),
+        "cfn_params_lambda",
+        filename="lambda.py",
+        environment={
+            "AUTO_SCALING_GROUP_NAME": "app",
+            "DEFAULT_AMI_SSM_PARAMETER": "/aws/service/ami",
+        },
+    )
+    cfn_signal = load_function(
+        os.path.join(ASG_DIR, "cfn_signal"),
+        "cfn_signal_lambda",
+        filename="lambda.py",
+        environment={
+            "LOGICAL_RESOURCE_ID": "AutoScalingGroup",
+            "POLL_INTERVAL": str(poll_interval),
+            "STACK_NAME": "app",
+            "TARGET_GROUP_ARNS": "[]",
+        },
+    )
+    return (cfn_params, cfn_signal)
+
+
+def parse_distribution(value):
+    """
+    Parses "MEAN" or "MEAN,STDDEV", in seconds.
+
+    """
+
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) == 1:
+        parts.append(0.0)
+    if len(parts) != 2 or min(parts) < 0:
+        raise argparse.ArgumentTypeError(f"expected MEAN or MEAN,STDDEV: {value}")
+    return tuple(parts)
+
+
+def parse_duration(value):
+    """
+    Parses an ISO 8601 duration such as PT15M, as used by PauseTime,
+    into seconds.
+
+    """
+
+    match = re.fullmatch(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", value)
+    if not match or value == "PT":
+        raise argparse.ArgumentTypeError(f"expected a duration like PT15M: {value}")
+    hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def plan_policy(config, cfn_params, floor_percent, max_batch_size):
+    """
+    Returns the MinInstancesInService and MaxBatchSize values that the
+    cfn_params function would use when deploying with this policy.
+
+    """
+
+    min_instances_in_service = config.min_instances_in_service
+    if min_instances_in_service < 0 or max_batch_size < 0:
+        capacity = {
+            "DesiredCapacity": config.desired,
+            "Healthy": config.desired - config.unhealthy,
+            "Pending": 0,
+            "Standby": 0,
+            "Unhealthy": config.unhealthy,
+        }
+        plan = cfn_params.plan_rolling_update(
+            capacity=capacity,
+            min_size=config.min_size,
+            max_size=config.max_size,
+            floor_percent=floor_percent,
+            min_instances_in_service=min_instances_in_service,
+        )
+        min_instances_in_service = plan["MinInstancesInService"]
+        if max_batch_size < 0:
+            max_batch_size = plan["MaxBatchSize"]
+    return {
+        "MaxBatchSize": max_batch_size,
+        "MinInstancesInService": min_instances_in_service,
+    }
+
+
+def sample(rng, distribution):
+    """
+    Returns a random duration from a gamma distribution with the mean
+    and standard deviation, which never goes below zero.
+
+    """
+
+    mean, stddev = distribution
+    if mean <= 0 or stddev <= 0:
+        return mean
+    shape = (mean / stddev) ** 2
+    return rng.gammavariate(shape, stddev ** 2 / mean)
+
+
+def signal_time(config, cfn_signal, launched, healthy):
+    """
+    Returns when the cfn_signal function signals CloudFormation for an
+    instance that was launched and became healthy at these times. It polls
+    target health at its own increasing intervals from the launch.
+
+    """
+
+    max_delay = min(config.poll_interval, config.health_check_interval)
+    delay = cfn_signal.MIN_POLL_INTERVAL
+    polled = launched + config.signal_delay
+    while polled < healthy:
+        polled += delay
+        delay = min(delay * 2, max_delay)
+    return polled
+
+
+def simulate(config, cfn_signal, policy, rng):
+    """
+    Simulates one rolling update, and returns its Duration in seconds,
+    the number of Batches, the lowest number of healthy instances in
+    service (Floor), and whether it Failed and would be rolled back.
+
+    CloudFormation launches new instances first while the group has room
+    below its maximum size, and terminates old instances first for the rest
+    of each batch, keeping MinInstancesInService in service. Each batch ends
+    when every new instance has signalled, or when PauseTime runs out.
+    Terminated instances drain in the background, and the cfn_wait function
+    waits for them at the end of the update.
+
+    """
+
+    desired = config.desired
+    min_in_service = policy["MinInstancesInService"]
+    room = max(config.max_size - desired, 0)
+
+    now = 0.0
+    drained = 0.0
+    old_healthy = desired - config.unhealthy
+    old = desired
+    healthy = old_healthy
+    floor = healthy
+    batches = 0
+    replaced = 0
+    succeeded = 0
+
+    while old:
+        batch_size = min(policy["MaxBatchSize"], old, room + desired - min_in_service)
+        if batch_size < 1:
+            return {"Batches": batches, "Duration": now, "Failed": True, "Floor": 0}
+        batches += 1
+        launch_first = min(batch_size, room)
+
+        # Terminate old instances to make room for the rest of the batch.
+        # Healthy ones are assumed to go first, which is the worst case.
+        terminated = batch_size - launch_first
+        healthy -= min(terminated, old_healthy)
+        old_healthy -= min(terminated, old_healthy)
+        floor = min(floor, healthy)
+        for _ in range(terminated):
+            drained = max(drained, now + sample(rng, config.drain_time))
+
+        # Launch the new instances, and process their health check and
+        # signal events in time order until the batch ends.
+        events = []
+        for _ in range(batch_size):
+            if rng.random() < config.failure_rate:
+                continue
+            ready = now + sample(rng, config.boot_time)
+            healthy_at = (
+                ready
+                + rng.uniform(0, config.health_check_interval)
+                + (config.healthy_threshold - 1) * config.health_check_interval
+            )
+            heapq.heappush(events, (healthy_at, "healthy"))
+            heapq.heappush(
+                events, (signal_time(config, cfn_signal, now, healthy_at), "signal")
+            )
+        timeout = now + config.pause_time
+        signals = 0
+        batch_end = timeout
+        while events and events[0][0] <= timeout:
+            event_time, kind = heapq.heappop(events)
+            if kind == "healthy":
+                healthy += 1
+            else:
+                signals += 1
+                if signals == batch_size:
+                    batch_end = event_time
+                    break
+        now = batch_end
+        healthy += sum(1 for event_time, kind in events if kind == "healthy")
+
+        # CloudFormation rolls back if too few instances have signalled.
+        replaced += batch_size
+        succeeded += signals
+        if succeeded * 100 < replaced * config.min_successful_instances_percent:
+            return {"Batches": batches, "Duration": now, "Failed": True, "Floor": floor}
+
+        # Terminate the old instances that the new ones replaced.
+        healthy -= min(launch_first, old_healthy)
+        old_healthy -= min(launch_first, old_healthy)
+        floor = min(floor, healthy)
+        for _ in range(launch_first):
+            drained = max(drained, now + sample(rng, config.drain_time))
+        old -= batch_size
+
+    return {
+        "Batches": batches,
+        "Duration": max(now, drained),
+        "Failed": False,
+        "Floor": floor,
+    }
+
+
+def evaluate(config, cfn_signal, policy, runs):
+    """
+    Simulates a policy repeatedly and summarises the results.
+
+    """
+
+    rng = random.Random(config.seed)
+    results = [simulate(config, cfn_signal, policy, rng) for _ in range(runs)]
+    durations = sorted(result["Duration"] for result in results)
+    return {
+        "Batches": max(result["Batches"] for result in results),
+        "DurationP50": round(statistics.median(durations)),
+        "DurationP90": round(durations[min(len(durations) - 1, runs * 9 // 10)]),
+        "FailureRate": sum(result["Failed"] for result in results) / runs,
+        "Floor": min(result["Floor"] for result in results),
+    }
+
+
+def search(config, cfn_params, cfn_signal):
+    """
+    Returns the results for the largest batch size that keeps the required
+    capacity, for each capacity_floor_percent value. Larger batches can only
+    lower the floor, so each is found with a binary search.
+
+    """
+
+    required = math.ceil(config.desired * config.required_capacity / 100)
+    results = {}
+    for floor_percent in SEARCH_FLOOR_PERCENTS:
+        planned = plan_policy(config, cfn_params, floor_percent, -1)
+        low, high = 0, planned["MaxBatchSize"]
+        best = None
+        while low < high:
+            batch_size = (low + high + 1) // 2
+            policy = dict(planned, MaxBatchSize=batch_size)
+            key = (policy["MinInstancesInService"], batch_size)
+            if key not in results:
+                results[key] = evaluate(config, cfn_signal, policy, config.runs)
+            result = results[key]
+            if result["Floor"] >= required:
+                low = batch_size
+                best = dict(result, CapacityFloorPercent=floor_percent, **policy)
+            else:
+                high = batch_size - 1
+        if best and best["FailureRate"] <= config.max_failure_rate:
+            yield best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    group = parser.add_argument_group("auto scaling group")
+    group.add_argument("--desired", type=int, default=10, help="desired capacity")
+    group.add_argument("--min-size", type=int, default=1, help="MinSize")
+    group.add_argument("--max-size", type=int, default=20, help="MaxSize")
+    group.add_argument(
+        "--unhealthy", type=int, default=0, help="unhealthy instances before deploying"
+    )
+    group = parser.add_argument_group("instances")
+    group.add_argument(
+        "--boot-time",
+        type=parse_distribution,
+        default=(90.0, 20.0),
+        help="seconds from launch until the app is ready, as MEAN,STDDEV",
+    )
+    group.add_argument(
+        "--drain-time",
+        type=parse_distribution,
+        default=(300.0, 0.0),
+        help="seconds to drain terminated instances, as MEAN,STDDEV",
+    )
+    group.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="fraction of new instances that never become healthy",
+    )
+    group = parser.add_argument_group("health checks")
+    group.add_argument(
+        "--health-check-interval",
+        type=float,
+        default=30,
+        help="target group HealthCheckIntervalSeconds",
+    )
+    group.add_argument(
+        "--healthy-threshold",
+        type=int,
+        default=5,
+        help="target group HealthyThresholdCount",
+    )
+    group.add_argument(
+        "--poll-interval",
+        type=int,
+        default=10,
+        help="the asg module's health_check_poll_interval",
+    )
+    group.add_argument(
+        "--signal-delay",
+        type=float,
+        default=0,
+        help="seconds before cfn_signal starts checking, such as its batch window",
+    )
+    group = parser.add_argument_group("rolling update policy")
+    group.add_argument("--capacity-floor-percent", type=int, default=100)
+    group.add_argument("--max-batch-size", type=int, default=-1)
+    group.add_argument("--min-instances-in-service", type=int, default=-1)
+    group.add_argument("--min-successful-instances-percent", type=int, default=100)
+    group.add_argument("--pause-time", type=parse_duration, default="PT1H")
+    group = parser.add_argument_group("simulation")
+    group.add_argument("--runs", type=int, default=200, help="deployments per policy")
+    group.add_argument("--seed", type=int, default=0, help="random seed")
+    group.add_argument(
+        "--search",
+        action="store_true",
+        help="search for the fastest policy that keeps the required capacity",
+    )
+    group.add_argument(
+        "--required-capacity",
+        type=int,
+        default=100,
+        help="percentage of desired capacity that must stay healthy, for --search",
+    )
+    group.add_argument(
+        "--max-failure-rate",
+        type=float,
+        default=0.01,
+        help="highest acceptable fraction of failed deployments, for --search",
+    )
+    group.add_argument("--json", action="store_true", help="output JSON lines")
+    config = parser.parse_args()
+
+    cfn_params, cfn_signal = load_functions(config.poll_interval)
+
+    if config.search:
+        results = sorted(
+            search(config, cfn_params, cfn_signal),
+            key=lambda result: (result["DurationP90"], -result["CapacityFloorPercent"]),
+        )
+        if not results:
+            parser.exit(1, "No policy keeps the required capacity.\n")
+    else:
+        policy = plan_policy(
+            config, cfn_params, config.capacity_floor_percent, config.max_batch_size
+        )
+        result = evaluate(config, cfn_signal, policy, config.runs)
+        results = [
+            dict(result, CapacityFloorPercent=config.capacity_floor_percent, **policy)
+        ]
+
+    if config.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    print(
+        f"{'floor %':>7} {'min in service':>14} {'max batch':>9} {'batches':>7} "
+        f"{'p50 s':>7} {'p90 s':>7} {'floor':>5} {'failed':>6}"
+    )
+    for result in results:
+        print(
+            f"{result['CapacityFloorPercent']:>7} "
+            f"{result['MinInstancesInService']:>14} {result['MaxBatchSize']:>9} "
+            f"{result['Batches']:>7} {result['DurationP50']:>7} "
+            f"{result['DurationP90']:>7} {result['Floor']:>5} "
+            f"{result['FailureRate']:>6.0%}"
+        )
+
+    # Show the asg module settings for the fastest policy.
+    if config.search:
+        best = results[0]
+        print(f"\ncapacity_floor_percent = {best['CapacityFloorPercent']}")
+        planned = plan_policy(config, cfn_params, best["CapacityFloorPercent"], -1)
+        if best["MaxBatchSize"] < planned["MaxBatchSize"]:
+            max_batch_size = best["MaxBatchSize"]
+            print(f"rolling_update_policy = {{ MaxBatchSize = {max_batch_size} }}")
+
+
+if __name__ == "__main__":
+    main()
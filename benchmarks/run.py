@@ -0,0 +1,961 @@
+"""
+Benchmarks the Lambda functions against an in-memory stand-in for AWS.
+
+Each scenario runs a function's lambda_handler with a synthetic event,
+and reports its latency, the number of AWS API calls it made, and its
+peak memory usage. Every API call takes the simulated latency, so the
+results reflect the number of sequential round trips to AWS.
+
+Usage:
+
+    python benchmarks/run.py [--latency SECONDS] [--json] [SCENARIO ...]
+
+"""
+
+import argparse
+import contextlib
+import hashlib
+import http.client
+import importlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+import zipfile
+
+import fake_aws
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_LAMBDA_DIR = os.path.join(ROOT, "modules", "pipeline", "lambda")
+ASG_DIR = os.path.join(ROOT, "modules", "asg")
+
+MB = 1024 * 1024
+
+TEMPLATE_BODY = "Resources: {}\n" * 200
+TEMPLATE_HASH = hashlib.sha256(TEMPLATE_BODY.encode("utf-8")).hexdigest()
+
+# Modules that exist in more than one Lambda source directory,
+# which must be reloaded when switching between functions.
+SHARED_MODULES = ["cfnresponse", "clients", "logger", "metrics", "utils"]
+
+aws = fake_aws.FakeAWS()
+fake_aws.install(aws)
+
+# Lambda sets this for every function.
+os.environ.setdefault("AWS_REGION", "eu-west-1")
+
+
+def load_function(source_dir, module_name, filename=None, environment=None):
+    """
+    Imports a Lambda function module from its source directory.
+
+    """
+
+    os.environ.update(environment or {})
+    for name in SHARED_MODULES + [module_name]:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, source_dir)
+    try:
+        if filename:
+            path = os.path.join(source_dir, filename)
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(module_name)
+    finally:
+        sys.path.remove(source_dir)
+
+    # Don't actually sleep while waiting for things.
+    for loaded in (module, sys.modules.get("cfnresponse")):
+        if hasattr(loaded, "time"):
+            loaded.time = types.SimpleNamespace(
+                sleep=aws.sleep, time=time.time, perf_counter=time.perf_counter
+            )
+
+    return module
+
+
+def make_context(function_name):
+    return types.SimpleNamespace(
+        aws_request_id="00000000-0000-0000-0000-000000000000",
+        function_name=function_name,
+        get_remaining_time_in_millis=lambda: 900000,
+        log_stream_name="2020/01/01/[$LATEST]00000000000000000000000000000000",
+    )
+
+
+def make_codepipeline_event(
+    user_parameters, input_key="input.zip", output_artifacts=("template",)
+):
+    return {
+        "CodePipeline.job": {
+            "id": "11111111-1111-1111-1111-111111111111",
+            "data": {
+                "actionConfiguration": {
+                    "configuration": {
+                        "FunctionName": "benchmark",
+                        "UserParameters": json.dumps(user_parameters),
+                    }
+                },
+                "artifactCredentials": {
+                    "accessKeyId": "ASIAFAKE",
+                    "secretAccessKey": "fake",
+                    "sessionToken": "fake",
+                },
+                "inputArtifacts": [
+                    {
+                        "location": {
+                            "s3Location": {
+                                "bucketName": "pipeline",
+                                "objectKey": input_key,
+                            },
+                            "type": "S3",
+                        },
+                        "name": "source",
+                        "revision": "source-version-1",
+                    }
+                ],
+                "outputArtifacts": [
+                    {
+                        "location": {
+                            "s3Location": {
+                                "bucketName": "pipeline",
+                                "objectKey": f"{name}.zip",
+                            },
+                            "type": "S3",
+                        },
+                        "name": name,
+                    }
+                    for name in output_artifacts
+                ],
+            },
+        }
+    }
+
+
+def make_custom_resource_event(properties, request_type="Update"):
+    return {
+        "LogicalResourceId": "Resource",
+        "RequestId": "22222222-2222-2222-2222-222222222222",
+        "RequestType": request_type,
+        "ResourceProperties": properties,
+        "ResponseURL": "https://cloudformation-custom-resource-response.example.com/",
+        "StackId": "arn:aws:cloudformation:eu-west-1:123456789012:stack/app/1",
+    }
+
+
+@contextlib.contextmanager
+def fake_response_url():
+    """
+    Sends custom resource responses to the fake AWS instead of the network.
+
+    """
+
+    class Response:
+        def __init__(self, status, reason):
+            self.status = status
+            self.reason = reason
+
+        def read(self):
+            return b""
+
+    class HTTPSConnection:
+        def __init__(self, host, timeout=None):
+            self.response = None
+
+        def close(self):
+            pass
+
+        def getresponse(self):
+            return self.response
+
+        def request(self, method, url, body=None, headers=None):
+            aws.record("cloudformation.Respond")
+            with aws.lock:
+                aws.response_failures -= 1
+                failed = aws.response_failures >= 0
+            if failed:
+                self.response = Response(503, "Slow Down")
+            else:
+                aws.cloudformation_respond(json.loads(body))
+                self.response = Response(200, "OK")
+
+    original = http.client.HTTPSConnection
+    http.client.HTTPSConnection = HTTPSConnection
+    try:
+        yield
+    finally:
+        http.client.HTTPSConnection = original
+
+
+def set_up_stack(extra_outputs=None, name="app"):
+    outputs = [{"OutputKey": "AutoScalingGroupName", "OutputValue": name}]
+    outputs.extend(extra_outputs or [])
+    aws.stacks[name] = {
+        "Outputs": outputs,
+        "Parameters": [
+            {"ParameterKey": "TemplateHash", "ParameterValue": TEMPLATE_HASH}
+        ],
+        "StackName": name,
+        "StackStatus": "UPDATE_COMPLETE",
+        "TemplateBody": TEMPLATE_BODY,
+    }
+
+
+def deploy_stack(invoke, parameter_names):
+    """
+    Runs a Prepare function and then simulates the CloudFormation deployment
+    stage by resolving the stack's SSM parameters, so that the next run is
+    a re-run of an already deployed revision.
+
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        invoke()
+    resolve_stack_parameters(parameter_names)
+    aws.calls.clear()
+    aws.job_results.clear()
+
+
+def resolve_stack_parameters(parameter_names):
+    """
+    Sets the stack's SSM parameters to their current values, as CloudFormation
+    does when the stack is created or updated.
+
+    """
+
+    aws.stacks["app"]["Parameters"] = [
+        {"ParameterKey": "TemplateHash", "ParameterValue": TEMPLATE_HASH}
+    ] + [
+        {
+            "ParameterKey": key,
+            "ParameterValue": name,
+            "ResolvedValue": aws.parameters[name],
+        }
+        for key, name in parameter_names.items()
+    ]
+
+
+# Scenarios. Each one sets up the fake AWS state and returns a function
+# that invokes the Lambda handler.
+
+
+def set_up_parameters(parameter_names):
+    """
+    Creates the SSM parameters used by a Prepare function. Keys that share
+    a parameter name are stored together in it as a JSON document.
+
+    """
+
+    for name in set(parameter_names.values()):
+        keys = [key for key in parameter_names if parameter_names[key] == name]
+        if len(keys) > 1:
+            aws.parameters[name] = json.dumps({key: "-" for key in keys})
+        else:
+            aws.parameters[name] = "-"
+
+
+def scenario_prepare_app(size_mb, rerun=False, json_parameters=False, new_stack=False):
+    module = load_function(PIPELINE_LAMBDA_DIR, "prepare_app_deployment")
+    aws.put_s3_object(
+        "pipeline",
+        "input.zip",
+        size=size_mb * MB,
+        metadata={"codepipeline-artifact-revision-summary": "v1"},
+    )
+    if json_parameters:
+        parameter_names = {
+            "AppVersionId": "/app/app-deployment",
+            "AppVersionName": "/app/app-deployment",
+        }
+    else:
+        parameter_names = {
+            "AppVersionId": "/app/app-version-id",
+            "AppVersionName": "/app/app-version-name",
+        }
+    set_up_parameters(parameter_names)
+    set_up_stack()
+
+    # A new stack has been created with the initial "-" values.
+    if new_stack:
+        resolve_stack_parameters(parameter_names)
+
+    event = make_codepipeline_event(
+        {
+            "AppLocation": {"Bucket": "app", "Key": "app.zip"},
+            "AssumeRoleArn": "arn:aws:iam::123456789012:role/app-pipeline",
+            "ParameterNames": parameter_names,
+            "StackName": "app",
+            "TemplateFilename": "cfn.yaml",
+        }
+    )
+
+    def invoke():
+        module.lambda_handler(event, make_context("prepare-app"))
+
+    # Each pipeline execution writes a new input artifact, even for the same
+    # source revision, so it has a different ETag.
+    if rerun:
+        deploy_stack(invoke, parameter_names)
+        aws.put_s3_object(
+            "pipeline",
+            "input.zip",
+            size=size_mb * MB,
+            metadata={"codepipeline-artifact-revision-summary": "v1"},
+        )
+        aws.calls.clear()
+    return invoke
+
+
+def make_app_chunks(count, changed_percent=0, chunk_size=64 * 1024):
+    """
+    Returns the chunks of an app with a file per chunk, keyed by their hash,
+    and the manifest listing them. The changed percentage of the chunks
+    are different from the chunks of the app with no changes.
+
+    """
+
+    changed = count * changed_percent // 100
+    chunks = {}
+    files = {}
+    for n in range(count):
+        seed = f"{'changed' if n < changed else 'original'}-{n}".encode("utf-8")
+        data = hashlib.sha256(seed).digest() * (chunk_size // 32)
+        chunk = hashlib.sha256(data).hexdigest()
+        chunks[chunk] = data
+        files[f"lib/file{n}.bin"] = [chunk]
+    return chunks, {"Files": files}
+
+
+def scenario_prepare_app_chunks(changed_percent, count=200):
+    module = load_function(PIPELINE_LAMBDA_DIR, "prepare_app_deployment")
+
+    # The app bucket has the chunks of the previous app version.
+    previous_chunks, _ = make_app_chunks(count)
+    for chunk, data in previous_chunks.items():
+        aws.put_s3_object("app", f"chunks/{chunk}", body=data)
+
+    chunks, manifest = make_app_chunks(count, changed_percent)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("app-manifest.json", json.dumps(manifest))
+        for chunk, data in chunks.items():
+            zip_file.writestr(f"chunks/{chunk}", data)
+    aws.put_s3_object(
+        "pipeline",
+        "input.zip",
+        body=buffer.getvalue(),
+        metadata={"codepipeline-artifact-revision-summary": "v1"},
+    )
+    parameter_names = {
+        "AppVersionId": "/app/app-version-id",
+        "AppVersionName": "/app/app-version-name",
+    }
+    set_up_parameters(parameter_names)
+    set_up_stack()
+    event = make_codepipeline_event(
+        {
+            "AppLocation": {"Bucket": "app", "Key": "app.json"},
+            "ArtifactFormat": "chunks",
+            "AssumeRoleArn": "arn:aws:iam::123456789012:role/app-pipeline",
+            "ParameterNames": parameter_names,
+            "StackName": "app",
+            "TemplateFilename": "cfn.yaml",
+        }
+    )
+    return lambda: module.lambda_handler(event, make_context("prepare-app"))
+
+
+def scenario_prepare_ami(size_mb, rerun=False, builds=0):
+    module = load_function(PIPELINE_LAMBDA_DIR, "prepare_ami_deployment")
+    manifest = {
+        "builds": [
+            {
+                "artifact_id": "eu-west-1:ami-00000000000000001",
+                "builder_type": "amazon-ebs",
+                "custom_data": None,
+                "name": "amazon-ebs",
+            }
+        ]
+    }
+
+    # Multi-region manifests have a build per account, each with an image
+    # per region, and name their images in custom_data.
+    if builds:
+        regions = ("ap-southeast-2", "eu-west-1", "us-east-1", "us-west-2")
+        manifest["builds"] = [
+            {
+                "artifact_id": ",".join(
+                    f"{region}:ami-{n:08}{index:09}"
+                    for index, region in enumerate(regions)
+                ),
+                "builder_type": "amazon-ebs",
+                "custom_data": {
+                    "account_id": f"{n:012}",
+                    "image_name": f"app-image-{n}",
+                },
+                "name": "amazon-ebs",
+            }
+            for n in range(builds - 1)
+        ]
+        manifest["builds"].append(
+            {
+                "artifact_id": ",".join(
+                    f"{region}:ami-{index:017}" for index, region in enumerate(regions)
+                ),
+                "builder_type": "amazon-ebs",
+                "custom_data": {
+                    "account_id": "123456789012",
+                    "image_name": "app-image-1",
+                },
+                "name": "amazon-ebs",
+            }
+        )
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("padding.bin", bytes(size_mb * MB))
+        zip_file.writestr("manifest.json", json.dumps(manifest))
+    aws.put_s3_object("pipeline", "input.zip", body=buffer.getvalue())
+    aws.images["ami-00000000000000001"] = "app-image-1"
+    parameter_names = {"ImageId": "/app/image-id", "ImageName": "/app/image-name"}
+    set_up_parameters(parameter_names)
+    set_up_stack()
+    event = make_codepipeline_event(
+        {
+            "AssumeRoleArn": "arn:aws:iam::123456789012:role/app-pipeline",
+            "ParameterNames": parameter_names,
+            "Region": "eu-west-1",
+            "StackName": "app",
+            "TemplateFilename": "cfn.yaml",
+        }
+    )
+
+    def invoke():
+        module.lambda_handler(event, make_context("prepare-ami"))
+
+    if rerun:
+        deploy_stack(invoke, parameter_names)
+    return invoke
+
+
+def scenario_distribute_ami(targets):
+    module = load_function(PIPELINE_LAMBDA_DIR, "distribute_ami_deployment")
+
+    # The image is built in one region, and the targets are in two others,
+    # each in their own account.
+    manifest = {
+        "builds": [
+            {
+                "artifact_id": "us-east-1:ami-00000000000000001",
+                "builder_type": "amazon-ebs",
+                "custom_data": {"image_name": "app-image-1"},
+                "name": "amazon-ebs",
+            }
+        ]
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("manifest.json", json.dumps(manifest))
+    aws.put_s3_object("pipeline", "input.zip", body=buffer.getvalue())
+    aws.images["ami-00000000000000001"] = "app-image-1"
+
+    target_list = []
+    for n in range(targets):
+        name = f"app{n}"
+        set_up_stack(name=name)
+        aws.auto_scaling_groups[name] = {
+            "AutoScalingGroupName": name,
+            "AvailabilityZones": ["eu-west-1a", "eu-west-1b", "eu-west-1c"],
+            "Instances": [],
+        }
+        target_list.append(
+            {
+                "AssumeRoleArn": f"arn:aws:iam::12345678901{n}:role/{name}-pipeline",
+                "Region": ("eu-west-1", "eu-west-2")[n % 2],
+                "StackName": name,
+            }
+        )
+    aws.put_s3_object(
+        "pipeline",
+        "prepare-targets/distribute.json",
+        body=json.dumps({"Targets": target_list}).encode("utf-8"),
+    )
+    event = make_codepipeline_event(
+        {
+            "CopyImage": True,
+            "FastSnapshotRestore": True,
+            "TargetsLocation": {
+                "Bucket": "pipeline",
+                "Key": "prepare-targets/distribute.json",
+            },
+        },
+        output_artifacts=["distributed"],
+    )
+    return lambda: module.lambda_handler(event, make_context("distribute-ami"))
+
+
+def scenario_bake(minutes):
+    module = load_function(PIPELINE_LAMBDA_DIR, "bake_deployment")
+    event = make_codepipeline_event({"BakeMinutes": minutes})
+    return lambda: module.lambda_handler(event, make_context("bake"))
+
+
+def scenario_prepare_targets(module_name, targets):
+    module = load_function(PIPELINE_LAMBDA_DIR, module_name)
+    if module_name == "prepare_ami_deployment":
+        manifest = {"builds": [{"artifact_id": "eu-west-1:ami-00000000000000001"}]}
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zip_file:
+            zip_file.writestr("manifest.json", json.dumps(manifest))
+        aws.put_s3_object("pipeline", "input.zip", body=buffer.getvalue())
+        aws.images["ami-00000000000000001"] = "app-image-1"
+        keys = ("ImageId", "ImageName")
+    else:
+        aws.put_s3_object("pipeline", "input.zip", size=MB)
+        keys = ("AppVersionId", "AppVersionName")
+
+    # Store the targets in the pipeline bucket, as the pipeline module
+    # does for Prepare actions with more than one target.
+    target_list = []
+    for n in range(targets):
+        name = f"app{n}"
+        parameter_names = {key: f"/{name}/{key}" for key in keys}
+        set_up_parameters(parameter_names)
+        set_up_stack(name=name)
+        target_list.append(
+            {
+                "AppLocation": {"Bucket": name, "Key": "app.zip"},
+                "AssumeRoleArn": f"arn:aws:iam::12345678901{n}:role/{name}-pipeline",
+                "OutputArtifact": f"{name}_cloudformation_template",
+                "ParameterNames": parameter_names,
+                "StackName": name,
+                "TemplateFilename": "cfn.yaml",
+            }
+        )
+    aws.put_s3_object(
+        "pipeline",
+        "prepare-targets/0-0.json",
+        body=json.dumps({"Targets": target_list}).encode("utf-8"),
+    )
+    event = make_codepipeline_event(
+        {"TargetsLocation": {"Bucket": "pipeline", "Key": "prepare-targets/0-0.json"}},
+        output_artifacts=[target["OutputArtifact"] for target in target_list],
+    )
+    return lambda: module.lambda_handler(event, make_context(module_name))
+
+
+def scenario_cleanup_app(versions, chunks=False):
+    module = load_function(PIPELINE_LAMBDA_DIR, "cleanup_app_deployment")
+    for n in range(versions):
+
+        # Chunked apps keep the previous version, which is a zip file from
+        # before the pipeline switched to chunked artifacts. Each of the
+        # other versions changes a tenth of the chunks of the one before.
+        if chunks and n != versions - 2:
+            version_chunks, manifest = make_app_chunks(
+                20, changed_percent=10 * (n % 10), chunk_size=32
+            )
+            for chunk, data in version_chunks.items():
+                aws.put_s3_object("app", f"chunks/{chunk}", body=data)
+            body = json.dumps(dict(manifest, ChunkPrefix="chunks/")).encode("utf-8")
+            used_version = aws.put_s3_object(
+                "app", "app.zip", body=body, content_type="application/json"
+            )
+        else:
+            used_version = aws.put_s3_object("app", "app.zip", size=1)
+    set_up_stack([{"OutputKey": "AppVersionId", "OutputValue": used_version}])
+    event = make_codepipeline_event(
+        {
+            "AppLocation": {"Bucket": "app", "Key": "app.zip"},
+            "ArtifactFormat": "chunks" if chunks else "zip",
+            "AssumeRoleArn": "arn:aws:iam::123456789012:role/app-pipeline",
+            "KeepVersions": 1 if chunks else 0,
+            "StackName": "app",
+        }
+    )
+    return lambda: module.lambda_handler(event, make_context("cleanup-app"))
+
+
+def scenario_cfn_params(desired_capacity, target_groups=0):
+    arns = [
+        f"arn:aws:elasticloadbalancing:::targetgroup/{n}" for n in range(target_groups)
+    ]
+    module = load_function(
+        os.path.join(ASG_DIR, "cfn_params"),
+        "cfn_params_lambda",
+        filename="lambda.py",
+        environment={
+            "AUTO_SCALING_GROUP_NAME": "app",
+            "DEFAULT_AMI_SSM_PARAMETER": "/aws/service/ami",
+        },
+    )
+    aws.parameters["/aws/service/ami"] = "ami-00000000000000000"
+    instance_ids = [f"i-{n:017d}" for n in range(desired_capacity)]
+    for arn in arns:
+        aws.target_groups[arn] = {
+            "TargetGroupArn": arn,
+            "Targets": [{"Id": instance_id} for instance_id in instance_ids],
+        }
+    aws.auto_scaling_groups["app"] = {
+        "AutoScalingGroupARN": "arn:aws:autoscaling:::app",
+        "AutoScalingGroupName": "app",
+        "DesiredCapacity": desired_capacity,
+        "Instances": [
+            {
+                "HealthStatus": "Healthy",
+                "InstanceId": instance_id,
+                "LifecycleState": "InService",
+            }
+            for instance_id in instance_ids
+        ],
+        "MaxSize": desired_capacity * 2,
+        "MinSize": 1,
+    }
+    event = make_custom_resource_event(
+        {
+            "AppVersionId": "1",
+            "CapacityFloorPercent": "100",
+            "ImageId": "ami-00000000000000001",
+            "MaxBatchSize": "-1",
+            "MaxSize": str(desired_capacity * 2),
+            "MinInstancesInService": "-1",
+            "MinSize": "1",
+            "TargetGroupARNs": arns,
+        }
+    )
+    return lambda: module.lambda_handler(event, make_context("cfn-params"))
+
+
+def scenario_cfn_signal(target_groups, instances=1, warm_pool=False, terminated=0):
+    arns = [
+        f"arn:aws:elasticloadbalancing:::targetgroup/{n}" for n in range(target_groups)
+    ]
+    module = load_function(
+        os.path.join(ASG_DIR, "cfn_signal"),
+        "cfn_signal_lambda",
+        filename="lambda.py",
+        environment={
+            "LOGICAL_RESOURCE_ID": "AutoScalingGroup",
+            "POLL_INTERVAL": "10",
+            "STACK_NAME": "app",
+            "TARGET_GROUP_ARNS": json.dumps(arns),
+        },
+    )
+    for arn in arns:
+        aws.target_groups[arn] = {
+            "HealthCheckIntervalSeconds": 10,
+            "Port": 80,
+            "TargetGroupArn": arn,
+        }
+    aws.healthy_after_polls = 5
+    launch_events = [
+        {
+            "detail": {
+                "AutoScalingGroupName": "app",
+                "Destination": "AutoScalingGroup",
+                "EC2InstanceId": f"i-{n:017d}",
+                "Origin": "WarmPool" if warm_pool else "EC2",
+            },
+            "detail-type": "EC2 Instance Launch Successful",
+            "source": "aws.autoscaling",
+        }
+        for n in range(instances)
+    ]
+    # Every other instance from the warm pool has an outdated launch template.
+    aws.auto_scaling_groups["app"] = {
+        "AutoScalingGroupName": "app",
+        "Instances": [
+            {
+                "InstanceId": f"i-{n:017d}",
+                "LaunchTemplate": {"Version": str(2 - n % 2)},
+                "LifecycleState": "InService",
+            }
+            for n in range(instances)
+        ],
+        "LaunchTemplate": {"Version": "2"},
+    }
+
+    # Terminated instances are invalid targets, and leave the group.
+    for n in range(terminated):
+        aws.invalid_instances.add(f"i-{n:017d}")
+        aws.auto_scaling_groups["app"]["Instances"][n]["LifecycleState"] = "Terminated"
+    if instances == 1:
+        event = launch_events[0]
+    else:
+        event = {"Records": [{"body": json.dumps(e)} for e in launch_events]}
+    return lambda: module.lambda_handler(event, make_context("cfn-signal"))
+
+
+def scenario_cfn_response(failures):
+    aws.response_failures = failures
+    return scenario_cfn_params(2)
+
+
+def scenario_cfn_refresh(phase):
+    module = load_function(
+        os.path.join(ASG_DIR, "cfn_refresh"),
+        "cfn_refresh_lambda",
+        filename="lambda.py",
+        environment={
+            "PENDING_REQUEST_PATH": "/app/cfn-refresh-pending-requests",
+            "SCHEDULE_RULE_NAME": "app-cfn-refresh-schedule",
+        },
+    )
+    event = make_custom_resource_event(
+        {
+            "AutoScalingGroupName": "app",
+            "LaunchTemplateVersion": "2",
+            "Preferences": {
+                "CheckpointPercentages": "50,100",
+                "InstanceWarmup": "60",
+                "MinHealthyPercentage": "90",
+                "SkipMatching": "true",
+            },
+        }
+    )
+    if phase == "start":
+        return lambda: module.lambda_handler(event, make_context("cfn-refresh"))
+
+    # Finish an instance refresh that was started by a previous invocation.
+    # With overlapping requests, both are saved and both are responded to.
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.lambda_handler(event, make_context("cfn-refresh"))
+        if phase == "overlap":
+            module.lambda_handler(
+                dict(event, RequestId="33333333-3333-3333-3333-333333333333"),
+                make_context("cfn-refresh"),
+            )
+    for refresh in aws.instance_refreshes.values():
+        refresh.update(PercentageComplete=100, Status="Successful")
+    aws.calls.clear()
+    aws.responses.clear()
+    finished_event = {
+        "detail": {"AutoScalingGroupName": "app"},
+        "detail-type": "EC2 Auto Scaling Instance Refresh Succeeded",
+        "source": "aws.autoscaling",
+    }
+    return lambda: module.lambda_handler(finished_event, make_context("cfn-refresh"))
+
+
+def scenario_cfn_wait(draining_instances):
+    module = load_function(
+        os.path.join(ASG_DIR, "cfn_wait"), "cfn_wait_lambda", filename="lambda.py"
+    )
+    aws.auto_scaling_groups["app"] = {
+        "AutoScalingGroupARN": "arn:aws:autoscaling:::app",
+        "AutoScalingGroupName": "app",
+        "DesiredCapacity": draining_instances,
+        "Instances": [
+            {
+                "Draining": True,
+                "InstanceId": f"i-{n:017d}",
+                "LifecycleState": "InService",
+            }
+            for n in range(draining_instances)
+        ],
+    }
+    aws.terminating_wait_polls = 5
+    event = make_custom_resource_event({"AutoScalingGroupName": "app"})
+    return lambda: module.lambda_handler(event, make_context("cfn-wait"))
+
+
+def scenario_cfn_wait_events(pending_requests):
+    module = load_function(
+        os.path.join(ASG_DIR, "cfn_wait"),
+        "cfn_wait_lambda",
+        filename="lambda.py",
+        environment={
+            "PENDING_REQUEST_PATH": "/app/cfn-wait-pending-requests",
+            "SCHEDULE_RULE_NAME": "app-cfn-wait-schedule",
+            "WAIT_MODE": "event",
+        },
+    )
+    aws.auto_scaling_groups["app"] = {
+        "AutoScalingGroupARN": "arn:aws:autoscaling:::app",
+        "AutoScalingGroupName": "app",
+        "DesiredCapacity": 1,
+        "Instances": [
+            {
+                "InstanceId": "i-00000000000000000",
+                "LifecycleState": "Terminating:Wait",
+            }
+        ],
+    }
+
+    # Save overlapping requests while an instance is still terminating.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(pending_requests):
+            event = make_custom_resource_event({"AutoScalingGroupName": "app"})
+            event["RequestId"] = f"request-{n}"
+            module.lambda_handler(event, make_context("cfn-wait"))
+    aws.auto_scaling_groups["app"]["Instances"] = []
+    aws.calls.clear()
+    aws.responses.clear()
+    scheduled_event = {"detail-type": "Scheduled Event", "source": "aws.events"}
+    return lambda: module.lambda_handler(scheduled_event, make_context("cfn-wait"))
+
+
+SCENARIOS = {
+    "bake": (scenario_bake, "minutes", [1, 30]),
+    "prepare_app": (scenario_prepare_app, "size_mb", [1, 512, 6144]),
+    "prepare_ami": (scenario_prepare_ami, "size_mb", [1, 16, 64]),
+    "distribute_ami": (scenario_distribute_ami, "targets", [1, 5]),
+    "prepare_ami_builds": (
+        lambda builds: scenario_prepare_ami(1, builds=builds),
+        "builds",
+        [1, 50],
+    ),
+    "prepare_ami_rerun": (
+        lambda size_mb: scenario_prepare_ami(size_mb, rerun=True),
+        "size_mb",
+        [1, 64],
+    ),
+    "prepare_ami_targets": (
+        lambda targets: scenario_prepare_targets("prepare_ami_deployment", targets),
+        "targets",
+        [1, 5],
+    ),
+    "prepare_app_targets": (
+        lambda targets: scenario_prepare_targets("prepare_app_deployment", targets),
+        "targets",
+        [1, 5],
+    ),
+    "prepare_app_json": (
+        lambda rerun: scenario_prepare_app(1, rerun=rerun, json_parameters=True),
+        "rerun",
+        [False, True],
+    ),
+    "prepare_app_chunks": (
+        scenario_prepare_app_chunks,
+        "changed_percent",
+        [100, 10, 0],
+    ),
+    "prepare_app_new": (
+        lambda json: scenario_prepare_app(1, json_parameters=json, new_stack=True),
+        "json",
+        [False, True],
+    ),
+    "prepare_app_rerun": (
+        lambda size_mb: scenario_prepare_app(size_mb, rerun=True),
+        "size_mb",
+        [1, 6144],
+    ),
+    "cleanup_app": (scenario_cleanup_app, "versions", [10, 1000, 5000]),
+    "cleanup_app_chunks": (
+        lambda versions: scenario_cleanup_app(versions, chunks=True),
+        "versions",
+        [10, 100],
+    ),
+    "cfn_params": (scenario_cfn_params, "capacity", [2, 20]),
+    "cfn_params_elb": (
+        lambda target_groups: scenario_cfn_params(20, target_groups),
+        "target_groups",
+        [1, 4],
+    ),
+    "cfn_signal": (scenario_cfn_signal, "target_groups", [1, 4, 8]),
+    "cfn_signal_batch": (
+        lambda instances: scenario_cfn_signal(4, instances),
+        "instances",
+        [1, 10, 20],
+    ),
+    "cfn_signal_gone": (
+        lambda instances: scenario_cfn_signal(4, instances, terminated=1),
+        "instances",
+        [1, 10],
+    ),
+    "cfn_signal_warm_pool": (
+        lambda instances: scenario_cfn_signal(4, instances, warm_pool=True),
+        "instances",
+        [1, 10],
+    ),
+    "cfn_refresh": (
+        scenario_cfn_refresh,
+        "phase",
+        ["start", "finish", "overlap"],
+    ),
+    "cfn_response": (scenario_cfn_response, "failures", [0, 2]),
+    "cfn_wait": (scenario_cfn_wait, "draining", [1, 10]),
+    "cfn_wait_events": (scenario_cfn_wait_events, "requests", [1, 3]),
+}
+
+
+def run_scenario(setup, value):
+    """
+    Runs a scenario twice, once to measure latency and API calls,
+    and once to measure peak memory, and returns the results.
+
+    """
+
+    results = {}
+    for measure_memory in (False, True):
+        aws.reset()
+        invoke = setup(value)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), fake_response_url():
+            if measure_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            invoke()
+            elapsed = time.perf_counter() - started
+            if measure_memory:
+                results["peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+            else:
+                results["latency_ms"] = round(elapsed * 1000, 1)
+                results["api_calls"] = sum(aws.calls.values())
+                results["simulated_sleep_s"] = round(aws.sleeps, 1)
+
+        failures = [msg for status, msg in aws.job_results if status != "SUCCESS"]
+        failures += [r["Reason"] for r in aws.responses if r["Status"] != "SUCCESS"]
+        if failures:
+            sys.stderr.write(output.getvalue())
+            raise RuntimeError(f"Scenario failed: {failures[0]}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="simulated latency of each AWS API call, in seconds (default 0.02)",
+    )
+    parser.add_argument("--json", action="store_true", help="output JSON lines")
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"scenarios to run: {', '.join(sorted(SCENARIOS))}"
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+
+    aws.latency = args.latency
+
+    if not args.json:
+        print(
+            f"{'scenario':<20} {'parameter':<20} {'latency ms':>10} "
+            f"{'api calls':>9} {'sleep s':>8} {'peak KB':>8}"
+        )
+
+    for name in args.scenarios or sorted(SCENARIOS):
+        setup, parameter, values = SCENARIOS[name]
+        for value in values:
+            results = run_scenario(setup, value)
+            if args.json:
+                print(json.dumps(dict(scenario=name, **{parameter: value}, **results)))
+            else:
+                print(
+                    f"{name:<20} {f'{parameter}={value}':<20} "
+                    f"{results['latency_ms']:>10} {results['api_calls']:>9} "
+                    f"{results['simulated_sleep_s']:>8} {results['peak_kb']:>8}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Creates a chunked app artifact, for pipelines with app_artifact_format
+set to "chunks". Files are split into chunks named by their SHA-256 hash,
+so chunks that are the same as in previous versions are not copied again.
+
+Usage:
+
+    python3 chunk_app.py OUTPUT.zip FILE ...
+
+"""
+
+import hashlib
+import json
+import sys
+import zipfile
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def main(output_path, paths):
+    files = {}
+    with zipfile.ZipFile(output_path, "w") as zip_file:
+        written = set()
+        for path in paths:
+            files[path] = []
+            with open(path, "rb") as open_file:
+                for data in iter(lambda: open_file.read(CHUNK_SIZE), b""):
+                    chunk = hashlib.sha256(data).hexdigest()
+                    files[path].append(chunk)
+                    if chunk not in written:
+                        zip_file.writestr(f"chunks/{chunk}", data)
+                        written.add(chunk)
+        zip_file.writestr("app-manifest.json", json.dumps({"Files": files}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
@@ -3,35 +3,47 @@
 # the AMI and app version used by the EC2 instances in the ASG.
 
 locals {
-  ami_pipeline_parameters = var.ami_pipeline ? {
-    ImageId   = aws_ssm_parameter.image_id[0].name
-    ImageName = aws_ssm_parameter.image_name[0].name
-    } : {
+  ami_pipeline_parameters = var.ami_pipeline ? (
+    var.ssm_json_parameters ? {
+      AmiDeployment = aws_ssm_parameter.ami_deployment[0].name
+      } : {
+      ImageId   = aws_ssm_parameter.image_id[0].name
+      ImageName = aws_ssm_parameter.image_name[0].name
+    }
+    ) : {
     ImageId = var.image_id
   }
-  app_pipeline_parameters = var.app_pipeline ? {
-    AppVersionId   = aws_ssm_parameter.app_version_id[0].name
-    AppVersionName = aws_ssm_parameter.app_version_name[0].name
-  } : {}
+  app_pipeline_parameters = var.app_pipeline ? (
+    var.ssm_json_parameters ? {
+      AppDeployment = aws_ssm_parameter.app_deployment[0].name
+      } : {
+      AppVersionId   = aws_ssm_parameter.app_version_id[0].name
+      AppVersionName = aws_ssm_parameter.app_version_name[0].name
+    }
+  ) : {}
   cfn_template_body = trimspace(templatefile("${path.module}/cfn.yaml.tpl", {
     access_control            = var.enabled ? random_string.access_control[0].result : ""
     ami_pipeline              = var.ami_pipeline
     app_pipeline              = var.app_pipeline
+    capacity_floor_percent    = var.capacity_floor_percent
     cfn_params_lambda_arn     = module.cfn_params_lambda.arn
+    cfn_refresh_lambda_arn    = local.cfn_refresh_enabled ? module.cfn_refresh_lambda.arn : ""
     cfn_wait_lambda_arn       = module.cfn_wait_lambda.arn
     detailed_monitoring       = var.detailed_monitoring
     health_check_grace_period = var.health_check_grace_period
-    health_check_type         = var.health_check_type
+    health_check_type         = local.health_check_type
     image_id                  = var.image_id
     instance_profile_arn      = var.instance_profile_arn
+    instance_refresh          = local.instance_refresh_preferences
     instance_type             = var.instance_type
+    json_parameters           = var.ssm_json_parameters
     key_name                  = var.key_name
     lifecycle_hooks           = var.lifecycle_hooks
     max_size                  = var.max_size
     min_size                  = var.min_size
     name                      = var.name
     rolling_update_policy = merge({
-      MaxBatchSize                  = var.max_size
+      MaxBatchSize                  = -1
       MinInstancesInService         = -1
       MinSuccessfulInstancesPercent = 100
       PauseTime                     = "PT1H"
@@ -40,7 +52,9 @@ locals {
     subnet_ids            = var.subnet_ids
     tags                  = var.tags
     target_group_arns     = var.target_group_arns
+    update_mode           = var.update_mode
     user_data             = var.user_data
+    warm_pool             = var.warm_pool
     block_device_mappings = var.block_device_mappings
   }))
   cfn_template_hash_parameters = {
@@ -4,18 +4,27 @@
 # ends up as a dollar-brace to be parsed by CloudFormation.
 
 Parameters:
-%{ if app_pipeline ~}
+%{ if app_pipeline && json_parameters ~}
+  AppDeployment:
+    Type: AWS::SSM::Parameter::Value<String>
+%{ endif ~}
+%{ if app_pipeline && !json_parameters ~}
   AppVersionId:
     Type: AWS::SSM::Parameter::Value<String>
   AppVersionName:
     Type: AWS::SSM::Parameter::Value<String>
 %{ endif ~}
-%{ if ami_pipeline ~}
+%{ if ami_pipeline && json_parameters ~}
+  AmiDeployment:
+    Type: AWS::SSM::Parameter::Value<String>
+%{ endif ~}
+%{ if ami_pipeline && !json_parameters ~}
   ImageId:
     Type: AWS::SSM::Parameter::Value<String>
   ImageName:
     Type: AWS::SSM::Parameter::Value<String>
-%{ else ~}
+%{ endif ~}
+%{ if !ami_pipeline ~}
   ImageId:
     Type: String
 %{ endif ~}
@@ -24,17 +33,36 @@ Parameters:
 
 Resources:
 
+  # The Params function returns the AMI and app version details as
+  # attributes, decoding them first if they are stored as JSON.
+  # It also plans the rolling update batch sizes from the current
+  # capacity of the ASG.
   Params:
     Type: Custom::Params
     Properties:
-%{ if app_pipeline ~}
+%{ if ami_pipeline && json_parameters ~}
+      AmiDeployment: !Ref AmiDeployment
+%{ endif ~}
+%{ if app_pipeline && json_parameters ~}
+      AppDeployment: !Ref AppDeployment
+%{ endif ~}
+%{ if app_pipeline && !json_parameters ~}
       AppVersionId: !Ref AppVersionId
+      AppVersionName: !Ref AppVersionName
 %{ endif ~}
+      CapacityFloorPercent: ${capacity_floor_percent}
+%{ if !(ami_pipeline && json_parameters) ~}
       ImageId: !Ref ImageId
+%{ endif ~}
+%{ if ami_pipeline && !json_parameters ~}
+      ImageName: !Ref ImageName
+%{ endif ~}
+      MaxBatchSize: ${rolling_update_policy.MaxBatchSize}
       MaxSize: ${max_size}
       MinInstancesInService: ${rolling_update_policy.MinInstancesInService}
       MinSize: ${min_size}
       ServiceToken: ${cfn_params_lambda_arn}
+      TargetGroupARNs: ${jsonencode(target_group_arns)}
 
   AutoScalingGroup:
     Type: AWS::AutoScaling::AutoScalingGroup
@@ -82,9 +110,10 @@ Resources:
 %{ if length(subnet_ids) > 0 ~}
       VPCZoneIdentifier: ${jsonencode(subnet_ids)}
 %{ endif ~}
+%{ if update_mode == "rolling" ~}
     UpdatePolicy:
       AutoScalingRollingUpdate:
-        MaxBatchSize: ${rolling_update_policy.MaxBatchSize}
+        MaxBatchSize: !GetAtt Params.MaxBatchSize
         MinInstancesInService: !GetAtt Params.MinInstancesInService
         MinSuccessfulInstancesPercent: ${rolling_update_policy.MinSuccessfulInstancesPercent}
         PauseTime: ${rolling_update_policy.PauseTime}
@@ -95,6 +124,7 @@ Resources:
         - AlarmNotification
         - ScheduledActions
         WaitOnResourceSignals: true
+%{ endif ~}
 
   LaunchTemplate:
     Type: AWS::EC2::LaunchTemplate
@@ -122,15 +152,15 @@ Resources:
             Value: "${access_control}"
 %{ if app_pipeline ~}
           - Key: AppVersionId
-            Value: !Ref AppVersionId
+            Value: !GetAtt Params.AppVersionId
           - Key: AppVersionName
-            Value: !Ref AppVersionName
+            Value: !GetAtt Params.AppVersionName
 %{ endif ~}
           - Key: ImageId
-            Value: !Ref ImageId
+            Value: !GetAtt Params.ImageId
 %{ if ami_pipeline ~}
           - Key: ImageName
-            Value: !Ref ImageName
+            Value: !GetAtt Params.ImageName
 %{ endif ~}
           - Key: Name
             Value: "${name}"
@@ -143,20 +173,50 @@ Resources:
 %{ endif ~}
       LaunchTemplateName: "${name}"
 
+%{ if warm_pool != null ~}
+  # Instances in the warm pool are launched and initialized ahead of time,
+  # so they can be put into service quickly during scale outs and rolling
+  # updates. Outdated instances are replaced by the Signal function when
+  # they leave the warm pool.
+  WarmPool:
+    Type: AWS::AutoScaling::WarmPool
+    Properties:
+      AutoScalingGroupName: !Ref AutoScalingGroup
+%{ for key, value in warm_pool ~}
+      ${key}: ${value}
+%{ endfor ~}
+
+%{ endif ~}
+%{ if update_mode == "refresh" ~}
+  # The Refresh function replaces outdated instances using an instance
+  # refresh, instead of a rolling update, whenever a new launch template
+  # version is created by deployments or other changes.
+  Refresh:
+    Type: Custom::Refresh
+    Properties:
+      AutoScalingGroupName: !Ref AutoScalingGroup
+      LaunchTemplateVersion: !GetAtt LaunchTemplate.LatestVersionNumber
+      Preferences: ${jsonencode(instance_refresh)}
+      ServiceToken: ${cfn_refresh_lambda_arn}
+
+%{ endif ~}
   Wait:
     Type: Custom::Wait
     DependsOn:
     - AutoScalingGroup
     - LaunchTemplate
+%{ if update_mode == "refresh" ~}
+    - Refresh
+%{ endif ~}
     Properties:
 %{ if app_pipeline ~}
-      AppVersionId: !Ref AppVersionId
-      AppVersionName: !Ref AppVersionName
+      AppVersionId: !GetAtt Params.AppVersionId
+      AppVersionName: !GetAtt Params.AppVersionName
 %{ endif ~}
       AutoScalingGroupName: !Ref AutoScalingGroup
-      ImageId: !Ref ImageId
+      ImageId: !GetAtt Params.ImageId
 %{ if ami_pipeline ~}
-      ImageName: !Ref ImageName
+      ImageName: !GetAtt Params.ImageName
 %{ endif ~}
       LaunchTemplate: !Ref LaunchTemplate
       ServiceToken: ${cfn_wait_lambda_arn}
@@ -165,7 +225,7 @@ Resources:
 Outputs:
 %{ if app_pipeline ~}
   AppVersionId:
-    Value: !Ref AppVersionId
+    Value: !GetAtt Params.AppVersionId
 %{ endif ~}
   AutoScalingGroupARN:
     Value: !GetAtt Wait.AutoScalingGroupARN
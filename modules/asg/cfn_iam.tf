@@ -22,24 +22,19 @@ data "aws_iam_policy_document" "cloudformation" {
   dynamic "statement" {
     for_each = toset(range(var.ami_pipeline || var.app_pipeline ? 1 : 0))
     content {
-      sid     = "ReadParameters"
-      actions = ["ssm:GetParameters"]
-      resources = concat(
-        aws_ssm_parameter.app_version_id[*].arn,
-        aws_ssm_parameter.app_version_name[*].arn,
-        aws_ssm_parameter.image_id[*].arn,
-        aws_ssm_parameter.image_name[*].arn,
-      )
+      sid       = "ReadParameters"
+      actions   = ["ssm:GetParameters"]
+      resources = local.ssm_param_arns
     }
   }
 
   statement {
     sid     = "InvokeLambda"
     actions = ["lambda:Invoke*"]
-    resources = [
+    resources = concat([
       module.cfn_params_lambda.arn,
       module.cfn_wait_lambda.arn,
-    ]
+    ], local.cfn_refresh_enabled ? [module.cfn_refresh_lambda.arn] : [])
   }
 
   # Allow describing various resources.
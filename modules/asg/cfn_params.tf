@@ -29,6 +29,7 @@ module "cfn_params_lambda" {
     variables = {
       AUTO_SCALING_GROUP_NAME   = var.name
       DEFAULT_AMI_SSM_PARAMETER = local.default_ami_ssm_parameter
+      LOG_LEVEL                 = var.log_level
     }
   }
 }
@@ -41,6 +42,15 @@ data "aws_iam_policy_document" "cfn_params_lambda" {
     resources = ["*"]
   }
 
+  dynamic "statement" {
+    for_each = toset(range(length(var.target_group_arns) > 0 ? 1 : 0))
+    content {
+      effect    = "Allow"
+      actions   = ["elasticloadbalancing:DescribeTargetHealth"]
+      resources = ["*"]
+    }
+  }
+
   statement {
     effect  = "Allow"
     actions = ["ssm:GetParameter"]
@@ -7,27 +7,52 @@
 #
 # Updated by Claranet:
 #   - Use built-in urllib instead of requests to avoid external dependency
+#   - Reuse connections, with timeouts and retries with jittered backoff
+#   - Log with the shared structured logger
 #
 
+import http.client
 import json
-import urllib.request
+import random
+import time
+import urllib.parse
+
+from logger import logger
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+# CloudFormation waits up to an hour for a response, so a slow or failed
+# request must not be the end of it. Each attempt has a timeout, and failed
+# attempts are retried after a random delay that grows with each attempt.
+ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+TIMEOUT = 10
+
+# Connections are kept open and reused for later responses to the same
+# host, including those sent by later invocations of a warm function.
+connections = {}
+
 
 def send(
-    event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False
+    event,
+    context,
+    responseStatus,
+    responseData,
+    physicalResourceId=None,
+    noEcho=False,
+    reason=None,
 ):
     responseUrl = event["ResponseURL"]
 
-    print(responseUrl)
-
     responseBody = {}
     responseBody["Status"] = responseStatus
     responseBody["Reason"] = (
         "See the details in CloudWatch Log Stream: " + context.log_stream_name
     )
+    if reason:
+        responseBody["Reason"] = reason + ". " + responseBody["Reason"]
     responseBody["PhysicalResourceId"] = physicalResourceId or context.log_stream_name
     responseBody["StackId"] = event["StackId"]
     responseBody["RequestId"] = event["RequestId"]
@@ -37,13 +62,73 @@ def send(
 
     json_responseBody = json.dumps(responseBody)
 
-    print("Response body:\n" + json_responseBody)
+    logger.info(
+        "Sending response",
+        LogicalResourceId=event["LogicalResourceId"],
+        Status=responseStatus,
+    )
+    if not noEcho:
+        logger.debug("Response body", Body=responseBody)
 
-    headers = {"content-type": "", "content-length": str(len(json_responseBody))}
+    put(responseUrl, json_responseBody.encode())
 
-    req = urllib.request.Request(
-        url=responseUrl, method="PUT", data=json_responseBody.encode(), headers=headers
-    )
-    with urllib.request.urlopen(req) as f:
-        pass
-    print("Status code: " + f.reason)
+
+def get_connection(host):
+    """
+    Returns an open connection to the host, and whether it has been used
+    before, in which case the server might have closed it since then.
+
+    """
+
+    connection = connections.get(host)
+    if connection:
+        return (connection, True)
+    connection = http.client.HTTPSConnection(host, timeout=TIMEOUT)
+    connections[host] = connection
+    return (connection, False)
+
+
+def put(url, body):
+    """
+    Sends the response body to the pre-signed S3 URL, retrying failed
+    requests and server errors.
+
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    headers = {"content-type": "", "content-length": str(len(body))}
+
+    for attempt in range(1, ATTEMPTS + 1):
+        start = time.perf_counter()
+        connection, reused = get_connection(parts.netloc)
+        retry_now = False
+        try:
+            connection.request("PUT", path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError) as error:
+            connections.pop(parts.netloc, None)
+            connection.close()
+            result = f"{type(error).__name__}: {error}"
+            retry = True
+            # A reused connection might have been closed by the server
+            # while it was idle, so retry straight away with a new one.
+            retry_now = reused
+        else:
+            result = f"{response.status} {response.reason}"
+            retry = response.status >= 500
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.log(
+            "WARNING" if retry else "INFO",
+            "Response attempt",
+            {"Attempt": attempt, "Duration": round(elapsed), "Result": result},
+        )
+
+        if not retry:
+            return
+        if attempt < ATTEMPTS and not retry_now:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+
+    raise Exception(f"Failed to send response after {ATTEMPTS} attempts")
@@ -1,17 +1,34 @@
-import os
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
 
-import boto3
+import json
+import math
+import os
 
 import cfnresponse
+from clients import LazyClient
+from logger import logger
 
-autoscaling_client = boto3.client("autoscaling")
-ssm_client = boto3.client("ssm")
+autoscaling_client = LazyClient("autoscaling")
+elb_client = LazyClient("elbv2")
+ssm_client = LazyClient("ssm")
 
 AUTO_SCALING_GROUP_NAME = os.environ["AUTO_SCALING_GROUP_NAME"]
 DEFAULT_AMI_SSM_PARAMETER = os.environ["DEFAULT_AMI_SSM_PARAMETER"]
 
+# Properties containing JSON documents with the AMI or app version details,
+# used instead of separate properties when the pipelines store them
+# in one SSM parameter each.
+JSON_PROPERTIES = ("AmiDeployment", "AppDeployment")
+
+# Properties that are returned as attributes for use in the template.
+VERSION_PROPERTIES = ("AppVersionId", "AppVersionName", "ImageName")
+
 
 def lambda_handler(event, context):
+    logger.reset(context)
+    metrics.reset(context)
     status = cfnresponse.FAILED
     physical_resource_id = None
     response_data = {}
@@ -24,79 +41,83 @@ def lambda_handler(event, context):
         request_type = event["RequestType"]
         is_delete_operation = request_type == "Delete"
 
+        properties = get_properties(event)
+
         # Check if this ASG has been created for use with AMI or app pipelines,
         # and either of those pipelines haven't been used yet. In that case,
         # it wouldn't make sense to launch instances yet.
-        app_version_id = event["ResourceProperties"].get("AppVersionId")
-        image_id = event["ResourceProperties"]["ImageId"]
+        app_version_id = properties.get("AppVersionId")
+        image_id = properties["ImageId"]
         is_new_pipeline = app_version_id == "-" or image_id == "-"
 
         if is_new_pipeline or is_delete_operation:
 
             if is_new_pipeline:
-                print("New pipeline, set to 0")
+                logger.info("New pipeline, set to 0")
 
             if is_delete_operation:
-                print("Delete operation, set to 0")
+                logger.info("Delete operation, set to 0")
 
             min_size = 0
             max_size = 0
             min_instances_in_service = 0
+            max_batch_size = 1
 
             if image_id == "-":
                 # Pick a valid AMI. It won't be used with the ASG
                 # size set to 0 so it doesn't matter what it is.
-                image_id = get_ami(DEFAULT_AMI_SSM_PARAMETER)
+                with metrics.timer("AmiLookup"):
+                    image_id = get_ami(DEFAULT_AMI_SSM_PARAMETER)
 
         else:
 
-            min_size = int(event["ResourceProperties"]["MinSize"])
-            max_size = int(event["ResourceProperties"]["MaxSize"])
+            min_size = int(properties["MinSize"])
+            max_size = int(properties["MaxSize"])
+            min_instances_in_service = int(properties["MinInstancesInService"])
+            max_batch_size = int(properties.get("MaxBatchSize", max_size))
 
-            min_instances_in_service = int(
-                event["ResourceProperties"]["MinInstancesInService"]
-            )
-            if min_instances_in_service < 0:
+            if min_instances_in_service < 0 or max_batch_size < 0:
 
                 # CloudFormation tries to keep a specified number of instances
-                # in-service while replacing instances. Try to use the current
-                # number of running instances.
-                min_instances_in_service = get_desired_capacity(AUTO_SCALING_GROUP_NAME)
-                print(
-                    f"Using desired capacity for MinInstancesInService={min_instances_in_service}"
-                )
-
-                # Unless it's below the minimum size of the ASG,
-                # in which case try to use that.
-                if min_instances_in_service < min_size:
-                    min_instances_in_service = min_size
-                    print(
-                        f"Desired capacity too low, set MinInstancesInService={min_instances_in_service}"
-                    )
-
-                # The number can't be the maximum size of the ASG because
-                # it needs to be allowed to terminate instances (bringing
-                # the number of in-service instance down) to replace them.
-                if min_instances_in_service >= max_size:
-                    if max_size > 1:
-                        min_instances_in_service = max_size - 1
-                    else:
-                        min_instances_in_service = 0
-                    print(
-                        f"Desired capacity too high, set MinInstancesInService={min_instances_in_service}"
+                # in-service while replacing instances. Work out how many
+                # instances that should be, and how many can be replaced
+                # at a time, from the current state of the ASG.
+                with metrics.timer("CapacityLookup"):
+                    capacity = get_capacity(
+                        AUTO_SCALING_GROUP_NAME, properties.get("TargetGroupARNs", [])
                     )
+                plan = plan_rolling_update(
+                    capacity=capacity,
+                    min_size=min_size,
+                    max_size=max_size,
+                    floor_percent=int(properties.get("CapacityFloorPercent", 100)),
+                    min_instances_in_service=min_instances_in_service,
+                )
+                logger.info("Capacity plan", **plan)
+                min_instances_in_service = plan["MinInstancesInService"]
+                if max_batch_size < 0:
+                    max_batch_size = plan["MaxBatchSize"]
 
         response_data = {
             "ImageId": image_id,
             "MinSize": min_size,
             "MaxSize": max_size,
             "MinInstancesInService": min_instances_in_service,
+            "MaxBatchSize": max_batch_size,
         }
+        for key in VERSION_PROPERTIES:
+            if key in properties:
+                response_data[key] = properties[key]
 
         status = cfnresponse.SUCCESS
 
     finally:
-        cfnresponse.send(event, context, status, response_data, physical_resource_id)
+        with metrics.timer("Respond"):
+            cfnresponse.send(
+                event, context, status, response_data, physical_resource_id
+            )
+        logger.flush()
+        metrics.emit()
 
 
 def get_ami(ssm_parameter_name):
@@ -108,16 +129,124 @@ def get_ami(ssm_parameter_name):
     return response["Parameter"]["Value"]
 
 
-def get_desired_capacity(auto_scaling_group_name):
+def get_capacity(auto_scaling_group_name, target_group_arns):
     """
-    Returns the current desired capacity of the ASG,
-    or zero if it doesn't exist.
+    Returns the current capacity of the ASG, counting its instances
+    by state. Instances that are in service but failing target group
+    health checks are counted as unhealthy.
 
     """
 
+    capacity = {
+        "DesiredCapacity": 0,
+        "Healthy": 0,
+        "Pending": 0,
+        "Standby": 0,
+        "Unhealthy": 0,
+    }
+
     response = autoscaling_client.describe_auto_scaling_groups(
         AutoScalingGroupNames=[auto_scaling_group_name],
     )
-    for asg in response["AutoScalingGroups"]:
-        return asg["DesiredCapacity"]
-    return 0
+    if not response["AutoScalingGroups"]:
+        return capacity
+    asg = response["AutoScalingGroups"][0]
+    capacity["DesiredCapacity"] = asg["DesiredCapacity"]
+
+    # Find the instances that are healthy in all target groups.
+    target_healthy = None
+    for target_group_arn in target_group_arns:
+        response = elb_client.describe_target_health(TargetGroupArn=target_group_arn)
+        healthy = {
+            description["Target"]["Id"]
+            for description in response["TargetHealthDescriptions"]
+            if description["TargetHealth"]["State"] == "healthy"
+        }
+        target_healthy = healthy if target_healthy is None else target_healthy & healthy
+
+    for instance in asg["Instances"]:
+        state = instance["LifecycleState"]
+        if state == "InService":
+            if instance["HealthStatus"] != "Healthy":
+                capacity["Unhealthy"] += 1
+            elif target_healthy is not None and (
+                instance["InstanceId"] not in target_healthy
+            ):
+                capacity["Unhealthy"] += 1
+            else:
+                capacity["Healthy"] += 1
+        elif state.startswith("Pending"):
+            capacity["Pending"] += 1
+        elif state.endswith("Standby"):
+            capacity["Standby"] += 1
+
+    return capacity
+
+
+def get_properties(event):
+    """
+    Returns the resource properties, with any JSON documents
+    decoded and merged into them.
+
+    """
+
+    properties = dict(event["ResourceProperties"])
+    for key in JSON_PROPERTIES:
+        if key in properties:
+            properties.update(json.loads(properties.pop(key)))
+    return properties
+
+
+def plan_rolling_update(
+    capacity, min_size, max_size, floor_percent, min_instances_in_service
+):
+    """
+    Returns the MinInstancesInService and MaxBatchSize values to use for
+    the fastest rolling update that keeps the specified percentage of
+    the desired capacity in service and healthy. A MinInstancesInService
+    value of zero or more is used as it is.
+
+    """
+
+    plan = {"Capacity": capacity, "FloorPercent": floor_percent}
+    desired = capacity["DesiredCapacity"]
+
+    # Instances in standby are part of the desired capacity, but they have
+    # been taken out of service on purpose, so they don't count towards the
+    # floor and they aren't replaced. They still take up room in the ASG.
+    serving = max(0, desired - capacity["Standby"])
+
+    if min_instances_in_service < 0:
+
+        # CloudFormation counts unhealthy instances as being in service,
+        # and pending instances too once they are launched, before they
+        # pass health checks. Keep extra instances in service to make up
+        # for them.
+        floor = math.ceil(serving * floor_percent / 100)
+        min_instances_in_service = floor + capacity["Unhealthy"] + capacity["Pending"]
+        plan["Floor"] = floor
+
+        # Unless it's below the minimum size of the ASG,
+        # in which case try to use that.
+        if min_instances_in_service < min_size:
+            min_instances_in_service = min_size
+            plan["Reason"] = "Raised to MinSize"
+
+        # The number can't be the maximum size of the ASG because
+        # it needs to be allowed to terminate instances (bringing
+        # the number of in-service instance down) to replace them.
+        if min_instances_in_service >= max_size:
+            if max_size > 1:
+                min_instances_in_service = max_size - 1
+            else:
+                min_instances_in_service = 0
+            plan["Reason"] = "Lowered below MaxSize"
+
+    # Replace as many instances at a time as the ASG has room for,
+    # but no more than the number of instances being replaced.
+    room = max_size - min_instances_in_service - capacity["Standby"]
+    max_batch_size = max(1, min(room, serving))
+
+    plan["MaxBatchSize"] = max_batch_size
+    plan["MinInstancesInService"] = min_instances_in_service
+    return plan
@@ -0,0 +1,150 @@
+# Create a CloudFormation custom resource Lambda function
+# to replace instances using an instance refresh, when
+# update_mode is "refresh".
+
+# Instance refreshes don't wait for per-instance signals from the cfn_signal
+# function, so the auto scaling group uses ELB health checks by default,
+# and new instances always have a warmup period, so that a refresh can't
+# replace every instance before any new ones are serving traffic.
+
+locals {
+  cfn_refresh_enabled               = var.enabled && var.update_mode == "refresh"
+  cfn_refresh_pending_requests_path = "/${var.name}/cfn-refresh-pending-requests"
+  cfn_refresh_schedule_rule_name    = "${var.name}-cfn-refresh-schedule"
+  health_check_type = coalesce(
+    var.health_check_type,
+    local.cfn_refresh_enabled && length(var.target_group_arns) > 0 ? "ELB" : "EC2"
+  )
+  instance_refresh_preferences = merge({
+    InstanceWarmup       = var.health_check_grace_period > 0 ? var.health_check_grace_period : 300
+    MaxHealthyPercentage = var.capacity_floor_percent < 100 ? 100 : 110
+    MinHealthyPercentage = var.capacity_floor_percent
+    SkipMatching         = true
+  }, var.instance_refresh_preferences)
+}
+
+module "cfn_refresh_lambda" {
+  source  = "raymondbutcher/lambda-builder/aws"
+  version = "1.1.0"
+
+  enabled = local.cfn_refresh_enabled
+
+  function_name = "${var.name}-cfn-refresh"
+  handler       = "lambda.lambda_handler"
+  runtime       = "python3.7"
+  memory_size   = 128
+  timeout       = 60 * 15
+
+  build_mode = "FILENAME"
+  source_dir = "${path.module}/cfn_refresh"
+  filename   = "${path.module}/cfn_refresh_lambda.zip"
+
+  role_cloudwatch_logs       = true
+  role_custom_policies       = local.cfn_refresh_enabled ? [data.aws_iam_policy_document.cfn_refresh_lambda[0].json] : []
+  role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL            = var.log_level
+      PENDING_REQUEST_PATH = local.cfn_refresh_pending_requests_path
+      SCHEDULE_RULE_NAME   = local.cfn_refresh_schedule_rule_name
+    }
+  }
+}
+
+data "aws_iam_policy_document" "cfn_refresh_lambda" {
+  count = local.cfn_refresh_enabled ? 1 : 0
+  statement {
+    effect    = "Allow"
+    actions   = ["autoscaling:DescribeInstanceRefreshes"]
+    resources = ["*"]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["autoscaling:CancelInstanceRefresh", "autoscaling:StartInstanceRefresh"]
+    resources = ["arn:${data.aws_partition.current.partition}:autoscaling:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:autoScalingGroup:*:autoScalingGroupName/${var.name}"]
+  }
+
+  statement {
+    effect  = "Allow"
+    actions = ["ssm:DeleteParameter", "ssm:GetParametersByPath", "ssm:PutParameter"]
+    resources = [
+      "arn:${data.aws_partition.current.partition}:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter${local.cfn_refresh_pending_requests_path}",
+      "arn:${data.aws_partition.current.partition}:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter${local.cfn_refresh_pending_requests_path}/*",
+    ]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["events:DisableRule", "events:EnableRule"]
+    resources = [aws_cloudwatch_event_rule.cfn_refresh_schedule[0].arn]
+  }
+}
+
+# The function saves each CloudFormation request in an SSM parameter under
+# the pending requests path after starting an instance refresh, and is
+# invoked again when the instance refresh reaches a checkpoint or finishes.
+# It is also invoked on a schedule in case any events are missed. The
+# function enables the schedule while there are pending requests, and
+# disables it afterwards.
+
+resource "aws_cloudwatch_event_rule" "cfn_refresh_progress" {
+  count = local.cfn_refresh_enabled ? 1 : 0
+  name  = "${module.cfn_refresh_lambda.function_name}-progress"
+  event_pattern = jsonencode({
+    source = ["aws.autoscaling"]
+    detail-type = [
+      "EC2 Auto Scaling Instance Refresh Cancelled",
+      "EC2 Auto Scaling Instance Refresh Checkpoint Reached",
+      "EC2 Auto Scaling Instance Refresh Failed",
+      "EC2 Auto Scaling Instance Refresh Succeeded",
+    ]
+    detail = {
+      AutoScalingGroupName = [var.name]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_rule" "cfn_refresh_schedule" {
+  count               = local.cfn_refresh_enabled ? 1 : 0
+  name                = local.cfn_refresh_schedule_rule_name
+  schedule_expression = "rate(1 minute)"
+  is_enabled          = false
+
+  lifecycle {
+    ignore_changes = [is_enabled]
+  }
+}
+
+resource "aws_cloudwatch_event_target" "cfn_refresh_progress" {
+  count     = local.cfn_refresh_enabled ? 1 : 0
+  target_id = "lambda"
+  rule      = aws_cloudwatch_event_rule.cfn_refresh_progress[0].name
+  arn       = module.cfn_refresh_lambda.arn
+}
+
+resource "aws_cloudwatch_event_target" "cfn_refresh_schedule" {
+  count     = local.cfn_refresh_enabled ? 1 : 0
+  target_id = "lambda"
+  rule      = aws_cloudwatch_event_rule.cfn_refresh_schedule[0].name
+  arn       = module.cfn_refresh_lambda.arn
+}
+
+resource "aws_lambda_permission" "cfn_refresh_progress" {
+  count         = local.cfn_refresh_enabled ? 1 : 0
+  statement_id  = "cloudwatch-event-rule-progress"
+  action        = "lambda:InvokeFunction"
+  function_name = module.cfn_refresh_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cfn_refresh_progress[0].arn
+}
+
+resource "aws_lambda_permission" "cfn_refresh_schedule" {
+  count         = local.cfn_refresh_enabled ? 1 : 0
+  statement_id  = "cloudwatch-event-rule-schedule"
+  action        = "lambda:InvokeFunction"
+  function_name = module.cfn_refresh_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cfn_refresh_schedule[0].arn
+}
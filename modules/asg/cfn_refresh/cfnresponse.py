@@ -0,0 +1,134 @@
+#  Copyright 2016 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#  This file is licensed to you under the AWS Customer Agreement (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at http://aws.amazon.com/agreement/ .
+#  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
+#  See the License for the specific language governing permissions and limitations under the License.
+#
+# Updated by Claranet:
+#   - Use built-in urllib instead of requests to avoid external dependency
+#   - Reuse connections, with timeouts and retries with jittered backoff
+#   - Log with the shared structured logger
+#
+
+import http.client
+import json
+import random
+import time
+import urllib.parse
+
+from logger import logger
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+# CloudFormation waits up to an hour for a response, so a slow or failed
+# request must not be the end of it. Each attempt has a timeout, and failed
+# attempts are retried after a random delay that grows with each attempt.
+ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+TIMEOUT = 10
+
+# Connections are kept open and reused for later responses to the same
+# host, including those sent by later invocations of a warm function.
+connections = {}
+
+
+def send(
+    event,
+    context,
+    responseStatus,
+    responseData,
+    physicalResourceId=None,
+    noEcho=False,
+    reason=None,
+):
+    responseUrl = event["ResponseURL"]
+
+    responseBody = {}
+    responseBody["Status"] = responseStatus
+    responseBody["Reason"] = (
+        "See the details in CloudWatch Log Stream: " + context.log_stream_name
+    )
+    if reason:
+        responseBody["Reason"] = reason + ". " + responseBody["Reason"]
+    responseBody["PhysicalResourceId"] = physicalResourceId or context.log_stream_name
+    responseBody["StackId"] = event["StackId"]
+    responseBody["RequestId"] = event["RequestId"]
+    responseBody["LogicalResourceId"] = event["LogicalResourceId"]
+    responseBody["NoEcho"] = noEcho
+    responseBody["Data"] = responseData
+
+    json_responseBody = json.dumps(responseBody)
+
+    logger.info(
+        "Sending response",
+        LogicalResourceId=event["LogicalResourceId"],
+        Status=responseStatus,
+    )
+    if not noEcho:
+        logger.debug("Response body", Body=responseBody)
+
+    put(responseUrl, json_responseBody.encode())
+
+
+def get_connection(host):
+    """
+    Returns an open connection to the host, and whether it has been used
+    before, in which case the server might have closed it since then.
+
+    """
+
+    connection = connections.get(host)
+    if connection:
+        return (connection, True)
+    connection = http.client.HTTPSConnection(host, timeout=TIMEOUT)
+    connections[host] = connection
+    return (connection, False)
+
+
+def put(url, body):
+    """
+    Sends the response body to the pre-signed S3 URL, retrying failed
+    requests and server errors.
+
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    headers = {"content-type": "", "content-length": str(len(body))}
+
+    for attempt in range(1, ATTEMPTS + 1):
+        start = time.perf_counter()
+        connection, reused = get_connection(parts.netloc)
+        retry_now = False
+        try:
+            connection.request("PUT", path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError) as error:
+            connections.pop(parts.netloc, None)
+            connection.close()
+            result = f"{type(error).__name__}: {error}"
+            retry = True
+            # A reused connection might have been closed by the server
+            # while it was idle, so retry straight away with a new one.
+            retry_now = reused
+        else:
+            result = f"{response.status} {response.reason}"
+            retry = response.status >= 500
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.log(
+            "WARNING" if retry else "INFO",
+            "Response attempt",
+            {"Attempt": attempt, "Duration": round(elapsed), "Result": result},
+        )
+
+        if not retry:
+            return
+        if attempt < ATTEMPTS and not retry_now:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+
+    raise Exception(f"Failed to send response after {ATTEMPTS} attempts")
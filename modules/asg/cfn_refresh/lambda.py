@@ -0,0 +1,292 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+import cfnresponse
+from clients import LazyClient
+from logger import logger
+
+autoscaling_client = LazyClient("autoscaling")
+events_client = LazyClient("events")
+ssm_client = LazyClient("ssm")
+
+PENDING_REQUEST_PATH = os.environ["PENDING_REQUEST_PATH"]
+SCHEDULE_RULE_NAME = os.environ["SCHEDULE_RULE_NAME"]
+
+# Preferences are passed to the function as strings by CloudFormation,
+# so they are converted to the types expected by StartInstanceRefresh.
+BOOLEAN_PREFERENCES = ("AutoRollback", "SkipMatching")
+INTEGER_PREFERENCES = (
+    "CheckpointDelay",
+    "InstanceWarmup",
+    "MaxHealthyPercentage",
+    "MinHealthyPercentage",
+)
+LIST_PREFERENCES = ("CheckpointPercentages",)
+
+# Instance refresh statuses that mean the refresh has finished.
+FAILED_STATUSES = ("Cancelled", "Failed", "RollbackFailed", "RollbackSuccessful")
+SUCCESSFUL_STATUSES = ("Successful",)
+
+# An instance refresh that is already running, perhaps because a previous
+# stack update was cancelled, is cancelled before starting a new one.
+# Cancelling takes a little while, so starting is retried until then.
+START_RETRY_DELAY = 5
+START_RETRY_LIMIT = 60
+
+
+def lambda_handler(event, context):
+    """
+    Replaces the instances in an auto scaling group using an instance
+    refresh, as an alternative to CloudFormation rolling updates.
+
+    When the stack is updated, this function starts an instance refresh
+    and saves the CloudFormation request without responding. It is then
+    invoked by EventBridge when the instance refresh reaches a checkpoint
+    or finishes, and on a schedule as a fallback, and it responds to
+    CloudFormation once the instance refresh has finished. Requests are
+    saved separately, so overlapping requests are all responded to, and
+    the schedule is only enabled while there are requests to respond to.
+
+    The instance refresh replaces instances in percentage-based batches,
+    and skips instances that already match the launch template, so there
+    are no per-instance signals for CloudFormation to wait for.
+
+    """
+
+    logger.reset(context)
+    metrics.reset(context)
+    try:
+        if "RequestType" in event:
+            handle_cloudformation_request(event, context)
+        else:
+            handle_refresh_event(event, context)
+    finally:
+        logger.flush()
+        metrics.emit()
+
+
+def handle_cloudformation_request(event, context):
+    """
+    Handles a CloudFormation custom resource request.
+
+    """
+
+    status = cfnresponse.FAILED
+    properties = event["ResourceProperties"]
+    asg_name = properties["AutoScalingGroupName"]
+    physical_resource_id = asg_name
+    respond = True
+
+    try:
+
+        # New auto scaling groups already have the latest launch template,
+        # and there is nothing to do when deleting, so only updates need
+        # to refresh instances.
+        if event["RequestType"] == "Update":
+            with metrics.timer("RefreshStart"):
+                refresh_id = start_instance_refresh(
+                    asg_name, get_preferences(properties.get("Preferences", {}))
+                )
+            save_pending_request(event, asg_name, physical_resource_id, refresh_id)
+            set_schedule_enabled(True)
+            respond = False
+
+        status = cfnresponse.SUCCESS
+
+    finally:
+        if respond:
+            with metrics.timer("Respond"):
+                cfnresponse.send(event, context, status, {}, physical_resource_id)
+
+
+def handle_refresh_event(event, context):
+    """
+    Handles an instance refresh event or a scheduled event,
+    responding to the pending CloudFormation requests whose
+    instance refreshes have finished. The schedule is disabled
+    once there are no pending requests left.
+
+    """
+
+    pending_requests = get_pending_requests()
+    scheduled = event.get("detail-type") == "Scheduled Event"
+    responded = False
+    remaining = 0
+    for name, pending_request in pending_requests.items():
+        if respond_if_finished(pending_request, context):
+            clear_pending_request(name)
+            responded = True
+        else:
+            remaining += 1
+
+    # Disable the schedule when the last request has been responded to,
+    # or when the schedule runs with nothing to do. Check again after
+    # disabling it, in case a request was saved in the meantime.
+    if not remaining and (responded or scheduled):
+        set_schedule_enabled(False)
+        if get_pending_requests():
+            set_schedule_enabled(True)
+
+
+def clear_pending_request(name):
+    """
+    Deletes a saved CloudFormation request.
+
+    """
+
+    ssm_client.delete_parameter(Name=name)
+
+
+def get_pending_requests():
+    """
+    Returns the saved CloudFormation requests, keyed by their parameter names.
+
+    """
+
+    pending_requests = {}
+    paginator = ssm_client.get_paginator("get_parameters_by_path")
+    for page in paginator.paginate(Path=PENDING_REQUEST_PATH):
+        for param in page["Parameters"]:
+            pending_requests[param["Name"]] = json.loads(param["Value"])
+    return pending_requests
+
+
+def get_preferences(properties):
+    """
+    Returns instance refresh preferences from the resource properties.
+
+    """
+
+    preferences = {}
+    for key, value in properties.items():
+        if key in BOOLEAN_PREFERENCES:
+            preferences[key] = str(value).lower() == "true"
+        elif key in INTEGER_PREFERENCES:
+            preferences[key] = int(value)
+        elif key in LIST_PREFERENCES:
+            preferences[key] = [int(item) for item in str(value).split(",") if item]
+        else:
+            preferences[key] = value
+    return preferences
+
+
+def respond_if_finished(pending_request, context):
+    """
+    Responds to a saved CloudFormation request if its instance refresh
+    has finished, and returns whether it did.
+
+    """
+
+    refresh_id = pending_request["InstanceRefreshId"]
+    response = autoscaling_client.describe_instance_refreshes(
+        AutoScalingGroupName=pending_request["AutoScalingGroupName"],
+        InstanceRefreshIds=[refresh_id],
+    )
+    refresh = response["InstanceRefreshes"][0]
+    refresh_status = refresh["Status"]
+    logger.info(
+        "Instance refresh status",
+        InstanceRefreshId=refresh_id,
+        InstancesToUpdate=refresh.get("InstancesToUpdate", 0),
+        PercentageComplete=refresh.get("PercentageComplete", 0),
+        Status=refresh_status,
+    )
+    if refresh_status in SUCCESSFUL_STATUSES:
+        status = cfnresponse.SUCCESS
+        reason = None
+    elif refresh_status in FAILED_STATUSES:
+        status = cfnresponse.FAILED
+        reason = f"Instance refresh {refresh_status}: {refresh.get('StatusReason', '')}"
+    else:
+        return False
+
+    with metrics.timer("Respond"):
+        cfnresponse.send(
+            pending_request["Event"],
+            context,
+            status,
+            {},
+            pending_request["PhysicalResourceId"],
+            reason=reason,
+        )
+    return True
+
+
+def save_pending_request(event, asg_name, physical_resource_id, refresh_id):
+    """
+    Saves the CloudFormation request details needed to respond later.
+
+    """
+
+    pending_request = {
+        "AutoScalingGroupName": asg_name,
+        "Event": {
+            key: event[key]
+            for key in ("LogicalResourceId", "RequestId", "ResponseURL", "StackId")
+        },
+        "InstanceRefreshId": refresh_id,
+        "PhysicalResourceId": physical_resource_id,
+    }
+    ssm_client.put_parameter(
+        Name=f"{PENDING_REQUEST_PATH}/{event['RequestId']}",
+        Value=json.dumps(pending_request),
+        Type="String",
+        Overwrite=True,
+    )
+    logger.info("Saved pending request", CloudFormationRequestId=event["RequestId"])
+
+
+def set_schedule_enabled(enabled):
+    """
+    Enables or disables the schedule that invokes this function,
+    so it only runs every minute while there are pending requests.
+
+    """
+
+    if enabled:
+        events_client.enable_rule(Name=SCHEDULE_RULE_NAME)
+    else:
+        events_client.disable_rule(Name=SCHEDULE_RULE_NAME)
+    logger.info("Schedule", Enabled=enabled)
+
+
+def start_instance_refresh(asg_name, preferences):
+    """
+    Starts an instance refresh, cancelling any that is already running,
+    and returns its ID.
+
+    """
+
+    logger.info("Starting instance refresh", Preferences=preferences)
+    for attempt in range(START_RETRY_LIMIT):
+        try:
+            response = autoscaling_client.start_instance_refresh(
+                AutoScalingGroupName=asg_name,
+                Preferences=preferences,
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "InstanceRefreshInProgress":
+                raise
+            if attempt == 0:
+                logger.info("Cancelling the instance refresh already in progress")
+                try:
+                    autoscaling_client.cancel_instance_refresh(
+                        AutoScalingGroupName=asg_name
+                    )
+                except ClientError as cancel_error:
+                    code = cancel_error.response["Error"]["Code"]
+                    if code != "ActiveInstanceRefreshNotFound":
+                        raise
+            time.sleep(START_RETRY_DELAY)
+        else:
+            refresh_id = response["InstanceRefreshId"]
+            logger.info("Started instance refresh", InstanceRefreshId=refresh_id)
+            return refresh_id
+    raise Exception("Timed out waiting for the previous instance refresh to cancel")
@@ -1,11 +1,17 @@
 # Create a Lambda function to tell CloudFormation when an auto
 # scaling group instance is healthy according to its target groups.
+# This is only used by rolling updates, not instance refreshes.
+
+locals {
+  cfn_signal_enabled = var.enabled && var.update_mode == "rolling"
+  cfn_signal_batches = local.cfn_signal_enabled && var.cfn_signal_mode == "batch"
+}
 
 module "cfn_signal_lambda" {
   source  = "raymondbutcher/lambda-builder/aws"
   version = "1.1.0"
 
-  enabled = var.enabled
+  enabled = local.cfn_signal_enabled
 
   function_name = "${var.name}-cfn-signal"
   handler       = "lambda.lambda_handler"
@@ -18,12 +24,14 @@ module "cfn_signal_lambda" {
   filename   = "${path.module}/cfn_signal_lambda.zip"
 
   role_cloudwatch_logs       = true
-  role_custom_policies       = var.enabled ? [data.aws_iam_policy_document.cfn_signal_lambda[0].json] : []
+  role_custom_policies       = local.cfn_signal_enabled ? [data.aws_iam_policy_document.cfn_signal_lambda[0].json] : []
   role_custom_policies_count = 1
 
   environment = {
     variables = {
+      LOG_LEVEL           = var.log_level
       LOGICAL_RESOURCE_ID = "AutoScalingGroup" # This must match the resource in the CFN template.
+      POLL_INTERVAL       = var.health_check_poll_interval
       STACK_NAME          = var.name
       TARGET_GROUP_ARNS   = jsonencode(var.target_group_arns)
     }
@@ -31,24 +39,62 @@ module "cfn_signal_lambda" {
 }
 
 data "aws_iam_policy_document" "cfn_signal_lambda" {
-  count = var.enabled ? 1 : 0
+  count = local.cfn_signal_enabled ? 1 : 0
   statement {
     effect    = "Allow"
     actions   = ["elasticloadbalancing:DescribeTargetGroups", "elasticloadbalancing:DescribeTargetHealth"]
     resources = ["*"]
   }
 
+  # Instances that target groups say are invalid are checked,
+  # so that terminated instances are not waited for.
+  statement {
+    effect    = "Allow"
+    actions   = ["autoscaling:DescribeAutoScalingInstances"]
+    resources = ["*"]
+  }
+
   statement {
     effect    = "Allow"
     actions   = ["cloudformation:SignalResource"]
     resources = ["arn:${data.aws_partition.current.partition}:cloudformation:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:stack/${var.name}/*"]
   }
+
+  # Outdated instances from the warm pool are replaced.
+  dynamic "statement" {
+    for_each = toset(range(var.warm_pool != null ? 1 : 0))
+    content {
+      effect    = "Allow"
+      actions   = ["autoscaling:DescribeAutoScalingGroups"]
+      resources = ["*"]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = toset(range(var.warm_pool != null ? 1 : 0))
+    content {
+      effect    = "Allow"
+      actions   = ["autoscaling:TerminateInstanceInAutoScalingGroup"]
+      resources = ["arn:${data.aws_partition.current.partition}:autoscaling:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:autoScalingGroup:*:autoScalingGroupName/${var.name}"]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = toset(range(local.cfn_signal_batches ? 1 : 0))
+    content {
+      effect    = "Allow"
+      actions   = ["sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ReceiveMessage"]
+      resources = [aws_sqs_queue.cfn_signal[0].arn]
+    }
+  }
 }
 
 # Invoke the function for each instance launched by the auto scaling group.
+# In batch mode, launch events are sent to an SQS queue instead, so that
+# one invocation can check and signal all instances launched together.
 
 resource "aws_cloudwatch_event_rule" "cfn_signal" {
-  count = var.enabled ? 1 : 0
+  count = local.cfn_signal_enabled ? 1 : 0
   name  = module.cfn_signal_lambda.function_name
   event_pattern = jsonencode({
     source      = ["aws.autoscaling"]
@@ -60,17 +106,67 @@ resource "aws_cloudwatch_event_rule" "cfn_signal" {
 }
 
 resource "aws_cloudwatch_event_target" "cfn_signal" {
-  count     = var.enabled ? 1 : 0
-  target_id = "lambda"
+  count     = local.cfn_signal_enabled ? 1 : 0
+  target_id = local.cfn_signal_batches ? "sqs" : "lambda"
   rule      = aws_cloudwatch_event_rule.cfn_signal[0].name
-  arn       = module.cfn_signal_lambda.arn
+  arn       = local.cfn_signal_batches ? aws_sqs_queue.cfn_signal[0].arn : module.cfn_signal_lambda.arn
 }
 
 resource "aws_lambda_permission" "cfn_signal" {
-  count         = var.enabled ? 1 : 0
+  count         = local.cfn_signal_enabled && ! local.cfn_signal_batches ? 1 : 0
   statement_id  = "cloudwatch-event-rule"
   action        = "lambda:InvokeFunction"
   function_name = module.cfn_signal_lambda.function_name
   principal     = "events.amazonaws.com"
   source_arn    = aws_cloudwatch_event_rule.cfn_signal[0].arn
 }
+
+# Launch events are retried a few times if the function fails or times out,
+# and are then moved to a dead-letter queue instead of being retried forever.
+resource "aws_sqs_queue" "cfn_signal" {
+  count                      = local.cfn_signal_batches ? 1 : 0
+  name                       = module.cfn_signal_lambda.function_name
+  visibility_timeout_seconds = 60 * 15 # This must not be less than the function timeout.
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.cfn_signal_dlq[0].arn
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_sqs_queue" "cfn_signal_dlq" {
+  count                     = local.cfn_signal_batches ? 1 : 0
+  name                      = "${module.cfn_signal_lambda.function_name}-dlq"
+  message_retention_seconds = 60 * 60 * 24 * 14
+}
+
+data "aws_iam_policy_document" "cfn_signal_queue" {
+  count = local.cfn_signal_batches ? 1 : 0
+  statement {
+    effect    = "Allow"
+    actions   = ["sqs:SendMessage"]
+    resources = [aws_sqs_queue.cfn_signal[0].arn]
+    principals {
+      type        = "Service"
+      identifiers = ["events.amazonaws.com"]
+    }
+    condition {
+      test     = "ArnEquals"
+      variable = "aws:SourceArn"
+      values   = [aws_cloudwatch_event_rule.cfn_signal[0].arn]
+    }
+  }
+}
+
+resource "aws_sqs_queue_policy" "cfn_signal" {
+  count     = local.cfn_signal_batches ? 1 : 0
+  queue_url = aws_sqs_queue.cfn_signal[0].id
+  policy    = data.aws_iam_policy_document.cfn_signal_queue[0].json
+}
+
+resource "aws_lambda_event_source_mapping" "cfn_signal" {
+  count                              = local.cfn_signal_batches ? 1 : 0
+  event_source_arn                   = aws_sqs_queue.cfn_signal[0].arn
+  function_name                      = module.cfn_signal_lambda.arn
+  batch_size                         = 100
+  maximum_batching_window_in_seconds = var.cfn_signal_batch_window
+}
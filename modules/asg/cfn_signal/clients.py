@@ -0,0 +1,48 @@
+# This file is shared by the Lambda functions in this project.
+# Identical copies exist in each Lambda function's source directory.
+
+# Imported before boto3, so that its InitDuration metric includes
+# the time spent importing boto3.
+from metrics import metrics  # isort: skip
+
+import threading
+
+import boto3
+
+lock = threading.RLock()
+sessions = []
+
+
+def create_client(service_name, **kwargs):
+    """
+    Creates a boto3 client. All clients are created from one shared session,
+    so service models are only loaded once. Credentials for other accounts
+    can be passed in as keyword arguments.
+
+    """
+
+    with lock:
+        if not sessions:
+            sessions.append(boto3.Session())
+        client = sessions[0].client(service_name, **kwargs)
+    return metrics.instrument(client)
+
+
+class LazyClient:
+    """
+    A boto3 client which is only created when it is first used,
+    so Lambda functions don't spend time creating clients they don't use.
+
+    """
+
+    def __init__(self, service_name, **kwargs):
+        self._client = None
+        self._kwargs = kwargs
+        self._service_name = service_name
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with lock:
+                if self._client is None:
+                    self._client = create_client(self._service_name, **self._kwargs)
+        return getattr(self._client, name)
@@ -1,52 +1,321 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
 
-import boto3
+from clients import LazyClient
+from logger import logger
 
 LOGICAL_RESOURCE_ID = os.environ["LOGICAL_RESOURCE_ID"]
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "30"))
 STACK_NAME = os.environ["STACK_NAME"]
 TARGET_GROUP_ARNS = json.loads(os.environ["TARGET_GROUP_ARNS"])
 
-cfn_client = boto3.client("cloudformation")
-elb_client = boto3.client("elbv2")
-target_in_service = elb_client.get_waiter("target_in_service")
+# Polling starts with a short delay which doubles up to the poll interval,
+# or up to the target group's health check interval if that is shorter.
+# Throttling errors make it back off further, up to the maximum delay.
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 60
+
+# Use client-side rate limiting to avoid contributing to API throttling
+# when many instances are being checked at the same time.
+boto_config = Config(retries={"mode": "adaptive", "max_attempts": 10})
+
+autoscaling_client = LazyClient("autoscaling", config=boto_config)
+cfn_client = LazyClient("cloudformation", config=boto_config)
+elb_client = LazyClient("elbv2", config=boto_config)
+
+# Target group details are cached for the lifetime of the Lambda container.
+target_groups_cache = []
+
+
+class HealthTracker:
+    """
+    Tracks which target groups each instance is healthy in,
+    and signals CloudFormation when an instance is healthy in all of them.
+
+    """
+
+    def __init__(self, instance_ids, target_groups):
+        self.lock = threading.Lock()
+        target_group_arns = [group["TargetGroupArn"] for group in target_groups]
+        self.pending = {
+            instance_id: set(target_group_arns) for instance_id in instance_ids
+        }
+
+    def healthy(self, instance_id, target_group_arn):
+        logger.info(
+            "Instance is healthy",
+            InstanceId=instance_id,
+            TargetGroupArn=target_group_arn,
+        )
+        with self.lock:
+            self.pending[instance_id].discard(target_group_arn)
+            ready = not self.pending[instance_id]
+        if ready:
+            signal_resource(instance_id)
 
 
 def lambda_handler(event, context):
-    # An instance has been launched.
-    # Get the details from the event.
-    instance_id = event["detail"]["EC2InstanceId"]
-    print(f"InstanceId={instance_id} Instance has launched")
+    logger.reset(context)
+    metrics.reset(context)
+    try:
+        handle_launch_events(event)
+    finally:
+        logger.flush()
+        metrics.emit()
 
-    # Fetch the target group details and loop over them.
-    if TARGET_GROUP_ARNS:
-        response = elb_client.describe_target_groups(TargetGroupArns=TARGET_GROUP_ARNS)
-        target_groups = response["TargetGroups"]
+
+def handle_launch_events(event):
+    # Instances have been launched. This function is either invoked directly
+    # by EventBridge with one launch event, or by SQS with a batch of them.
+    # Get the details from the event.
+    if "Records" in event:
+        events = [json.loads(record["body"]) for record in event["Records"]]
     else:
-        target_groups = []
-    for target_group in target_groups:
-        # Wait until the target group thinks the instance is healthy.
-        # Wait for so long that the Lambda function will time out before
-        # this ever does. If it times out, the function will be retried
-        # a few times and then give up. If this fails during a CloudFormation
-        # update then CloudFormation will roll back the update.
-        print(
-            f"InstanceId={instance_id} Waiting until instance is healthy in {target_group['TargetGroupArn']}"
+        events = [event]
+
+    # Instances launched into a warm pool are not in service yet,
+    # so they are ignored. They will be checked when they leave it.
+    events = [e for e in events if e["detail"].get("Destination") != "WarmPool"]
+    if not events:
+        logger.info("Instance has launched into the warm pool")
+        return
+
+    instance_ids = sorted(set(e["detail"]["EC2InstanceId"] for e in events))
+    for instance_id in instance_ids:
+        logger.info("Instance has launched", InstanceId=instance_id)
+
+    # Instances from a warm pool were initialized when they were launched
+    # into it, which might have been before the auto scaling group's launch
+    # template was last updated. Replace any of those, so that only instances
+    # with the current launch template version are signaled.
+    warmed_instance_ids = sorted(
+        set(
+            e["detail"]["EC2InstanceId"]
+            for e in events
+            if e["detail"].get("Origin") == "WarmPool"
         )
-        target_in_service.wait(
+    )
+    if warmed_instance_ids:
+        with metrics.timer("WarmPoolCheck"):
+            stale_instance_ids = get_stale_instance_ids(
+                events[0]["detail"]["AutoScalingGroupName"], warmed_instance_ids
+            )
+            for instance_id in stale_instance_ids:
+                replace_instance(instance_id)
+        instance_ids = [i for i in instance_ids if i not in stale_instance_ids]
+        if not instance_ids:
+            return
+
+    # Wait until the target groups think the instances are healthy,
+    # checking all of the target groups at the same time, and signal
+    # CloudFormation as soon as each instance is healthy in all of them.
+    # Wait for so long that the Lambda function will time out before
+    # this ever does. If it times out, the function will be retried
+    # a few times and then give up, moving batched launch events to a
+    # dead-letter queue. If this fails during a CloudFormation update
+    # then CloudFormation will roll back the update.
+    with metrics.timer("TargetGroupLookup"):
+        target_groups = get_target_groups()
+    if target_groups:
+        tracker = HealthTracker(instance_ids, target_groups)
+        with metrics.timer("HealthWait"), ThreadPoolExecutor(
+            max_workers=len(target_groups)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    wait_until_healthy, target_group, instance_ids, tracker
+                )
+                for target_group in target_groups
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for instance_id in instance_ids:
+            signal_resource(instance_id)
+
+
+def describe_target_health(target_group, instance_ids):
+    """
+    Returns the health descriptions of the instances in the target group,
+    and the IDs of any instances that it says are invalid. One invalid
+    instance makes the whole request fail, so then the instances are
+    checked one at a time, to still get the health of the others.
+
+    """
+
+    def describe(ids):
+        response = elb_client.describe_target_health(
             TargetGroupArn=target_group["TargetGroupArn"],
-            Targets=[{"Id": instance_id, "Port": target_group["Port"]}],
-            WaiterConfig={"Delay": 30, "MaxAttempts": 1000},
+            Targets=[
+                {"Id": instance_id, "Port": target_group["Port"]} for instance_id in ids
+            ],
         )
-        print(
-            f"InstanceId={instance_id} Instance is healthy in {target_group['TargetGroupArn']}"
+        return response["TargetHealthDescriptions"]
+
+    try:
+        return describe(instance_ids), []
+    except elb_client.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] != "InvalidInstance":
+            raise
+        if len(instance_ids) == 1:
+            return [], list(instance_ids)
+
+    descriptions = []
+    invalid_ids = []
+    for instance_id in instance_ids:
+        try:
+            descriptions.extend(describe([instance_id]))
+        except elb_client.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] != "InvalidInstance":
+                raise
+            invalid_ids.append(instance_id)
+    return descriptions, invalid_ids
+
+
+def get_stale_instance_ids(auto_scaling_group_name, instance_ids):
+    """
+    Returns the IDs of instances that were launched with a different
+    launch template version than the auto scaling group is using.
+
+    """
+
+    response = autoscaling_client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[auto_scaling_group_name],
+    )
+    asg = response["AutoScalingGroups"][0]
+    version = asg["LaunchTemplate"]["Version"]
+    stale = set()
+    for instance in asg["Instances"]:
+        if instance["InstanceId"] in instance_ids:
+            if instance["LaunchTemplate"]["Version"] != version:
+                stale.add(instance["InstanceId"])
+    return stale
+
+
+def get_terminated_instance_ids(instance_ids):
+    """
+    Returns the IDs of instances that are terminating or have terminated,
+    or are no longer in the auto scaling group.
+
+    """
+
+    response = autoscaling_client.describe_auto_scaling_instances(
+        InstanceIds=instance_ids
+    )
+    states = {
+        instance["InstanceId"]: instance["LifecycleState"]
+        for instance in response["AutoScalingInstances"]
+    }
+    return [
+        instance_id
+        for instance_id in instance_ids
+        if "Terminat" in states.get(instance_id, "Terminated")
+    ]
+
+
+def get_target_groups():
+    """
+    Returns the target group details, fetching them only once
+    per Lambda container.
+
+    """
+
+    if TARGET_GROUP_ARNS and not target_groups_cache:
+        response = elb_client.describe_target_groups(TargetGroupArns=TARGET_GROUP_ARNS)
+        target_groups_cache.extend(response["TargetGroups"])
+    return target_groups_cache
+
+
+def replace_instance(instance_id):
+    """
+    Terminates an instance without reducing the desired capacity,
+    so the auto scaling group launches a replacement.
+
+    """
+
+    logger.info("Replacing outdated instance from warm pool", InstanceId=instance_id)
+    autoscaling_client.terminate_instance_in_auto_scaling_group(
+        InstanceId=instance_id, ShouldDecrementDesiredCapacity=False
+    )
+
+
+def signal_resource(instance_id):
+    """
+    Tells CloudFormation that an instance is ready.
+
+    """
+
+    logger.info("Sending signal to CloudFormation", InstanceId=instance_id)
+    with metrics.timer("Signal"):
+        cfn_client.signal_resource(
+            StackName=STACK_NAME,
+            LogicalResourceId=LOGICAL_RESOURCE_ID,
+            UniqueId=instance_id,
+            Status="SUCCESS",
         )
 
-    # Tell CloudFormation that this instance is ready.
-    print(f"InstanceId={instance_id} Sending signal to CloudFormation")
-    cfn_client.signal_resource(
-        StackName=STACK_NAME,
-        LogicalResourceId=LOGICAL_RESOURCE_ID,
-        UniqueId=instance_id,
-        Status="SUCCESS",
+
+def wait_until_healthy(target_group, instance_ids, tracker):
+    """
+    Waits until the instances are healthy in the target group, checking
+    all of them with one request each time. The tracker is told about each
+    instance as soon as it is healthy.
+
+    """
+
+    target_group_arn = target_group["TargetGroupArn"]
+    logger.info(
+        "Waiting until instances are healthy",
+        InstanceIds=instance_ids,
+        TargetGroupArn=target_group_arn,
     )
+
+    max_delay = min(
+        POLL_INTERVAL, target_group.get("HealthCheckIntervalSeconds", POLL_INTERVAL)
+    )
+    delay = MIN_POLL_INTERVAL
+    pending = list(instance_ids)
+    while True:
+        try:
+            descriptions, invalid_ids = describe_target_health(target_group, pending)
+        except elb_client.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] != "Throttling":
+                raise
+            # Back off further when ELB is throttling requests.
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+            time.sleep(delay)
+            continue
+        for description in descriptions:
+            if description["TargetHealth"]["State"] == "healthy":
+                instance_id = description["Target"]["Id"]
+                if instance_id in pending:
+                    pending.remove(instance_id)
+                    tracker.healthy(instance_id, target_group_arn)
+
+        # InvalidInstance usually means that an instance is not ready
+        # to be registered with the target group yet, but terminated
+        # instances are invalid too, and will never be healthy, so they
+        # are not waited for.
+        if invalid_ids:
+            with metrics.timer("TerminatedCheck"):
+                terminated_ids = get_terminated_instance_ids(invalid_ids)
+            for instance_id in terminated_ids:
+                logger.warning(
+                    "Instance has terminated",
+                    InstanceId=instance_id,
+                    TargetGroupArn=target_group_arn,
+                )
+                pending.remove(instance_id)
+        if not pending:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
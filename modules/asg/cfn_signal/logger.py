@@ -0,0 +1,147 @@
+# This file is shared by the Lambda functions in this project.
+# Identical copies exist in each Lambda function's source directory.
+
+import json
+import os
+import sys
+import threading
+import time
+from traceback import TracebackException
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# Values are replaced if their key contains any of these words,
+# such as the artifact credentials in CodePipeline events and
+# the pre-signed response URLs in CloudFormation events.
+REDACT_KEYS = ("credentials", "password", "responseurl", "secret", "token")
+REDACTED = "REDACTED"
+
+# Large values, such as whole events and Packer manifests, are truncated.
+MAX_DEPTH = 8
+MAX_ITEMS = 50
+MAX_STRING_LENGTH = 2000
+
+# Records are buffered and written together, at the end of the invocation,
+# or sooner if the buffer gets large or has been waiting for a while,
+# so that long-running functions still log their progress.
+FLUSH_INTERVAL = 5
+FLUSH_SIZE = 64 * 1024
+
+
+class Logger:
+    """
+    Logs records as JSON lines, which CloudWatch Logs can filter and query
+    by field. Records below the LOG_LEVEL environment variable's level are
+    dropped.
+
+    """
+
+    def __init__(self):
+        self.level = LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.context = {}
+        self.flushed = time.monotonic()
+
+    def debug(self, message, **fields):
+        self.log("DEBUG", message, fields)
+
+    def error(self, message, exception=None, **fields):
+        if exception:
+            fields["Exception"] = "".join(
+                TracebackException.from_exception(exception).format()
+            )
+        self.log("ERROR", message, fields)
+
+    def flush(self):
+        """
+        Writes the buffered records to the log.
+
+        """
+
+        with self.lock:
+            lines = self.buffer
+            self.buffer = []
+            self.buffer_size = 0
+            self.flushed = time.monotonic()
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+    def info(self, message, **fields):
+        self.log("INFO", message, fields)
+
+    def log(self, level, message, fields):
+        """
+        Adds a record to the buffer, if its level is enabled.
+
+        """
+
+        if LEVELS[level] < self.level:
+            return
+        record = {
+            "Level": level,
+            "Message": message,
+            "Timestamp": round(time.time(), 3),
+        }
+        record.update(self.context)
+        for key, value in fields.items():
+            record[key] = sanitize(key, value, 0)
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.buffer.append(line)
+            self.buffer_size += len(line)
+            flush = (
+                level == "ERROR"
+                or self.buffer_size >= FLUSH_SIZE
+                or time.monotonic() - self.flushed >= FLUSH_INTERVAL
+            )
+        if flush:
+            self.flush()
+
+    def reset(self, context=None):
+        """
+        Starts logging for a new invocation. Records include its request ID.
+
+        """
+
+        self.flush()
+        self.context = {}
+        if context:
+            self.context["RequestId"] = context.aws_request_id
+
+    def warning(self, message, **fields):
+        self.log("WARNING", message, fields)
+
+
+def sanitize(key, value, depth):
+    """
+    Returns the value with secrets redacted and large values truncated.
+
+    """
+
+    if any(word in str(key).lower() for word in REDACT_KEYS):
+        return REDACTED
+    if isinstance(value, str):
+        if len(value) > MAX_STRING_LENGTH:
+            return value[:MAX_STRING_LENGTH] + f"... ({len(value)} characters)"
+        return value
+    if depth >= MAX_DEPTH:
+        return "..."
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {str(k): sanitize(k, v, depth + 1) for k, v in items[:MAX_ITEMS]}
+        if len(items) > MAX_ITEMS:
+            result["..."] = f"{len(items)} items"
+        return result
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [sanitize(key, item, depth + 1) for item in items[:MAX_ITEMS]]
+        if len(items) > MAX_ITEMS:
+            result.append(f"... ({len(items)} items)")
+        return result
+    return value
+
+
+logger = Logger()
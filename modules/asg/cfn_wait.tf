@@ -1,6 +1,12 @@
 # Create a CloudFormation custom resource Lambda function
 # to wait for instances in the Terminating:Wait state.
 
+locals {
+  cfn_wait_events                = var.enabled && var.cfn_wait_mode == "event"
+  cfn_wait_pending_requests_path = "/${var.name}/cfn-wait-pending-requests"
+  cfn_wait_schedule_rule_name    = "${var.name}-cfn-wait-schedule"
+}
+
 module "cfn_wait_lambda" {
   source  = "raymondbutcher/lambda-builder/aws"
   version = "1.1.0"
@@ -20,6 +26,15 @@ module "cfn_wait_lambda" {
   role_cloudwatch_logs       = true
   role_custom_policies       = var.enabled ? [data.aws_iam_policy_document.cfn_wait_lambda[0].json] : []
   role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL            = var.log_level
+      PENDING_REQUEST_PATH = local.cfn_wait_events ? local.cfn_wait_pending_requests_path : ""
+      SCHEDULE_RULE_NAME   = local.cfn_wait_events ? local.cfn_wait_schedule_rule_name : ""
+      WAIT_MODE            = var.cfn_wait_mode
+    }
+  }
 }
 
 data "aws_iam_policy_document" "cfn_wait_lambda" {
@@ -29,4 +44,86 @@ data "aws_iam_policy_document" "cfn_wait_lambda" {
     actions   = ["autoscaling:DescribeAutoScalingGroups"]
     resources = ["*"]
   }
+
+  dynamic "statement" {
+    for_each = toset(range(local.cfn_wait_events ? 1 : 0))
+    content {
+      effect  = "Allow"
+      actions = ["ssm:DeleteParameter", "ssm:GetParametersByPath", "ssm:PutParameter"]
+      resources = [
+        "arn:${data.aws_partition.current.partition}:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter${local.cfn_wait_pending_requests_path}",
+        "arn:${data.aws_partition.current.partition}:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter${local.cfn_wait_pending_requests_path}/*",
+      ]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = toset(range(local.cfn_wait_events ? 1 : 0))
+    content {
+      effect    = "Allow"
+      actions   = ["events:DisableRule", "events:EnableRule"]
+      resources = [aws_cloudwatch_event_rule.cfn_wait_schedule[0].arn]
+    }
+  }
+}
+
+# In event mode, the function saves each CloudFormation request in an SSM
+# parameter under the pending requests path instead of waiting, and is
+# invoked again when instances finish terminating. It is also invoked on
+# a schedule in case any events are missed. The function enables the
+# schedule while there are pending requests, and disables it afterwards.
+
+resource "aws_cloudwatch_event_rule" "cfn_wait_terminate" {
+  count = local.cfn_wait_events ? 1 : 0
+  name  = "${module.cfn_wait_lambda.function_name}-terminate"
+  event_pattern = jsonencode({
+    source      = ["aws.autoscaling"]
+    detail-type = ["EC2 Instance Terminate Successful", "EC2 Instance Terminate Unsuccessful"]
+    detail = {
+      AutoScalingGroupName = [var.name]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_rule" "cfn_wait_schedule" {
+  count               = local.cfn_wait_events ? 1 : 0
+  name                = local.cfn_wait_schedule_rule_name
+  schedule_expression = "rate(1 minute)"
+  is_enabled          = false
+
+  lifecycle {
+    ignore_changes = [is_enabled]
+  }
+}
+
+resource "aws_cloudwatch_event_target" "cfn_wait_terminate" {
+  count     = local.cfn_wait_events ? 1 : 0
+  target_id = "lambda"
+  rule      = aws_cloudwatch_event_rule.cfn_wait_terminate[0].name
+  arn       = module.cfn_wait_lambda.arn
+}
+
+resource "aws_cloudwatch_event_target" "cfn_wait_schedule" {
+  count     = local.cfn_wait_events ? 1 : 0
+  target_id = "lambda"
+  rule      = aws_cloudwatch_event_rule.cfn_wait_schedule[0].name
+  arn       = module.cfn_wait_lambda.arn
+}
+
+resource "aws_lambda_permission" "cfn_wait_terminate" {
+  count         = local.cfn_wait_events ? 1 : 0
+  statement_id  = "cloudwatch-event-rule-terminate"
+  action        = "lambda:InvokeFunction"
+  function_name = module.cfn_wait_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cfn_wait_terminate[0].arn
+}
+
+resource "aws_lambda_permission" "cfn_wait_schedule" {
+  count         = local.cfn_wait_events ? 1 : 0
+  statement_id  = "cloudwatch-event-rule-schedule"
+  action        = "lambda:InvokeFunction"
+  function_name = module.cfn_wait_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.cfn_wait_schedule[0].arn
 }
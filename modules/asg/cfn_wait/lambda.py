@@ -1,10 +1,27 @@
-import time
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
 
-import boto3
+import json
+import os
+import time
 
 import cfnresponse
+from clients import LazyClient
+from logger import logger
+
+autoscaling_client = LazyClient("autoscaling")
+events_client = LazyClient("events")
+ssm_client = LazyClient("ssm")
+
+PENDING_REQUEST_PATH = os.environ.get("PENDING_REQUEST_PATH", "")
+SCHEDULE_RULE_NAME = os.environ.get("SCHEDULE_RULE_NAME", "")
+WAIT_MODE = os.environ.get("WAIT_MODE", "poll")
 
-autoscaling_client = boto3.client("autoscaling")
+# Polling starts with a short delay which doubles while nothing changes,
+# and goes back to the short delay whenever an instance finishes.
+MIN_POLL_DELAY = 2
+MAX_POLL_DELAY = 30
 
 
 def lambda_handler(event, context):
@@ -20,42 +37,215 @@ def lambda_handler(event, context):
     auto scaling group isn't really stable until those tasks have been moved,
     so the CloudFormation stack uses this function to wait during stack updates.
 
-    This function will wait as long as it finds instances in the
-    Terminating:Wait state. The function may even time out while waiting.
+    In "poll" mode, this function will wait as long as it finds instances in
+    the Terminating:Wait state. The function may even time out while waiting.
     If that happens, the function will be retried a few times and then it
     will give up. If that happens then CloudFormation will roll back the
     stack update.
 
+    In "event" mode, this function saves the CloudFormation request and
+    returns straight away if it has to wait. It is then invoked again by
+    EventBridge when instances finish terminating, and on a schedule as a
+    fallback, and it responds to CloudFormation once no instances remain
+    in the Terminating:Wait state. Requests are saved separately, so
+    overlapping requests are all responded to, and the schedule is only
+    enabled while there are requests to respond to.
+
+    """
+
+    logger.reset(context)
+    metrics.reset(context)
+    try:
+        if "RequestType" in event:
+            handle_cloudformation_request(event, context)
+        else:
+            handle_scheduled_event(event, context)
+    finally:
+        logger.flush()
+        metrics.emit()
+
+
+def handle_cloudformation_request(event, context):
+    """
+    Handles a CloudFormation custom resource request.
+
     """
 
     status = cfnresponse.FAILED
     physical_resource_id = None
     response_data = {}
+    respond = True
 
     try:
 
-        asg_arn = ""
         asg_name = event["ResourceProperties"]["AutoScalingGroupName"]
 
-        while True:
-            wait = False
-            response = autoscaling_client.describe_auto_scaling_groups(
-                AutoScalingGroupNames=[asg_name],
-            )
-            for asg in response["AutoScalingGroups"]:
-                asg_arn = asg["AutoScalingGroupARN"]
-                for instance in asg["Instances"]:
-                    if instance["LifecycleState"] == "Terminating:Wait":
-                        wait = True
-                        instance_id = instance["InstanceId"]
-                        print(f"Waiting for {instance_id} terminate lifecycle action")
-            if wait:
-                time.sleep(30)
-            else:
-                break
+        if WAIT_MODE == "event":
+            asg_arn, waiting = get_waiting_instances(asg_name)
+            if waiting:
+                # Respond later, when invoked by an EventBridge rule.
+                save_pending_request(event, context, asg_name)
+                set_schedule_enabled(True)
+                respond = False
+        else:
+            with metrics.timer("DrainWait"):
+                asg_arn = poll_waiting_instances(asg_name)
 
         response_data["AutoScalingGroupARN"] = asg_arn
         status = cfnresponse.SUCCESS
 
     finally:
-        cfnresponse.send(event, context, status, response_data, physical_resource_id)
+        if respond:
+            with metrics.timer("Respond"):
+                cfnresponse.send(
+                    event, context, status, response_data, physical_resource_id
+                )
+
+
+def handle_scheduled_event(event, context):
+    """
+    Handles an instance termination event or a scheduled event,
+    responding to the pending CloudFormation requests if there are
+    no longer any instances to wait for. The schedule is disabled
+    once there are no pending requests left.
+
+    """
+
+    pending_requests = get_pending_requests()
+    scheduled = event.get("detail-type") == "Scheduled Event"
+    responded = False
+    remaining = 0
+    waiting_by_asg = {}
+    for name, pending_request in pending_requests.items():
+        asg_name = pending_request["AutoScalingGroupName"]
+        if asg_name not in waiting_by_asg:
+            waiting_by_asg[asg_name] = get_waiting_instances(asg_name)
+        asg_arn, waiting = waiting_by_asg[asg_name]
+        if waiting:
+            remaining += 1
+            continue
+        with metrics.timer("Respond"):
+            cfnresponse.send(
+                pending_request["Event"],
+                context,
+                cfnresponse.SUCCESS,
+                {"AutoScalingGroupARN": asg_arn},
+                pending_request["PhysicalResourceId"],
+            )
+        clear_pending_request(name)
+        responded = True
+
+    # Disable the schedule when the last request has been responded to,
+    # or when the schedule runs with nothing to do. Check again after
+    # disabling it, in case a request was saved in the meantime.
+    if not remaining and (responded or scheduled):
+        set_schedule_enabled(False)
+        if get_pending_requests():
+            set_schedule_enabled(True)
+
+
+def clear_pending_request(name):
+    """
+    Deletes a saved CloudFormation request.
+
+    """
+
+    ssm_client.delete_parameter(Name=name)
+
+
+def get_pending_requests():
+    """
+    Returns the saved CloudFormation requests, keyed by their parameter names.
+
+    """
+
+    pending_requests = {}
+    paginator = ssm_client.get_paginator("get_parameters_by_path")
+    for page in paginator.paginate(Path=PENDING_REQUEST_PATH):
+        for param in page["Parameters"]:
+            pending_requests[param["Name"]] = json.loads(param["Value"])
+    return pending_requests
+
+
+def get_waiting_instances(asg_name):
+    """
+    Returns the ARN of the auto scaling group
+    and the IDs of its instances in the Terminating:Wait state.
+
+    """
+
+    asg_arn = ""
+    waiting = []
+    response = autoscaling_client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name],
+    )
+    for asg in response["AutoScalingGroups"]:
+        asg_arn = asg["AutoScalingGroupARN"]
+        for instance in asg["Instances"]:
+            if instance["LifecycleState"] == "Terminating:Wait":
+                instance_id = instance["InstanceId"]
+                logger.info(
+                    "Waiting for terminate lifecycle action", InstanceId=instance_id
+                )
+                waiting.append(instance_id)
+    return (asg_arn, waiting)
+
+
+def poll_waiting_instances(asg_name):
+    """
+    Waits until there are no instances in the Terminating:Wait state,
+    and then returns the ARN of the auto scaling group.
+
+    """
+
+    delay = MIN_POLL_DELAY
+    previous = None
+    while True:
+        asg_arn, waiting = get_waiting_instances(asg_name)
+        if not waiting:
+            return asg_arn
+        if previous is None or set(waiting) != previous:
+            delay = MIN_POLL_DELAY
+        else:
+            delay = min(delay * 2, MAX_POLL_DELAY)
+        previous = set(waiting)
+        time.sleep(delay)
+
+
+def save_pending_request(event, context, asg_name):
+    """
+    Saves the CloudFormation request details needed to respond later.
+
+    """
+
+    pending_request = {
+        "AutoScalingGroupName": asg_name,
+        "Event": {
+            key: event[key]
+            for key in ("LogicalResourceId", "RequestId", "ResponseURL", "StackId")
+        },
+        # Keep the physical resource id that would have been used
+        # by responding now, so CloudFormation doesn't see it change.
+        "PhysicalResourceId": context.log_stream_name,
+    }
+    ssm_client.put_parameter(
+        Name=f"{PENDING_REQUEST_PATH}/{event['RequestId']}",
+        Value=json.dumps(pending_request),
+        Type="String",
+        Overwrite=True,
+    )
+    logger.info("Saved pending request", CloudFormationRequestId=event["RequestId"])
+
+
+def set_schedule_enabled(enabled):
+    """
+    Enables or disables the schedule that invokes this function,
+    so it only runs every minute while there are pending requests.
+
+    """
+
+    if enabled:
+        events_client.enable_rule(Name=SCHEDULE_RULE_NAME)
+    else:
+        events_client.disable_rule(Name=SCHEDULE_RULE_NAME)
+    logger.info("Schedule", Enabled=enabled)
@@ -38,20 +38,20 @@ output "pipeline_target" {
     name = var.pipeline_target_name
     ssm_params = {
       app_version_id = {
-        arn  = var.app_pipeline ? aws_ssm_parameter.app_version_id[0].arn : null
-        name = var.app_pipeline ? aws_ssm_parameter.app_version_id[0].name : null
+        arn  = var.app_pipeline ? local.ssm_params.app_version_id.arn : null
+        name = var.app_pipeline ? local.ssm_params.app_version_id.name : null
       }
       app_version_name = {
-        arn  = var.app_pipeline ? aws_ssm_parameter.app_version_name[0].arn : null
-        name = var.app_pipeline ? aws_ssm_parameter.app_version_name[0].name : null
+        arn  = var.app_pipeline ? local.ssm_params.app_version_name.arn : null
+        name = var.app_pipeline ? local.ssm_params.app_version_name.name : null
       }
       image_id = {
-        arn  = var.ami_pipeline ? aws_ssm_parameter.image_id[0].arn : null
-        name = var.ami_pipeline ? aws_ssm_parameter.image_id[0].name : null
+        arn  = var.ami_pipeline ? local.ssm_params.image_id.arn : null
+        name = var.ami_pipeline ? local.ssm_params.image_id.name : null
       }
       image_name = {
-        arn  = var.ami_pipeline ? aws_ssm_parameter.image_name[0].arn : null
-        name = var.ami_pipeline ? aws_ssm_parameter.image_name[0].name : null
+        arn  = var.ami_pipeline ? local.ssm_params.image_name.arn : null
+        name = var.ami_pipeline ? local.ssm_params.image_name.name : null
       }
     }
   } : null
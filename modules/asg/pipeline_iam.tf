@@ -19,12 +19,31 @@ data "aws_iam_policy_document" "pipeline_assume_role" {
 data "aws_iam_policy_document" "pipeline" {
   count = var.ami_pipeline && var.enabled || var.app_pipeline && var.enabled ? 1 : 0
 
+  # Used to copy the AMI to this region and enable fast snapshot restore
+  # for it, when those are enabled in the pipeline.
+  dynamic "statement" {
+    for_each = toset(range(var.ami_pipeline ? 1 : 0))
+    content {
+      sid = "AMIDistribution"
+      actions = [
+        "autoscaling:DescribeAutoScalingGroups",
+        "ec2:CopyImage",
+        "ec2:DescribeFastSnapshotRestores",
+        "ec2:DescribeImages",
+        "ec2:EnableFastSnapshotRestores",
+      ]
+      resources = ["*"]
+    }
+  }
+
   dynamic "statement" {
     for_each = toset(range(var.app_pipeline ? 1 : 0))
     content {
       sid = "AppBucket"
       actions = [
+        "s3:AbortMultipartUpload",
         "s3:DeleteObjectVersion",
+        "s3:GetObjectVersion",
         "s3:ListBucket*",
         "s3:PutObject*",
       ]
@@ -65,14 +84,12 @@ data "aws_iam_policy_document" "pipeline" {
   }
 
   statement {
-    sid     = "ParameterStore"
-    actions = ["ssm:PutParameter"]
-    resources = concat(
-      aws_ssm_parameter.app_version_id[*].arn,
-      aws_ssm_parameter.app_version_name[*].arn,
-      aws_ssm_parameter.image_id[*].arn,
-      aws_ssm_parameter.image_name[*].arn,
-    )
+    sid = "ParameterStore"
+    actions = [
+      "ssm:GetParameters",
+      "ssm:PutParameter",
+    ]
+    resources = local.ssm_param_arns
   }
 }
 
@@ -1,5 +1,66 @@
+# These SSM parameters hold the AMI and app versions to deploy. They are
+# updated by the pipeline and used as inputs to the CloudFormation stack.
+# With var.ssm_json_parameters, each pipeline's values are stored together
+# in one JSON parameter instead, which the cfn_params function decodes.
+
+locals {
+  ssm_params = {
+    app_version_id = var.app_pipeline ? (
+      var.ssm_json_parameters ? aws_ssm_parameter.app_deployment[0] : aws_ssm_parameter.app_version_id[0]
+    ) : null
+    app_version_name = var.app_pipeline ? (
+      var.ssm_json_parameters ? aws_ssm_parameter.app_deployment[0] : aws_ssm_parameter.app_version_name[0]
+    ) : null
+    image_id = var.ami_pipeline ? (
+      var.ssm_json_parameters ? aws_ssm_parameter.ami_deployment[0] : aws_ssm_parameter.image_id[0]
+    ) : null
+    image_name = var.ami_pipeline ? (
+      var.ssm_json_parameters ? aws_ssm_parameter.ami_deployment[0] : aws_ssm_parameter.image_name[0]
+    ) : null
+  }
+  ssm_param_arns = concat(
+    aws_ssm_parameter.ami_deployment[*].arn,
+    aws_ssm_parameter.app_deployment[*].arn,
+    aws_ssm_parameter.app_version_id[*].arn,
+    aws_ssm_parameter.app_version_name[*].arn,
+    aws_ssm_parameter.image_id[*].arn,
+    aws_ssm_parameter.image_name[*].arn,
+  )
+}
+
+resource "aws_ssm_parameter" "ami_deployment" {
+  count = var.ami_pipeline && var.enabled && var.ssm_json_parameters ? 1 : 0
+
+  name = "/${var.name}/ami-deployment"
+  type = "String"
+  value = jsonencode({
+    ImageId   = "-"
+    ImageName = "-"
+  })
+
+  lifecycle {
+    ignore_changes = [value]
+  }
+}
+
+resource "aws_ssm_parameter" "app_deployment" {
+  count = var.app_pipeline && var.enabled && var.ssm_json_parameters ? 1 : 0
+
+  name = "/${var.name}/app-deployment"
+  type = "String"
+  value = jsonencode({
+    AppVersionId   = "-"
+    AppVersionName = "-"
+  })
+
+  lifecycle {
+    ignore_changes = [value]
+  }
+}
+
+
 resource "aws_ssm_parameter" "app_version_id" {
-  count = var.app_pipeline && var.enabled ? 1 : 0
+  count = var.app_pipeline && var.enabled && !var.ssm_json_parameters ? 1 : 0
 
   name  = "/${var.name}/app-version-id"
   type  = "String"
@@ -11,7 +72,7 @@ resource "aws_ssm_parameter" "app_version_id" {
 }
 
 resource "aws_ssm_parameter" "app_version_name" {
-  count = var.app_pipeline && var.enabled ? 1 : 0
+  count = var.app_pipeline && var.enabled && !var.ssm_json_parameters ? 1 : 0
 
   name  = "/${var.name}/app-version-name"
   type  = "String"
@@ -23,7 +84,7 @@ resource "aws_ssm_parameter" "app_version_name" {
 }
 
 resource "aws_ssm_parameter" "image_id" {
-  count = var.ami_pipeline && var.enabled ? 1 : 0
+  count = var.ami_pipeline && var.enabled && !var.ssm_json_parameters ? 1 : 0
 
   name  = "/${var.name}/image-id"
   type  = "String"
@@ -35,7 +96,7 @@ resource "aws_ssm_parameter" "image_id" {
 }
 
 resource "aws_ssm_parameter" "image_name" {
-  count = var.ami_pipeline && var.enabled ? 1 : 0
+  count = var.ami_pipeline && var.enabled && !var.ssm_json_parameters ? 1 : 0
 
   name  = "/${var.name}/image-name"
   type  = "String"
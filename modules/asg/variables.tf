@@ -21,6 +21,30 @@ variable "app_pipeline" {
   default     = false
 }
 
+variable "capacity_floor_percent" {
+  description = "The percentage of the ASG's desired capacity to keep in service and healthy during rolling updates, when rolling_update_policy.MinInstancesInService is -1, and the default MinHealthyPercentage of instance refreshes. Lower values allow larger batches and faster deployments."
+  type        = number
+  default     = 100
+}
+
+variable "cfn_signal_batch_window" {
+  description = "The maximum amount of time, in seconds, to gather instance launch events into one batch when cfn_signal_mode is 'batch'."
+  type        = number
+  default     = 10
+}
+
+variable "cfn_signal_mode" {
+  description = "How instances are checked before signalling CloudFormation during rolling updates. Use 'single' to invoke a Lambda function for each launched instance, or 'batch' to check all instances launched together with one invocation."
+  type        = string
+  default     = "single"
+}
+
+variable "cfn_wait_mode" {
+  description = "How CloudFormation waits for instances in the Terminating:Wait state during stack updates. Use 'poll' to keep a Lambda function running while it checks, or 'event' to resume when instances finish terminating."
+  type        = string
+  default     = "poll"
+}
+
 variable "detailed_monitoring" {
   description = "Specify true to enable detailed monitoring. Otherwise, basic monitoring is enabled."
   type        = bool
@@ -33,10 +57,16 @@ variable "health_check_grace_period" {
   default     = 0
 }
 
+variable "health_check_poll_interval" {
+  description = "The maximum amount of time, in seconds, between checks of new instances' target group health before signalling CloudFormation. Checks start more frequently than this, and are never less frequent than the target group's health check interval."
+  type        = number
+  default     = 10
+}
+
 variable "health_check_type" {
-  description = "The service to use for the health checks. The valid values are EC2 (default) and ELB."
+  description = "The service to use for the health checks. The valid values are EC2 and ELB. Defaults to ELB when update_mode is 'refresh' and there are target groups, so that instance refreshes wait for new instances to be healthy in them, otherwise EC2."
   type        = string
-  default     = "EC2"
+  default     = null
 }
 
 variable "image_id" {
@@ -50,6 +80,12 @@ variable "instance_profile_arn" {
   type        = string
 }
 
+variable "instance_refresh_preferences" {
+  description = "Customise instance refreshes when update_mode is 'refresh' by setting any of CheckpointDelay, CheckpointPercentages (comma separated), InstanceWarmup, MaxHealthyPercentage, MinHealthyPercentage, SkipMatching from https://docs.aws.amazon.com/autoscaling/ec2/APIReference/API_RefreshPreferences.html - MinHealthyPercentage defaults to capacity_floor_percent."
+  type        = map(string)
+  default     = {}
+}
+
 variable "instance_type" {
   description = "The type of instances to use."
   type        = string
@@ -67,6 +103,12 @@ variable "lifecycle_hooks" {
   default     = []
 }
 
+variable "log_level" {
+  description = "The minimum level of log records written by the Lambda functions: DEBUG, INFO, WARNING or ERROR."
+  type        = string
+  default     = "INFO"
+}
+
 variable "max_size" {
   description = "The maximum size of the auto scaling group."
   type        = number
@@ -96,7 +138,7 @@ variable "pipeline_target_name" {
 }
 
 variable "rolling_update_policy" {
-  description = "Customise rolling update behaviour by setting any of MaxBatchSize, MinInstancesInService, MinSuccessfulInstancesPercent, PauseTime from https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-attribute-updatepolicy.html"
+  description = "Customise rolling update behaviour by setting any of MaxBatchSize, MinInstancesInService, MinSuccessfulInstancesPercent, PauseTime from https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-attribute-updatepolicy.html - MaxBatchSize and MinInstancesInService default to -1, which calculates them from the current capacity of the ASG when deploying."
   type        = map(string)
   default     = {}
 }
@@ -107,6 +149,12 @@ variable "security_group_ids" {
   default     = []
 }
 
+variable "ssm_json_parameters" {
+  description = "Store each pipeline's deployment state (e.g. AppVersionId and AppVersionName) in a single JSON SSM parameter, rather than one SSM parameter per value. This halves the number of SSM parameter writes and reads per deployment, which helps to avoid SSM throughput limits when deploying to many Auto Scaling Groups at once."
+  type        = bool
+  default     = false
+}
+
 variable "subnet_ids" {
   description = "A list of subnets to launch instances in."
   type        = list(string)
@@ -125,12 +173,24 @@ variable "target_group_arns" {
   default     = []
 }
 
+variable "update_mode" {
+  description = "How instances are replaced during stack updates. Use 'rolling' for a CloudFormation rolling update, which signals CloudFormation as each instance becomes healthy, or 'refresh' for an EC2 Auto Scaling instance refresh, which replaces instances in percentage-based batches without signals."
+  type        = string
+  default     = "rolling"
+}
+
 variable "user_data" {
   description = "User data to provide when launching the instance. This module will Base64 encode the provided string."
   type        = string
   default     = ""
 }
 
+variable "warm_pool" {
+  description = "Create a warm pool of pre-initialized instances by setting this to a map with any of MaxGroupPreparedCapacity, MinSize, PoolState from https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-resource-autoscaling-warmpool.html"
+  type        = map(string)
+  default     = null
+}
+
 variable "block_device_mappings" {
   description = "List of block devices for the instances."
   type        = list(any)
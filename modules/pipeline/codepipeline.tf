@@ -1,13 +1,119 @@
+locals {
+  app_copy_settings = merge({
+    MaxConcurrency       = 10
+    MultipartThresholdMB = 256
+    PartSizeMB           = 64
+  }, var.app_copy_settings)
+
+  # CodePipeline needs an artifact store in each region with Deploy
+  # actions, so the pipeline bucket is listed with the other regions'
+  # artifact stores when there are any. Single-region pipelines must not
+  # give their artifact store a region.
+  artifact_stores = merge(var.artifact_stores, {
+    (length(var.artifact_stores) == 0 ? "" : data.aws_region.current.name) = {
+      bucket      = aws_s3_bucket.pipeline.bucket
+      kms_key_arn = var.kms_key_arn
+    }
+  })
+
+  # Each target's region, taken from its stack ARN.
+  target_regions = {
+    for target in var.targets : target.name => split(":", target.cfn_stack.arn)[3]
+  }
+
+  distribute_enabled = var.type == "ami" && (var.ami_copy || var.ami_fast_snapshot_restore)
+  waves = [
+    for index in range(0, length(var.targets), var.wave_size) :
+    slice(var.targets, index, min(index + var.wave_size, length(var.targets)))
+  ]
+
+  # Targets in each wave are split into groups to be prepared by one
+  # Prepare action each. CodePipeline allows up to 5 output artifacts
+  # per Lambda action, so that is the largest group size.
+  prepare_group_size = max(1, min(var.targets_per_prepare_action, 5))
+  prepare_groups = [
+    for wave in local.waves : [
+      for index in range(0, length(wave), local.prepare_group_size) :
+      slice(wave, index, min(index + local.prepare_group_size, length(wave)))
+    ]
+  ]
+
+  # The Prepare function parameters for each target, as JSON.
+  # Targets include the stack's region, to use the stack and its SSM
+  # parameters there, and for AMI targets to select the matching image
+  # from multi-region Packer manifests.
+  prepare_targets = {
+    for target in var.targets : target.name => var.type == "ami" ? jsonencode({
+      AssumeRoleArn  = target.assume_role.arn
+      OutputArtifact = "${target.name}_cloudformation_template"
+      ParameterNames = {
+        ImageId   = target.ssm_params.image_id.name
+        ImageName = target.ssm_params.image_name.name
+      }
+      Region           = local.target_regions[target.name]
+      StackName        = target.cfn_stack.name
+      TemplateFilename = "cfn.yaml"
+      }) : jsonencode({
+      AppLocation = {
+        Bucket = target.app_location.bucket
+        Key    = target.app_location.key
+      }
+      ArtifactFormat = var.app_artifact_format
+      AssumeRoleArn  = target.assume_role.arn
+      CopySettings   = local.app_copy_settings
+      OutputArtifact = "${target.name}_cloudformation_template"
+      ParameterNames = {
+        AppVersionId   = target.ssm_params.app_version_id.name
+        AppVersionName = target.ssm_params.app_version_name.name
+      }
+      Region           = local.target_regions[target.name]
+      StackName        = target.cfn_stack.name
+      TemplateFilename = "cfn.yaml"
+    })
+  }
+}
+
+# The Prepare function parameters for groups of more than one target.
+resource "aws_s3_bucket_object" "prepare_targets" {
+  for_each = {
+    for item in flatten([
+      for wave_index, groups in local.prepare_groups : [
+        for group_index, group in groups : {
+          key     = "${wave_index}-${group_index}"
+          targets = group
+        } if length(group) > 1
+      ]
+    ]) : item.key => item.targets
+  }
+
+  bucket  = aws_s3_bucket.pipeline.bucket
+  key     = "prepare-targets/${each.key}.json"
+  content = "{\"Targets\": [${join(", ", [for target in each.value : local.prepare_targets[target.name]])}]}"
+}
+
+# The Distribute function parameters for all targets.
+resource "aws_s3_bucket_object" "distribute_targets" {
+  count = local.distribute_enabled ? 1 : 0
+
+  bucket  = aws_s3_bucket.pipeline.bucket
+  key     = "prepare-targets/distribute.json"
+  content = "{\"Targets\": [${join(", ", [for target in var.targets : local.prepare_targets[target.name]])}]}"
+}
+
 resource "aws_codepipeline" "this" {
   name     = var.name
   role_arn = local.codepipeline_role_arn
 
-  artifact_store {
-    type     = "S3"
-    location = aws_s3_bucket.pipeline.bucket
-    encryption_key {
-      id   = var.kms_key_arn
-      type = "KMS"
+  dynamic "artifact_store" {
+    for_each = local.artifact_stores
+    content {
+      type     = "S3"
+      location = artifact_store.value.bucket
+      region   = artifact_store.key == "" ? null : artifact_store.key
+      encryption_key {
+        id   = artifact_store.value.kms_key_arn
+        type = "KMS"
+      }
     }
   }
 
@@ -31,17 +137,57 @@ resource "aws_codepipeline" "this" {
     }
   }
 
+  # Distribute step for AMI pipelines.
+  # Copies the AMI to the target accounts and regions that don't have an
+  # image in the Packer manifest, and enables fast snapshot restore for
+  # its snapshots in the target Auto Scaling Groups' availability zones,
+  # then waits until they are all ready. The output artifact has the
+  # manifest with the copied images added, used by the Prepare actions.
   dynamic "stage" {
-    for_each = var.targets
-    iterator = each
+    for_each = toset(range(local.distribute_enabled ? 1 : 0))
+    content {
+      name = "Distribute"
+
+      action {
+        name             = "Distribute"
+        input_artifacts  = ["source"]
+        output_artifacts = ["distributed"]
+
+        category = "Invoke"
+        owner    = "AWS"
+        provider = "Lambda"
+        version  = "1"
+
+        configuration = {
+          FunctionName = module.distribute_ami_deployment_lambda.function_name
+          UserParameters = jsonencode({
+            CopyImage           = var.ami_copy
+            FastSnapshotRestore = var.ami_fast_snapshot_restore
+            TargetsLocation = {
+              Bucket = aws_s3_bucket.pipeline.bucket
+              Key    = aws_s3_bucket_object.distribute_targets[0].key
+            }
+          })
+        }
+      }
+    }
+  }
+
+  # Targets are deployed in waves, one stage per wave. Targets within
+  # a wave are deployed in parallel, using separate actions for each
+  # target. Stages for single target waves are named after the target,
+  # otherwise they are numbered.
+  dynamic "stage" {
+    for_each = local.waves
+    iterator = wave
 
     content {
-      name = each.value.name
+      name = length(wave.value) == 1 ? wave.value[0].name : "Wave${wave.key + 1}"
 
       # Approval step.
-      # This is skipped when the target has "auto deploy" enabled.
+      # This is skipped when all targets in the wave have "auto deploy" enabled.
       dynamic "action" {
-        for_each = toset(range(each.value.auto_deploy ? 0 : 1))
+        for_each = toset(range(length([for target in wave.value : target if ! target.auto_deploy]) > 0 ? 1 : 0))
         content {
           name      = "Approve"
           run_order = "1"
@@ -52,7 +198,7 @@ resource "aws_codepipeline" "this" {
           version  = "1"
 
           configuration = {
-            CustomData = "Approve deployment to ${each.value.name}"
+            CustomData = "Approve deployment to ${join(", ", wave.value[*].name)}"
           }
         }
       }
@@ -63,47 +209,27 @@ resource "aws_codepipeline" "this" {
       # Downloads the Packer manifest input artifact, extracts the new
       # image id from it, and then updates the SSM parameters used by
       # the CFN stack template.
-      dynamic "action" {
-        for_each = toset(range(var.type == "ami" ? 1 : 0))
-        content {
-          name             = "Prepare"
-          run_order        = "2"
-          input_artifacts  = ["source"]
-          output_artifacts = ["${each.value.name}_cloudformation_template"]
-
-          category = "Invoke"
-          owner    = "AWS"
-          provider = "Lambda"
-          version  = "1"
-
-          configuration = {
-            FunctionName = module.prepare_ami_deployment_lambda.function_name
-            UserParameters = jsonencode({
-              AssumeRoleArn = each.value.assume_role.arn
-              ParameterNames = {
-                ImageId   = each.value.ssm_params.image_id.name
-                ImageName = each.value.ssm_params.image_name.name
-              }
-              StackName        = each.value.cfn_stack.name
-              TemplateFilename = "cfn.yaml"
-            })
-          }
-        }
-      }
-
+      #
       # Prepare deployment step for app pipelines.
       # Downloads the CFN stack template and writes it to the S3 output
       # artifact location, used by the subsequent CFN stack update action.
       # Copies the app release from the pipeline artifacts S3 bucket
       # to the target S3 bucket, and then updates the SSM parameters
-      # used by the CFN stack template.
+      # used by the CFN stack template. Large app releases are copied
+      # using a concurrent multipart copy.
+      #
+      # Each action prepares a group of targets concurrently, writing one
+      # output artifact per target. Groups of more than one target have
+      # their details stored in the pipeline bucket, because they don't fit
+      # in the action's UserParameters.
       dynamic "action" {
-        for_each = toset(range(var.type == "app" ? 1 : 0))
+        for_each = local.prepare_groups[wave.key]
+        iterator = group
         content {
-          name             = "Prepare"
+          name             = length(wave.value) == 1 ? "Prepare" : length(group.value) == 1 ? "${group.value[0].name}-Prepare" : "Prepare${group.key + 1}"
           run_order        = "2"
-          input_artifacts  = ["source"]
-          output_artifacts = ["${each.value.name}_cloudformation_template"]
+          input_artifacts  = [local.distribute_enabled ? "distributed" : "source"]
+          output_artifacts = [for target in group.value : "${target.name}_cloudformation_template"]
 
           category = "Invoke"
           owner    = "AWS"
@@ -111,19 +237,14 @@ resource "aws_codepipeline" "this" {
           version  = "1"
 
           configuration = {
-            FunctionName = module.prepare_app_deployment_lambda.function_name
-            UserParameters = jsonencode({
-              AppLocation = {
-                Bucket = each.value.app_location.bucket
-                Key    = each.value.app_location.key
+            FunctionName = var.type == "ami" ? module.prepare_ami_deployment_lambda.function_name : module.prepare_app_deployment_lambda.function_name
+            UserParameters = length(group.value) == 1 ? local.prepare_targets[group.value[0].name] : jsonencode({
+              ArtifactFormat = var.type == "app" ? var.app_artifact_format : null
+              CopySettings   = var.type == "app" ? local.app_copy_settings : null
+              TargetsLocation = {
+                Bucket = aws_s3_bucket.pipeline.bucket
+                Key    = aws_s3_bucket_object.prepare_targets["${wave.key}-${group.key}"].key
               }
-              AssumeRoleArn = each.value.assume_role.arn
-              ParameterNames = {
-                AppVersionId   = each.value.ssm_params.app_version_id.name
-                AppVersionName = each.value.ssm_params.app_version_name.name
-              }
-              StackName        = each.value.cfn_stack.name
-              TemplateFilename = "cfn.yaml"
             })
           }
         }
@@ -137,33 +258,42 @@ resource "aws_codepipeline" "this" {
       # input parameters mixed up, but if they run at the same time then
       # one will error (you can just click retry, and this can be improved
       # later with more a fancy Lambda function or Step Function).
-      action {
-        name            = "Deploy"
-        run_order       = "3"
-        input_artifacts = ["${each.value.name}_cloudformation_template"]
+      # Stacks in other regions are updated by cross-region actions.
+      dynamic "action" {
+        for_each = wave.value
+        iterator = each
+        content {
+          name            = length(wave.value) == 1 ? "Deploy" : "${each.value.name}-Deploy"
+          run_order       = "3"
+          input_artifacts = ["${each.value.name}_cloudformation_template"]
+          region          = local.target_regions[each.value.name] == data.aws_region.current.name ? null : local.target_regions[each.value.name]
 
-        category = "Deploy"
-        owner    = "AWS"
-        provider = "CloudFormation"
-        version  = "1"
+          category = "Deploy"
+          owner    = "AWS"
+          provider = "CloudFormation"
+          version  = "1"
 
-        configuration = {
-          ActionMode         = "CREATE_UPDATE"
-          RoleArn            = each.value.cfn_role.arn
-          StackName          = each.value.cfn_stack.name
-          TemplatePath       = "${each.value.name}_cloudformation_template::cfn.yaml"
-          ParameterOverrides = jsonencode(each.value.cfn_stack.params)
-        }
+          configuration = {
+            ActionMode         = "CREATE_UPDATE"
+            RoleArn            = each.value.cfn_role.arn
+            StackName          = each.value.cfn_stack.name
+            TemplatePath       = "${each.value.name}_cloudformation_template::cfn.yaml"
+            ParameterOverrides = jsonencode(each.value.cfn_stack.params)
+          }
 
-        role_arn = each.value.assume_role.arn
+          role_arn = each.value.assume_role.arn
+        }
       }
 
       # Cleanup step for app pipelines.
-      # Deletes old app versions from the target S3 bucket.
+      # Deletes old app versions from the target S3 bucket,
+      # apart from the version in use and the most recent ones,
+      # along with any chunks that the remaining versions don't use.
       dynamic "action" {
-        for_each = toset(range(var.type == "app" ? 1 : 0))
+        for_each = var.type == "app" ? wave.value : []
+        iterator = each
         content {
-          name      = "Cleanup"
+          name      = length(wave.value) == 1 ? "Cleanup" : "${each.value.name}-Cleanup"
           run_order = "4"
 
           category = "Invoke"
@@ -178,8 +308,35 @@ resource "aws_codepipeline" "this" {
                 Bucket = each.value.app_location.bucket
                 Key    = each.value.app_location.key
               }
-              AssumeRoleArn = each.value.assume_role.arn
-              StackName     = each.value.cfn_stack.name
+              ArtifactFormat = var.app_artifact_format
+              AssumeRoleArn  = each.value.assume_role.arn
+              KeepVersions   = var.keep_app_versions
+              Region         = local.target_regions[each.value.name]
+              StackName      = each.value.cfn_stack.name
+            })
+          }
+        }
+      }
+
+      # Bake step.
+      # Waits for a while after deploying the wave, before the next wave
+      # can start, so that problems can be noticed before they spread.
+      # This is skipped for the last wave.
+      dynamic "action" {
+        for_each = toset(range(var.wave_bake_minutes > 0 && wave.key < length(local.waves) - 1 ? 1 : 0))
+        content {
+          name      = "Bake"
+          run_order = "5"
+
+          category = "Invoke"
+          owner    = "AWS"
+          provider = "Lambda"
+          version  = "1"
+
+          configuration = {
+            FunctionName = module.bake_deployment_lambda.function_name
+            UserParameters = jsonencode({
+              BakeMinutes = var.wave_bake_minutes
             })
           }
         }
@@ -27,10 +27,14 @@ data "aws_iam_policy_document" "codepipeline" {
       "s3:Abort*"
     ]
 
-    resources = [
-      aws_s3_bucket.pipeline.arn,
-      "${aws_s3_bucket.pipeline.arn}/*"
-    ]
+    # Including the artifact stores for targets in other regions.
+    resources = concat(
+      [aws_s3_bucket.pipeline.arn, "${aws_s3_bucket.pipeline.arn}/*"],
+      flatten([
+        for store in values(var.artifact_stores) :
+        ["arn:aws:s3:::${store.bucket}", "arn:aws:s3:::${store.bucket}/*"]
+      ])
+    )
   }
 
   statement {
@@ -42,9 +46,10 @@ data "aws_iam_policy_document" "codepipeline" {
       "kms:GenerateDataKey",
     ]
 
-    resources = [
-      var.kms_key_arn,
-    ]
+    resources = concat(
+      [var.kms_key_arn],
+      [for store in values(var.artifact_stores) : store.kms_key_arn]
+    )
   }
 
   statement {
@@ -61,7 +66,9 @@ data "aws_iam_policy_document" "codepipeline" {
     ]
 
     resources = compact([
+      module.bake_deployment_lambda.arn,
       module.cleanup_app_deployment_lambda.arn,
+      module.distribute_ami_deployment_lambda.arn,
       module.prepare_ami_deployment_lambda.arn,
       module.prepare_app_deployment_lambda.arn,
     ])
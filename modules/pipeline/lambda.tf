@@ -19,6 +19,42 @@ module "prepare_ami_deployment_lambda" {
   role_cloudwatch_logs       = true
   role_custom_policies       = [data.aws_iam_policy_document.lambda.json]
   role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL = var.log_level
+    }
+  }
+}
+
+
+module "distribute_ami_deployment_lambda" {
+  source  = "raymondbutcher/lambda-builder/aws"
+  version = "1.1.0"
+
+  enabled = local.distribute_enabled
+
+  function_name = "${var.name}-distribute-deployment"
+  handler       = "distribute_ami_deployment.lambda_handler"
+  runtime       = "python3.6"
+  filename      = ".terraform/distribute-ami-deployment-lambda.zip"
+  timeout       = 900
+
+  # Enable build functionality.
+  build_mode = "FILENAME"
+  source_dir = "${path.module}/lambda"
+
+  # Create and use a role with CloudWatch Logs permissions,
+  # and attach a custom policy.
+  role_cloudwatch_logs       = true
+  role_custom_policies       = [data.aws_iam_policy_document.lambda.json]
+  role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL = var.log_level
+    }
+  }
 }
 
 
@@ -43,6 +79,12 @@ module "prepare_app_deployment_lambda" {
   role_cloudwatch_logs       = true
   role_custom_policies       = [data.aws_iam_policy_document.lambda.json]
   role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL = var.log_level
+    }
+  }
 }
 
 
@@ -67,4 +109,40 @@ module "cleanup_app_deployment_lambda" {
   role_cloudwatch_logs       = true
   role_custom_policies       = [data.aws_iam_policy_document.lambda.json]
   role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL = var.log_level
+    }
+  }
+}
+
+
+module "bake_deployment_lambda" {
+  source  = "raymondbutcher/lambda-builder/aws"
+  version = "1.1.0"
+
+  enabled = var.wave_bake_minutes > 0
+
+  function_name = "${var.name}-bake-deployment"
+  handler       = "bake_deployment.lambda_handler"
+  runtime       = "python3.6"
+  filename      = ".terraform/bake-deployment-lambda.zip"
+  timeout       = 30
+
+  # Enable build functionality.
+  build_mode = "FILENAME"
+  source_dir = "${path.module}/lambda"
+
+  # Create and use a role with CloudWatch Logs permissions,
+  # and attach a custom policy.
+  role_cloudwatch_logs       = true
+  role_custom_policies       = [data.aws_iam_policy_document.lambda.json]
+  role_custom_policies_count = 1
+
+  environment = {
+    variables = {
+      LOG_LEVEL = var.log_level
+    }
+  }
 }
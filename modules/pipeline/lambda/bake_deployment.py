@@ -0,0 +1,34 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # noqa: F401  # isort: skip
+
+import time
+
+from logger import logger
+from utils import codepipeline_lambda_handler, get_user_parameters
+
+
+@codepipeline_lambda_handler
+def lambda_handler(event, context):
+    """
+    Waits for the bake time after a wave of deployments. Instead of sleeping,
+    this returns a continuation token holding the time that the bake time
+    ends, and CodePipeline keeps invoking the function with that token until
+    the time has passed.
+
+    """
+
+    # Get details from the event.
+    job = event["CodePipeline.job"]
+    user_params = get_user_parameters(job)
+    continuation_token = job["data"].get("continuationToken")
+
+    if continuation_token:
+        ends = float(continuation_token)
+    else:
+        ends = time.time() + user_params["BakeMinutes"] * 60
+    remaining = ends - time.time()
+    logger.info("BAKE_REMAINING", Seconds=round(max(remaining, 0)))
+
+    if remaining > 0:
+        return str(ends)
@@ -1,10 +1,32 @@
-from utils import codepipeline_lambda_handler, get_session, get_user_parameters, log
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
+import json
+import os
+
+from logger import logger
+from utils import (
+    APP_CHUNK_PREFIX,
+    codepipeline_lambda_handler,
+    get_session,
+    get_user_parameters,
+)
+
+# The maximum number of keys that S3 accepts in a single DeleteObjects request.
+DELETE_BATCH_SIZE = 1000
+
+# Chunked app versions are JSON manifests. Other versions, such as zip files
+# deployed before switching formats, are skipped without reading them.
+MANIFEST_CONTENT_TYPE = "application/json"
+MAX_MANIFEST_SIZE = 64 * 1024 * 1024
 
 
 @codepipeline_lambda_handler
 def lambda_handler(event, context):
     """
-    Cleans up old versions from the app bucket.
+    Cleans up old versions from the app bucket. For chunked artifacts,
+    chunks that aren't used by any of the remaining versions are deleted too.
 
     """
 
@@ -13,41 +35,183 @@ def lambda_handler(event, context):
     user_params = get_user_parameters(job)
     app_bucket = user_params["AppLocation"]["Bucket"]
     app_key = user_params["AppLocation"]["Key"]
+    artifact_format = user_params.get("ArtifactFormat", "zip")
     assume_role_arn = user_params["AssumeRoleArn"]
+    keep_versions = int(user_params.get("KeepVersions", 0))
+    region = user_params.get("Region") or os.environ["AWS_REGION"]
     stack_name = user_params["StackName"]
 
-    # Create clients in the target account.
+    # Create clients in the target account and region.
     target_session = get_session(
         role_arn=assume_role_arn, session_name="cleanup-app-deployment"
     )
-    target_cfn_client = target_session.client("cloudformation")
-    target_s3_client = target_session.client("s3")
+    target_cfn_client = target_session.client("cloudformation", region_name=region)
+    target_s3_client = target_session.client("s3", region_name=region)
 
-    # Delete any versions of the app that aren't being used.
-    all_versions = set(
-        get_all_s3_versions(s3_client=target_s3_client, bucket=app_bucket, key=app_key)
+    # Delete any versions of the app that aren't being used,
+    # apart from the most recent ones that should be retained.
+    with metrics.timer("StackLookup"):
+        used_app_version = get_used_s3_version(
+            cfn_client=target_cfn_client, stack_name=stack_name
+        )
+    logger.info("USED_APP_VERSION", VersionId=used_app_version)
+    all_versions = get_all_s3_versions(
+        s3_client=target_s3_client, bucket=app_bucket, key=app_key
     )
-    used_app_version = get_used_s3_version(
-        cfn_client=target_cfn_client, stack_name=stack_name
+    old_versions = get_old_s3_versions(
+        versions=all_versions, used_version=used_app_version, keep=keep_versions
     )
-    for version in all_versions:
-        if version != used_app_version:
-            log("DELETE", version)
-            target_s3_client.delete_object(
-                Bucket=app_bucket, Key=app_key, VersionId=version
+    with metrics.timer("VersionCleanup"):
+        deleted = delete_s3_versions(
+            s3_client=target_s3_client,
+            bucket=app_bucket,
+            versions=((app_key, version) for version in old_versions),
+        )
+    logger.info("DELETED", Count=deleted)
+
+    # Delete the chunks that aren't listed in the manifests of the app
+    # versions that are left. The Prepare action uploads chunks in the
+    # same stage, so none can be added for a new version while this runs.
+    if artifact_format == "chunks":
+        with metrics.timer("ChunkLookup"):
+            used_chunks = get_used_s3_chunks(
+                s3_client=target_s3_client,
+                bucket=app_bucket,
+                key=app_key,
+                versions=get_all_s3_versions(
+                    s3_client=target_s3_client, bucket=app_bucket, key=app_key
+                ),
             )
+        unused_chunk_versions = get_unused_s3_chunk_versions(
+            s3_client=target_s3_client,
+            bucket=app_bucket,
+            prefix=APP_CHUNK_PREFIX,
+            used_chunks=used_chunks,
+        )
+        with metrics.timer("ChunkCleanup"):
+            deleted = delete_s3_versions(
+                s3_client=target_s3_client,
+                bucket=app_bucket,
+                versions=unused_chunk_versions,
+            )
+        logger.info("DELETED_CHUNKS", Count=deleted, Used=len(used_chunks))
+
+
+def delete_s3_versions(s3_client, bucket, versions):
+    """
+    Deletes object versions from S3 in batches, given (key, version) pairs.
+    Returns the number of deleted versions.
+
+    """
+
+    deleted = 0
+    batch = []
+    for version in versions:
+        batch.append(version)
+        if len(batch) == DELETE_BATCH_SIZE:
+            deleted += delete_s3_versions_batch(s3_client, bucket, batch)
+            batch = []
+    if batch:
+        deleted += delete_s3_versions_batch(s3_client, bucket, batch)
+    return deleted
+
+
+def delete_s3_versions_batch(s3_client, bucket, versions):
+    """
+    Deletes a batch of object versions from S3 with a single request.
+    Returns the number of deleted versions.
+
+    """
+
+    logger.debug("DELETE", Versions=versions)
+    response = s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={
+            "Objects": [
+                {"Key": key, "VersionId": version} for key, version in versions
+            ],
+            "Quiet": True,
+        },
+    )
+    errors = response.get("Errors", [])
+    if errors:
+        error = errors[0]
+        raise Exception(
+            f"Failed to delete {len(errors)} versions, "
+            f"first error for {error['Key']} {error['VersionId']}: "
+            f"{error['Code']} {error['Message']}"
+        )
+    return len(versions)
 
 
 def get_all_s3_versions(s3_client, bucket, key):
     """
-    Returns all object versions in S3.
+    Returns all object versions in S3, newest first.
+    Delete markers are not included.
+
+    """
+
+    paginator = s3_client.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket=bucket, Prefix=key):
+        for version in page.get("Versions", []):
+            # The prefix can match other keys, e.g. "app.zip.old".
+            if version["Key"] == key:
+                yield version["VersionId"]
+
+
+def get_old_s3_versions(versions, used_version, keep):
+    """
+    Returns the versions that can be deleted. The version used by the
+    CloudFormation stack is always retained, along with the most recent
+    versions up to the specified number.
+
+    """
+
+    kept = 0
+    for version in versions:
+        if version == used_version:
+            continue
+        if kept < keep:
+            kept += 1
+            continue
+        yield version
+
+
+def get_unused_s3_chunk_versions(s3_client, bucket, prefix, used_chunks):
+    """
+    Returns (key, version) pairs for all versions of the chunks in S3
+    that aren't in the used chunks.
+
+    """
+
+    paginator = s3_client.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for version in page.get("Versions", []):
+            if version["Key"][len(prefix) :] not in used_chunks:
+                yield (version["Key"], version["VersionId"])
+
+
+def get_used_s3_chunks(s3_client, bucket, key, versions):
+    """
+    Returns the set of chunks listed in the manifests of the object versions.
+    Versions that aren't manifests are skipped.
 
     """
 
-    response = s3_client.list_object_versions(Bucket=bucket)
-    for version in response.get("Versions", []):
-        if version["Key"] == key:
-            yield version["VersionId"]
+    used_chunks = set()
+    for version in versions:
+        response = s3_client.get_object(Bucket=bucket, Key=key, VersionId=version)
+        if (
+            response.get("ContentType") != MANIFEST_CONTENT_TYPE
+            or response["ContentLength"] > MAX_MANIFEST_SIZE
+        ):
+            response["Body"].close()
+            logger.info("NOT_MANIFEST", VersionId=version)
+            continue
+        manifest = json.loads(response["Body"].read())
+        for file_chunks in manifest.get("Files", {}).values():
+            used_chunks.update(file_chunks)
+    return used_chunks
 
 
 def get_used_s3_version(cfn_client, stack_name):
@@ -0,0 +1,291 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
+import json
+import os
+import threading
+import time
+
+from clients import create_client
+from logger import logger
+from utils import (
+    codepipeline_lambda_handler,
+    create_zip_file,
+    get_artifact_s3_client,
+    get_input_artifact_location,
+    get_manifest_image,
+    get_manifest_images,
+    get_output_artifact_location,
+    get_session,
+    get_targets,
+    get_user_parameters,
+    open_s3_zip_file,
+    run_targets,
+)
+
+# Wait for up to this long in each invocation, leaving enough time
+# before the function times out to return a continuation token.
+MAX_WAIT_SECONDS = 840
+
+# Image copies and fast snapshot restores take minutes to become ready,
+# so they are checked at this interval.
+POLL_SECONDS = 15
+
+# Fast snapshot restore states that mean it needs to be enabled again.
+FAST_SNAPSHOT_RESTORE_DISABLED_STATES = ("disabled", "disabling")
+
+
+@codepipeline_lambda_handler
+def lambda_handler(event, context):
+    """
+    Makes the AMI from the Packer manifest ready to launch in every target,
+    before any of them are deployed. The AMI is copied to each target
+    account and region that doesn't have an image in the manifest, and
+    fast snapshot restore can be enabled for its snapshots in the target
+    Auto Scaling Groups' availability zones, so the first instances
+    launched from it don't have to wait for their volumes to load.
+
+    The output artifact has the manifest with a build added for each copy,
+    to be used by the Prepare actions. Waits longer than a single invocation
+    can run are continued in further invocations. Copies are started with
+    an idempotency token, so continued invocations find the same copies.
+
+    """
+
+    # Get details from the event.
+    job = event["CodePipeline.job"]
+    input_bucket, input_key = get_input_artifact_location(job)
+    output_bucket, output_key = get_output_artifact_location(job)
+    user_params = get_user_parameters(job)
+    copy_image = user_params.get("CopyImage", False)
+    fast_snapshot_restore = user_params.get("FastSnapshotRestore", False)
+    targets = get_targets(user_params)
+    continuation_token = job["data"].get("continuationToken")
+    invoked = time.time()
+    started = float(continuation_token) if continuation_token else invoked
+
+    # Create client in the pipeline account.
+    pipeline_s3_client = get_artifact_s3_client(job)
+
+    # Read manifest.json from the input artifact zip file, without downloading
+    # the whole file, and index the AMIs it references by account and region.
+    with metrics.timer("ArtifactRead"):
+        with open_s3_zip_file(
+            s3_client=pipeline_s3_client, bucket=input_bucket, key=input_key
+        ) as zip_file:
+            manifest_string = zip_file.read("manifest.json").decode("utf-8")
+    manifest = json.loads(manifest_string)
+    images = get_manifest_images(manifest)
+
+    # Look up source image names in their own regions, if the manifest
+    # doesn't include them. This is only done once per image.
+    image_names = {}
+    image_names_lock = threading.Lock()
+
+    def lookup_image_name(image):
+        with image_names_lock:
+            if image["ImageId"] not in image_names:
+                ec2_client = create_client("ec2", region_name=image["Region"])
+                with metrics.timer("ImageLookup"):
+                    response = ec2_client.describe_images(ImageIds=[image["ImageId"]])
+                image_names[image["ImageId"]] = response["Images"][0]["Name"]
+            return image_names[image["ImageId"]]
+
+    # Copy the image once per account and region, even when there are
+    # several targets there, while copying to different places concurrently.
+    copies = {}
+    copy_locks = {}
+    copies_lock = threading.Lock()
+
+    def get_image(ec2_client, account_id, region):
+        image = get_manifest_image(images, account_id, region)
+        if not copy_image or image["Region"] == region:
+            return image
+        key = (account_id, region)
+        with copies_lock:
+            copy_lock = copy_locks.setdefault(key, threading.Lock())
+        with copy_lock:
+            if key not in copies:
+                image_name = image["ImageName"] or lookup_image_name(image)
+                with metrics.timer("ImageCopy"):
+                    response = ec2_client.copy_image(
+                        ClientToken=image["ImageId"],
+                        Name=image_name,
+                        SourceImageId=image["ImageId"],
+                        SourceRegion=image["Region"],
+                    )
+                copies[key] = {
+                    "ImageId": response["ImageId"],
+                    "ImageName": image_name,
+                    "Region": region,
+                }
+                logger.info(
+                    "IMAGE_COPY",
+                    AccountId=account_id,
+                    ImageId=response["ImageId"],
+                    Region=region,
+                    SourceImageId=image["ImageId"],
+                    SourceRegion=image["Region"],
+                )
+            return copies[key]
+
+    # Remember the availability zones of each target's Auto Scaling Group,
+    # which are only looked up once.
+    zones = {}
+
+    def get_zones(target_key, target_session, region):
+        if target_key not in zones:
+            stack_name = target_key[1]
+            cfn_client = target_session.client("cloudformation", region_name=region)
+            response = cfn_client.describe_stacks(StackName=stack_name)
+            outputs = {
+                output["OutputKey"]: output["OutputValue"]
+                for output in response["Stacks"][0].get("Outputs", [])
+            }
+            asg_client = target_session.client("autoscaling", region_name=region)
+            response = asg_client.describe_auto_scaling_groups(
+                AutoScalingGroupNames=[outputs["AutoScalingGroupName"]]
+            )
+            asg = response["AutoScalingGroups"][0]
+            zones[target_key] = asg["AvailabilityZones"]
+        return zones[target_key]
+
+    # Check whether each target is ready, starting anything that it needs.
+    # Stacks in different accounts can have the same name, so targets
+    # are identified by their role and stack name.
+    ready = set()
+
+    def check_target(target):
+
+        # Get details for this target.
+        assume_role_arn = target["AssumeRoleArn"]
+        account_id = assume_role_arn.split(":")[4]
+        region = target.get("Region") or os.environ["AWS_REGION"]
+        target_key = (assume_role_arn, target["StackName"])
+
+        # Create clients in the target account and region.
+        target_session = get_session(
+            role_arn=assume_role_arn, session_name="distribute-ami-deployment"
+        )
+        target_ec2_client = target_session.client("ec2", region_name=region)
+
+        # Wait for the image to be available.
+        image = get_image(target_ec2_client, account_id, region)
+        response = target_ec2_client.describe_images(ImageIds=[image["ImageId"]])
+        image_state = response["Images"][0]["State"]
+        if image_state not in ("available", "pending"):
+            raise Exception(f"Image {image['ImageId']} is {image_state}")
+        if image_state != "available":
+            logger.info("IMAGE_PENDING", ImageId=image["ImageId"], Region=region)
+            return
+
+        # Wait for fast snapshot restore to be enabled for its snapshots.
+        if fast_snapshot_restore:
+            snapshot_ids = [
+                mapping["Ebs"]["SnapshotId"]
+                for mapping in response["Images"][0].get("BlockDeviceMappings", [])
+                if mapping.get("Ebs", {}).get("SnapshotId")
+            ]
+            target_zones = get_zones(target_key, target_session, region)
+            enabled = enable_fast_snapshot_restores(
+                ec2_client=target_ec2_client,
+                snapshot_ids=snapshot_ids,
+                zones=target_zones,
+            )
+            if not enabled:
+                return
+
+        ready.add(target_key)
+
+    # Check all of the targets concurrently, until they are all ready
+    # or it is time to continue in another invocation.
+    while True:
+        run_targets(
+            [
+                target
+                for target in targets
+                if (target["AssumeRoleArn"], target["StackName"]) not in ready
+            ],
+            check_target,
+        )
+        logger.info(
+            "DISTRIBUTE_READY",
+            Ready=len(ready),
+            Seconds=round(time.time() - started),
+            Targets=len(targets),
+        )
+        if len(ready) == len(targets):
+            break
+        if time.time() + POLL_SECONDS - invoked > MAX_WAIT_SECONDS:
+            return str(started)
+        time.sleep(POLL_SECONDS)
+
+    # Write the manifest with the copied images added as builds,
+    # so the Prepare actions can find the image for each target.
+    # They go before the Packer builds, which keeps the last build
+    # as the fallback for targets without an image for their region.
+    copy_builds = [
+        {
+            "artifact_id": f"{region}:{image['ImageId']}",
+            "builder_type": "copy",
+            "custom_data": {"account_id": account_id, "image_name": image["ImageName"]},
+            "name": "distribute",
+        }
+        for (account_id, region), image in sorted(copies.items())
+    ]
+    manifest["builds"] = copy_builds + manifest["builds"]
+    body = create_zip_file({"manifest.json": json.dumps(manifest)})
+    with metrics.timer("ArtifactWrite"):
+        pipeline_s3_client.put_object(Bucket=output_bucket, Key=output_key, Body=body)
+
+
+def enable_fast_snapshot_restores(ec2_client, snapshot_ids, zones):
+    """
+    Enables fast snapshot restore for the snapshots in the availability zones,
+    where it isn't already enabled or being enabled, and returns whether it
+    is enabled for all of them.
+
+    """
+
+    response = ec2_client.describe_fast_snapshot_restores(
+        Filters=[{"Name": "snapshot-id", "Values": snapshot_ids}]
+    )
+    states = {
+        (item["SnapshotId"], item["AvailabilityZone"]): item["State"]
+        for item in response["FastSnapshotRestores"]
+    }
+    missing_zones = sorted(
+        {
+            zone
+            for snapshot_id in snapshot_ids
+            for zone in zones
+            if states.get((snapshot_id, zone), "disabled")
+            in FAST_SNAPSHOT_RESTORE_DISABLED_STATES
+        }
+    )
+    if missing_zones:
+        with metrics.timer("FastSnapshotRestoreEnable"):
+            response = ec2_client.enable_fast_snapshot_restores(
+                AvailabilityZones=missing_zones, SourceSnapshotIds=snapshot_ids
+            )
+        errors = [
+            error["Error"]["Message"]
+            for item in response.get("Unsuccessful", [])
+            for error in item["FastSnapshotRestoreStateErrors"]
+        ]
+        if errors:
+            raise Exception(f"Failed to enable fast snapshot restore: {errors[0]}")
+    pending = [
+        (snapshot_id, zone)
+        for snapshot_id in snapshot_ids
+        for zone in zones
+        if states.get((snapshot_id, zone)) != "enabled"
+    ]
+    logger.info(
+        "FAST_SNAPSHOT_RESTORE",
+        Enabling=missing_zones,
+        Pending=len(pending),
+        SnapshotIds=snapshot_ids,
+    )
+    return not pending
@@ -0,0 +1,130 @@
+# This file is shared by the Lambda functions in this project.
+# Identical copies exist in each Lambda function's source directory.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = "ASGPipeline"
+
+# When this module was imported. The Lambda functions import it first,
+# so this is when they started loading their modules.
+IMPORTED = time.perf_counter()
+
+# Containers initialized for provisioned concurrency can wait a long time
+# before their first invocation, which shouldn't count as initialization.
+ON_DEMAND = os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE", "on-demand") == "on-demand"
+
+
+class Metrics:
+    """
+    Records how long each phase of a Lambda function invocation takes,
+    and how many AWS API calls it makes. The results are logged using the
+    CloudWatch Embedded Metric Format, so CloudWatch Logs turns them into
+    CloudWatch metrics.
+
+    """
+
+    def __init__(self):
+        self.cold_start = True
+        self.lock = threading.Lock()
+        self.reset()
+
+    def count(self, event_name, **kwargs):
+        """
+        Counts an API call. This is registered as a botocore event handler.
+
+        """
+
+        # The event name is like "before-call.s3.CopyObject".
+        api_call = event_name.split(".", 1)[-1]
+        with self.lock:
+            self.api_calls[api_call] = self.api_calls.get(api_call, 0) + 1
+
+    def emit(self):
+        """
+        Logs the metrics in the CloudWatch Embedded Metric Format.
+
+        """
+
+        with self.lock:
+            durations = dict(self.durations)
+            api_calls = dict(self.api_calls)
+            init_duration = self.init_duration
+
+        durations["Total"] = (time.perf_counter() - self.started) * 1000
+        if init_duration is not None:
+            durations["Init"] = init_duration
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [["FunctionName"]],
+                        "Metrics": [
+                            {"Name": f"{name}Duration", "Unit": "Milliseconds"}
+                            for name in sorted(durations)
+                        ]
+                        + [{"Name": "ApiCalls", "Unit": "Count"}],
+                    }
+                ],
+            },
+            "ApiCalls": sum(api_calls.values()),
+            "ApiCallCounts": api_calls,
+            "ColdStart": init_duration is not None,
+            "FunctionName": self.function_name,
+        }
+        for name, duration in durations.items():
+            record[f"{name}Duration"] = round(duration, 1)
+        print(json.dumps(record, sort_keys=True))
+
+    def instrument(self, client):
+        """
+        Counts the API calls made by a boto3 client. Returns the client.
+
+        """
+
+        client.meta.events.register("before-call", self.count)
+        return client
+
+    def reset(self, context=None):
+        """
+        Starts recording metrics for a new invocation.
+
+        """
+
+        with self.lock:
+            self.api_calls = {}
+            self.durations = {}
+            self.function_name = getattr(context, "function_name", "")
+            self.init_duration = None
+            self.started = time.perf_counter()
+            if context and self.cold_start:
+                # This is the first invocation in this Lambda container.
+                # The time since this module was imported was spent
+                # importing the other modules and creating global objects.
+                self.cold_start = False
+                if ON_DEMAND:
+                    self.init_duration = (self.started - IMPORTED) * 1000
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Records how long the context block takes. Durations for the same
+        name are added together.
+
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.durations[name] = self.durations.get(name, 0) + duration
+
+
+metrics = Metrics()
@@ -1,92 +1,201 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
 import json
-import tempfile
-import zipfile
-from contextlib import contextmanager
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
 
+from logger import logger
 from utils import (
+    call_targets,
     codepipeline_lambda_handler,
-    create_zip_file,
-    ec2_client,
     get_artifact_s3_client,
-    get_cloudformation_template,
+    get_cloudformation_template_artifact,
+    get_deployed_parameters,
     get_input_artifact_location,
+    get_manifest_image,
+    get_manifest_images,
     get_output_artifact_location,
     get_session,
+    get_targets,
     get_user_parameters,
-    log,
+    open_s3_zip_file,
+    put_parameters,
+    run_steps,
+    run_targets,
 )
 
 
 @codepipeline_lambda_handler
 def lambda_handler(event, context):
     """
-    Prepares for an AMI deployment.
+    Prepares for an AMI deployment to one or more targets.
 
     """
 
     # Get details from the event.
     job = event["CodePipeline.job"]
     input_bucket, input_key = get_input_artifact_location(job)
-    output_bucket, output_key = get_output_artifact_location(job)
     user_params = get_user_parameters(job)
-    assume_role_arn = user_params["AssumeRoleArn"]
-    parameter_names = user_params["ParameterNames"]
-    stack_name = user_params["StackName"]
-    template_filename = user_params["TemplateFilename"]
+    targets = get_targets(user_params)
 
     # Create client in the pipeline account.
     pipeline_s3_client = get_artifact_s3_client(job)
 
-    # Create clients in the target account.
-    target_session = get_session(
-        role_arn=assume_role_arn, session_name="prepare-ami-deployment"
-    )
-    target_cfn_client = target_session.client("cloudformation")
-    target_ssm_client = target_session.client("ssm")
-
-    # Download the input artifact zip file, read manifest.json from it,
-    # and get the AMI it references. Also look up the associated image name.
-    with download_zip_file(
-        s3_client=pipeline_s3_client, bucket=input_bucket, key=input_key
-    ) as zip_file:
-        manifest_string = zip_file.read("manifest.json").decode("utf-8")
-    log("MANIFEST", manifest_string)
-    manifest = json.loads(manifest_string)
-    image_id = manifest["builds"][-1]["artifact_id"].split(":")[1]
-    log("IMAGE_ID", image_id)
-    image_name = ec2_client.describe_images(ImageIds=[image_id])["Images"][0]["Name"]
-    log("IMAGE_NAME", image_name)
-
-    # Update the SSM parameters with the image details,
-    # to be used by the CloudFormation deployment stage of the pipeline.
-    target_ssm_client.put_parameter(
-        Name=parameter_names["ImageId"], Value=image_id, Type="String", Overwrite=True
-    )
-    target_ssm_client.put_parameter(
-        Name=parameter_names["ImageName"],
-        Value=image_name,
-        Type="String",
-        Overwrite=True,
-    )
-
-    # Write the CloudFormation stack's template to the output artifact location,
-    # to be used by the CloudFormation deployment stage of the pipeline.
-    template = get_cloudformation_template(
-        cfn_client=target_cfn_client, stack_name=stack_name
-    )
-    with create_zip_file({template_filename: template}) as zip_path:
-        pipeline_s3_client.upload_file(zip_path, output_bucket, output_key)
-
-
-@contextmanager
-def download_zip_file(s3_client, bucket, key):
-    """
-    Downloads and extracts a zip file from S3.
+    # Read manifest.json from the input artifact zip file, without downloading
+    # the whole file, and index the AMIs it references by account and region.
+    def get_images():
+        with metrics.timer("ArtifactRead"):
+            with open_s3_zip_file(
+                s3_client=pipeline_s3_client, bucket=input_bucket, key=input_key
+            ) as zip_file:
+                manifest_string = zip_file.read("manifest.json").decode("utf-8")
+        manifest = json.loads(manifest_string)
+        logger.debug("MANIFEST", Manifest=manifest)
+        images = get_manifest_images(manifest)
+        regions = sorted({key[1] for key in images if key})
+        logger.info("IMAGES", Builds=len(manifest["builds"]), Regions=regions)
+        return images
 
-    """
+    # Look up the image name, if the manifest doesn't include it. This is
+    # only done once per image, for the targets which don't already have
+    # the image deployed. Images are looked up in the target's account and
+    # region, where they must be available for the target to launch them.
+    # There is a lock per image, so different images are looked up
+    # concurrently.
+    image_names = {}
+    image_name_locks = {}
+    image_names_lock = threading.Lock()
+
+    def lookup_image_name(image_id, ec2_client, region):
+        with image_names_lock:
+            image_name_lock = image_name_locks.setdefault(image_id, threading.Lock())
+        with image_name_lock:
+            if image_id not in image_names:
+                try:
+                    with metrics.timer("ImageLookup"):
+                        response = ec2_client.describe_images(ImageIds=[image_id])
+                    images_found = response["Images"]
+                except ClientError as error:
+                    if error.response["Error"]["Code"] != "InvalidAMIID.NotFound":
+                        raise
+                    images_found = []
+                if not images_found:
+                    raise Exception(
+                        f"Image {image_id} was not found in {region}, "
+                        "or is not shared with the target account"
+                    )
+                image_names[image_id] = images_found[0]["Name"]
+            return image_names[image_id]
+
+    def prepare_target(target):
+
+        # Get details for this target.
+        output_bucket, output_key = get_output_artifact_location(
+            job, name=target.get("OutputArtifact")
+        )
+        assume_role_arn = target["AssumeRoleArn"]
+        account_id = assume_role_arn.split(":")[4]
+        parameter_names = target["ParameterNames"]
+        region = target.get("Region") or os.environ["AWS_REGION"]
+        stack_name = target["StackName"]
+        template_filename = target["TemplateFilename"]
+
+        # Create clients in the target account and region.
+        target_session = get_session(
+            role_arn=assume_role_arn, session_name="prepare-ami-deployment"
+        )
+        target_cfn_client = target_session.client("cloudformation", region_name=region)
+        target_ssm_client = target_session.client("ssm", region_name=region)
+
+        # Get the SSM parameter values currently used by the stack,
+        # to skip any parts of the deployment that haven't changed.
+        def get_deployed():
+            deployed = get_deployed_parameters(
+                cfn_client=target_cfn_client,
+                ssm_client=target_ssm_client,
+                stack_name=stack_name,
+                parameter_names=parameter_names,
+            )
+            logger.info("DEPLOYED", Deployed=deployed)
+            return deployed
+
+        # Get the image built for this target's account and region.
+        def get_image():
+            image = get_manifest_image(images.result(), account_id, region)
+            logger.info("IMAGE_ID", ImageId=image["ImageId"], Region=region)
+            return image
+
+        # Get the image name from the manifest, or from the deployed
+        # parameters if the image is already deployed, or from EC2.
+        def get_image_name(image, deployed):
+            image_id = image["ImageId"]
+            if image["ImageName"]:
+                image_name = image["ImageName"]
+            elif deployed.get("ImageId") == image_id and "ImageName" in deployed:
+                image_name = deployed["ImageName"]
+            else:
+                image_name = lookup_image_name(
+                    image_id, target_session.client("ec2", region_name=region), region
+                )
+            logger.info("IMAGE_NAME", ImageName=image_name)
+            return image_name
+
+        # Update the SSM parameters with the image details,
+        # to be used by the CloudFormation deployment stage of the pipeline.
+        # Unchanged values are not written, so the stack update is a no-op
+        # when the same image is deployed again.
+        def put_image(image, image_name, deployed):
+            put_parameters(
+                ssm_client=target_ssm_client,
+                parameter_names=parameter_names,
+                values={"ImageId": image["ImageId"], "ImageName": image_name},
+                deployed=deployed,
+            )
+
+        # Write the CloudFormation stack's template to the output artifact
+        # location, to be used by the CloudFormation deployment stage of the
+        # pipeline. The zipped template is cached in the pipeline bucket by
+        # the stack's TemplateHash parameter.
+        def put_template():
+            body = get_cloudformation_template_artifact(
+                cfn_client=target_cfn_client,
+                stack_name=stack_name,
+                template_filename=template_filename,
+                cache_bucket=output_bucket,
+            )
+            with metrics.timer("TemplateWrite"):
+                pipeline_s3_client.put_object(
+                    Bucket=output_bucket, Key=output_key, Body=body
+                )
+
+        # Run the steps concurrently, apart from those that must wait
+        # for the values they use. Return a function to write the SSM
+        # parameters afterwards.
+        results = run_steps(
+            {
+                "deployed": (get_deployed, ()),
+                "image": (get_image, ()),
+                "image_name": (get_image_name, ("image", "deployed")),
+                "template": (put_template, ()),
+            }
+        )
+        return lambda: put_image(
+            image=results["image"],
+            image_name=results["image_name"],
+            deployed=results["deployed"],
+        )
+
+    # Read and index the manifest once, in the background,
+    # while preparing all of the targets concurrently.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        images = executor.submit(get_images)
+        put_functions = run_targets(targets, prepare_target)
 
-    temp_file = tempfile.NamedTemporaryFile()
-    with tempfile.NamedTemporaryFile() as temp_file:
-        s3_client.download_file(bucket, key, temp_file.name)
-        with zipfile.ZipFile(temp_file.name, "r") as zip_file:
-            yield zip_file
+    # Only write the SSM parameters once every target has been prepared,
+    # so that a failure doesn't leave any stack with a new image to deploy.
+    call_targets(list(zip(targets, put_functions)))
@@ -1,83 +1,224 @@
+# Imported first, so that its InitDuration metric includes the time
+# spent importing everything else.
+from metrics import metrics  # isort: skip
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from logger import logger
 from utils import (
+    MB,
+    call_targets,
     codepipeline_lambda_handler,
-    create_zip_file,
+    copy_s3_object,
+    copy_s3_zip_chunks,
     get_artifact_s3_client,
-    get_cloudformation_template,
+    get_cloudformation_template_artifact,
+    get_deployed_parameters,
     get_input_artifact_location,
+    get_input_artifact_revision,
     get_output_artifact_location,
     get_session,
+    get_targets,
     get_user_parameters,
-    log,
+    put_parameters,
+    run_steps,
+    run_targets,
 )
 
+# The app bucket object metadata key for the source revision of the input
+# artifact that it was copied from. The artifact's ETag can't be used, because
+# each pipeline execution writes a new artifact, and ETags of objects encrypted
+# with KMS keys are different every time.
+SOURCE_REVISION_METADATA = "source-revision"
+
+# Error codes from looking up a deployed app version that doesn't exist,
+# or isn't a version ID, in which case the artifact is copied.
+MISSING_VERSION_ERRORS = ("400", "404", "NoSuchKey", "NoSuchVersion")
+
 
 @codepipeline_lambda_handler
 def lambda_handler(event, context):
     """
-    Prepares for an app deployment.
+    Prepares for an app deployment to one or more targets.
 
     """
 
     # Get details from the event.
     job = event["CodePipeline.job"]
     input_bucket, input_key = get_input_artifact_location(job)
-    output_bucket, output_key = get_output_artifact_location(job)
+    source_revision = get_input_artifact_revision(job)
     user_params = get_user_parameters(job)
-    app_bucket = user_params["AppLocation"]["Bucket"]
-    app_key = user_params["AppLocation"]["Key"]
-    assume_role_arn = user_params["AssumeRoleArn"]
-    parameter_names = user_params["ParameterNames"]
-    stack_name = user_params["StackName"]
-    template_filename = user_params["TemplateFilename"]
+    artifact_format = user_params.get("ArtifactFormat", "zip")
+    copy_settings = user_params.get("CopySettings", {})
+    max_concurrency = copy_settings.get("MaxConcurrency", 10)
+    multipart_threshold = copy_settings.get("MultipartThresholdMB", 256) * MB
+    part_size = copy_settings.get("PartSizeMB", 64) * MB
+    targets = get_targets(user_params)
 
     # Create client in the pipeline account.
     pipeline_s3_client = get_artifact_s3_client(job)
 
-    # Create clients in the target account.
-    target_session = get_session(
-        role_arn=assume_role_arn, session_name="prepare-app-deployment"
-    )
-    target_cfn_client = target_session.client("cloudformation")
-    target_ssm_client = target_session.client("ssm")
-    target_s3_client = target_session.client("s3")
+    # Get the input artifact details. Its metadata has the friendly name.
+    def get_source():
+        with metrics.timer("ArtifactHead"):
+            return pipeline_s3_client.head_object(Bucket=input_bucket, Key=input_key)
 
     # Get the friendly name from the input artifact metadata,
     # to be added to EC2 tags for visibility.
-    response = pipeline_s3_client.head_object(Bucket=input_bucket, Key=input_key)
-    app_version_name = response["Metadata"].get(
-        "codepipeline-artifact-revision-summary", "-"
-    )
-    log("APP_VERSION_NAME", app_version_name)
-
-    # Copy the input artifact to the environment's app bucket,
-    # to be used by EC2 instances when they boot up.
-    response = target_s3_client.copy_object(
-        CopySource={"Bucket": input_bucket, "Key": input_key},
-        Bucket=app_bucket,
-        Key=app_key,
-    )
-    app_version_id = response["VersionId"]
-    log("APP_VERSION_ID", app_version_id)
-
-    # Update the SSM parameters with the app version details,
-    # to be used by the CloudFormation deployment stage of the pipeline.
-    target_ssm_client.put_parameter(
-        Name=parameter_names["AppVersionId"],
-        Value=app_version_id,
-        Type="String",
-        Overwrite=True,
-    )
-    target_ssm_client.put_parameter(
-        Name=parameter_names["AppVersionName"],
-        Value=app_version_name,
-        Type="String",
-        Overwrite=True,
-    )
-
-    # Write the CloudFormation stack's template to the output artifact location,
-    # to be used by the CloudFormation deployment stage of the pipeline.
-    template = get_cloudformation_template(
-        cfn_client=target_cfn_client, stack_name=stack_name
-    )
-    with create_zip_file({template_filename: template}) as zip_path:
-        pipeline_s3_client.upload_file(zip_path, output_bucket, output_key)
+    def get_app_version_name(source):
+        app_version_name = source["Metadata"].get(
+            "codepipeline-artifact-revision-summary", "-"
+        )
+        logger.info("APP_VERSION_NAME", AppVersionName=app_version_name)
+        return app_version_name
+
+    def prepare_target(target):
+
+        # Get details for this target.
+        output_bucket, output_key = get_output_artifact_location(
+            job, name=target.get("OutputArtifact")
+        )
+        app_bucket = target["AppLocation"]["Bucket"]
+        app_key = target["AppLocation"]["Key"]
+        assume_role_arn = target["AssumeRoleArn"]
+        parameter_names = target["ParameterNames"]
+        region = target.get("Region") or os.environ["AWS_REGION"]
+        stack_name = target["StackName"]
+        template_filename = target["TemplateFilename"]
+
+        # Create clients in the target account and region.
+        target_session = get_session(
+            role_arn=assume_role_arn, session_name="prepare-app-deployment"
+        )
+        target_cfn_client = target_session.client("cloudformation", region_name=region)
+        target_ssm_client = target_session.client("ssm", region_name=region)
+        target_s3_client = target_session.client("s3", region_name=region)
+
+        # Get the SSM parameter values currently used by the stack,
+        # to skip any parts of the deployment that haven't changed.
+        def get_deployed():
+            deployed = get_deployed_parameters(
+                cfn_client=target_cfn_client,
+                ssm_client=target_ssm_client,
+                stack_name=stack_name,
+                parameter_names=parameter_names,
+            )
+            logger.info("DEPLOYED", Deployed=deployed)
+            return deployed
+
+        # Copy the input artifact to the environment's app bucket,
+        # to be used by EC2 instances when they boot up. The source revision
+        # is stored in the object metadata, so if the deployed version came
+        # from the same revision then it is used instead of copying it again.
+        # Chunked artifacts only copy the chunks that the bucket doesn't
+        # already have, and the app version is their manifest. New stacks
+        # have the initial "-" value, so there is nothing to compare with.
+        def copy_app(deployed):
+            deployed_version_id = deployed.get("AppVersionId", "-")
+            if source_revision and deployed_version_id != "-":
+                try:
+                    with metrics.timer("ChangeDetection"):
+                        response = target_s3_client.head_object(
+                            Bucket=app_bucket,
+                            Key=app_key,
+                            VersionId=deployed_version_id,
+                        )
+                except ClientError as error:
+                    if error.response["Error"]["Code"] not in MISSING_VERSION_ERRORS:
+                        raise
+                    logger.info("DEPLOYED_VERSION_MISSING", Error=str(error))
+                else:
+                    metadata = response["Metadata"]
+                    if metadata.get(SOURCE_REVISION_METADATA) == source_revision:
+                        logger.info("UNCHANGED", AppVersionId=deployed_version_id)
+                        return deployed_version_id
+            metadata = {SOURCE_REVISION_METADATA: source_revision or "-"}
+            if artifact_format == "chunks":
+                with metrics.timer("ChunkCopy"):
+                    app_version_id = copy_s3_zip_chunks(
+                        source_s3_client=pipeline_s3_client,
+                        source_bucket=input_bucket,
+                        source_key=input_key,
+                        s3_client=target_s3_client,
+                        bucket=app_bucket,
+                        key=app_key,
+                        max_concurrency=max_concurrency,
+                        metadata=metadata,
+                    )
+            else:
+                with metrics.timer("Copy"):
+                    app_version_id = copy_s3_object(
+                        s3_client=target_s3_client,
+                        source_bucket=input_bucket,
+                        source_key=input_key,
+                        bucket=app_bucket,
+                        key=app_key,
+                        multipart_threshold=multipart_threshold,
+                        part_size=part_size,
+                        max_concurrency=max_concurrency,
+                        metadata=metadata,
+                    )
+            logger.info("APP_VERSION_ID", AppVersionId=app_version_id)
+            return app_version_id
+
+        # Update the SSM parameters with the app version details,
+        # to be used by the CloudFormation deployment stage of the pipeline.
+        # Unchanged values are not written, so the stack update is a no-op
+        # when the same revision is deployed again.
+        def put_app_version(app_version_id, app_version_name, deployed):
+            put_parameters(
+                ssm_client=target_ssm_client,
+                parameter_names=parameter_names,
+                values={
+                    "AppVersionId": app_version_id,
+                    "AppVersionName": app_version_name,
+                },
+                deployed=deployed,
+            )
+
+        # Write the CloudFormation stack's template to the output artifact
+        # location, to be used by the CloudFormation deployment stage of the
+        # pipeline. The zipped template is cached in the pipeline bucket by
+        # the stack's TemplateHash parameter.
+        def put_template():
+            body = get_cloudformation_template_artifact(
+                cfn_client=target_cfn_client,
+                stack_name=stack_name,
+                template_filename=template_filename,
+                cache_bucket=output_bucket,
+            )
+            with metrics.timer("TemplateWrite"):
+                pipeline_s3_client.put_object(
+                    Bucket=output_bucket, Key=output_key, Body=body
+                )
+
+        # Run the steps concurrently, apart from those that must wait
+        # for the values they use. Return a function to write the SSM
+        # parameters afterwards.
+        results = run_steps(
+            {
+                "source": (source.result, ()),
+                "deployed": (get_deployed, ()),
+                "app_version_id": (copy_app, ("deployed",)),
+                "app_version_name": (get_app_version_name, ("source",)),
+                "template": (put_template, ()),
+            }
+        )
+        return lambda: put_app_version(
+            app_version_id=results["app_version_id"],
+            app_version_name=results["app_version_name"],
+            deployed=results["deployed"],
+        )
+
+    # Get the input artifact details once, in the background,
+    # while preparing all of the targets concurrently.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        source = executor.submit(get_source)
+        put_functions = run_targets(targets, prepare_target)
+
+    # Only write the SSM parameters once every target has been prepared,
+    # so that a failure doesn't leave any stack with a new version to deploy.
+    call_targets(list(zip(targets, put_functions)))
@@ -1,43 +1,226 @@
+import hashlib
+import io
 import json
-import tempfile
+import os
+import random
+import threading
+import time
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from functools import wraps
-from traceback import TracebackException
+from datetime import datetime, timedelta, timezone
+from functools import partial, wraps
+
+from botocore.exceptions import ClientError
+
+from clients import LazyClient, create_client
+from logger import logger
+from metrics import metrics
+
+codepipeline_client = LazyClient("codepipeline")
+s3_client = LazyClient("s3")
+sts_client = LazyClient("sts")
+
+MB = 1024 * 1024
+
+# Object headers that are kept when copying S3 objects with new metadata,
+# which otherwise replaces them.
+COPIED_OBJECT_HEADERS = (
+    "CacheControl",
+    "ContentDisposition",
+    "ContentEncoding",
+    "ContentLanguage",
+    "ContentType",
+)
+
+# Chunked app artifacts are zip files with a manifest listing the chunks
+# of each file, and the chunks stored under a prefix and named by their
+# SHA-256 hash. The chunks are stored under the same prefix in app buckets,
+# so each one is only copied once, and the manifest is the app version.
+APP_CHUNK_PREFIX = "chunks/"
+APP_MANIFEST_FILENAME = "app-manifest.json"
+
+# SSM parameter writes are retried with jittered exponential backoff
+# when many pipelines update parameters at the same time.
+PUT_PARAMETER_ATTEMPTS = 8
+PUT_PARAMETER_BASE_DELAY = 0.5
+PUT_PARAMETER_MAX_DELAY = 10
+PUT_PARAMETER_RETRY_ERRORS = ("ThrottlingException", "TooManyUpdates")
+
+# Sessions and clients are cached between invocations of warm Lambda
+# containers, keyed by role ARN and session name. Cached sessions are
+# discarded this long before their credentials expire.
+SESSION_EXPIRY_MARGIN = timedelta(minutes=5)
+
+# Template artifact zip files are cached by template hash and filename,
+# in memory and in the pipeline bucket under this prefix.
+TEMPLATE_CACHE_PREFIX = "template-cache/"
+TEMPLATE_CACHE_SIZE = 100
+
+# Packer manifest builds can use these custom_data keys to say which account
+# their images were built in, and what the images are named, so the Prepare
+# functions don't need to look up the names in EC2.
+MANIFEST_ACCOUNT_ID_KEY = "account_id"
+MANIFEST_IMAGE_NAME_KEYS = ("image_name", "ami_name")
+
+cache_lock = threading.RLock()
+cache_stats = {"hits": 0, "misses": 0}
+artifact_client_cache = {}
+session_cache = {}
+session_locks = {}
+template_cache = {}
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    A seekable, read-only file object for an S3 object. Reads are performed
+    with ranged GET requests, so only the requested bytes are downloaded.
+
+    """
 
-import boto3
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.position = 0
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+        self.size = response["ContentLength"]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        response = self.s3_client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={self.position}-{end - 1}",
+        )
+        data = response["Body"].read()
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+
+class CachedSession:
+    """
+    Holds credentials for an assumed role, and reuses clients created
+    with them, per service and region. This can be used like a boto3 session.
 
-codepipeline_client = boto3.client("codepipeline")
-ec2_client = boto3.client("ec2")
-sts_client = boto3.client("sts")
+    """
+
+    def __init__(self, credentials, expiration=None):
+        self.credentials = credentials
+        self.expiration = expiration
+        self.clients = {}
+
+    def client(self, service_name, region_name=None):
+        region_name = region_name or os.environ.get("AWS_REGION")
+        cache_key = (service_name, region_name)
+        with cache_lock:
+            if cache_key in self.clients:
+                cache_stats["hits"] += 1
+            else:
+                cache_stats["misses"] += 1
+                self.clients[cache_key] = create_client(
+                    service_name,
+                    region_name=region_name,
+                    aws_access_key_id=self.credentials["AccessKeyId"],
+                    aws_secret_access_key=self.credentials["SecretAccessKey"],
+                    aws_session_token=self.credentials["SessionToken"],
+                )
+            return self.clients[cache_key]
+
+    def is_expired(self):
+        if self.expiration is None:
+            return False
+        return datetime.now(timezone.utc) >= self.expiration - SESSION_EXPIRY_MARGIN
+
+
+def call_targets(calls):
+    """
+    Calls the functions in a list of (target, function) pairs, concurrently,
+    and returns a list of the results in the same order. If any of them fail,
+    the first exception is raised once they have all finished.
+
+    """
+
+    if not calls:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(func) for _, func in calls]
+        wait(futures)
+
+    errors = []
+    for (target, _), future in zip(calls, futures):
+        error = future.exception()
+        if error:
+            logger.error(
+                "TARGET_FAILURE", exception=error, StackName=target["StackName"]
+            )
+            errors.append(error)
+    if errors:
+        raise errors[0]
+    return [future.result() for future in futures]
 
 
 def codepipeline_lambda_handler(func):
     """
     Decorates a lambda handler function to set up logging and error handling.
     Sends a failure result to CodePipeline if the decorated function raises
-    an exception, otherwise sending a success result.
+    an exception, otherwise sending a success result. If the decorated
+    function returns a continuation token, the success result includes it,
+    and CodePipeline will invoke the function again with that token.
 
     """
 
     @wraps(func)
     def wrapped(event, context):
 
-        # Set up logging and log the event.
+        # Set up logging and metrics, and log the event. The whole event
+        # is only logged at the debug level, with its credentials redacted.
         # Example event: https://docs.amazonaws.cn/en_us/lambda/latest/dg/services-codepipeline.html
-        log.context = {"RequestId": context.aws_request_id}
-        log("EVENT", json.dumps(event, indent=2))
+        logger.reset(context)
+        metrics.reset(context)
+        logger.debug("EVENT", Event=event)
 
         # Get the job data.
         job = event["CodePipeline.job"]
+        logger.info("JOB", JobId=job["id"])
 
         # Process the job and then notify CodePipeline of its success or failure.
         try:
-            func(event, context)
-            log("SUCCESS")
-            codepipeline_client.put_job_success_result(jobId=job["id"])
+            continuation_token = func(event, context)
+            if continuation_token:
+                logger.info("CONTINUE")
+                codepipeline_client.put_job_success_result(
+                    jobId=job["id"], continuationToken=continuation_token
+                )
+            else:
+                logger.info("SUCCESS")
+                codepipeline_client.put_job_success_result(jobId=job["id"])
         except Exception as error:
-            log("FAILURE", exception=error)
+            logger.error("FAILURE", exception=error)
             codepipeline_client.put_job_failure_result(
                 jobId=job["id"],
                 failureDetails={
@@ -46,24 +229,189 @@ def codepipeline_lambda_handler(func):
                     "externalExecutionId": context.aws_request_id,
                 },
             )
+        finally:
+            logger.info(
+                "CACHE", Hits=cache_stats["hits"], Misses=cache_stats["misses"]
+            )
+            logger.flush()
+            metrics.emit()
 
     return wrapped
 
 
-@contextmanager
+def copy_s3_object(
+    s3_client,
+    source_bucket,
+    source_key,
+    bucket,
+    key,
+    multipart_threshold=256 * MB,
+    part_size=64 * MB,
+    max_concurrency=10,
+    metadata=None,
+):
+    """
+    Copies an object in S3 and returns the VersionId of the new object.
+    Objects larger than the multipart threshold are copied in parts,
+    concurrently, which also allows copying objects larger than 5 GB.
+    Metadata and headers such as ContentType are copied from the source
+    object in both cases, with any additional metadata added to it.
+
+    """
+
+    response = s3_client.head_object(Bucket=source_bucket, Key=source_key)
+    size = response["ContentLength"]
+    headers = {key: response[key] for key in COPIED_OBJECT_HEADERS if key in response}
+    new_metadata = dict(response["Metadata"], **(metadata or {}))
+
+    if size <= multipart_threshold:
+        response = s3_client.copy_object(
+            CopySource={"Bucket": source_bucket, "Key": source_key},
+            Bucket=bucket,
+            Key=key,
+            Metadata=new_metadata,
+            MetadataDirective="REPLACE",
+            **headers,
+        )
+        return response["VersionId"]
+
+    # S3 supports up to 10,000 parts of at least 5 MB each,
+    # so increase the part size if there would be too many parts.
+    part_size = max(part_size, 5 * MB, -(-size // 10000))
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+    logger.info("MULTIPART_COPY", Size=size, Parts=len(ranges))
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        Metadata=new_metadata,
+        **headers,
+    )["UploadId"]
+
+    def copy_part(part_number, first_byte, last_byte):
+        response = s3_client.upload_part_copy(
+            Bucket=bucket,
+            Key=key,
+            CopySource={"Bucket": source_bucket, "Key": source_key},
+            CopySourceRange=f"bytes={first_byte}-{last_byte}",
+            PartNumber=part_number,
+            UploadId=upload_id,
+        )
+        return {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": part_number}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [
+                executor.submit(copy_part, part_number, first_byte, last_byte)
+                for part_number, (first_byte, last_byte) in enumerate(ranges, 1)
+            ]
+            parts = [future.result() for future in futures]
+        response = s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            MultipartUpload={"Parts": parts},
+            UploadId=upload_id,
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    return response["VersionId"]
+
+
+def copy_s3_zip_chunks(
+    source_s3_client,
+    source_bucket,
+    source_key,
+    s3_client,
+    bucket,
+    key,
+    max_concurrency=10,
+    metadata=None,
+    read_size=1 * MB,
+):
+    """
+    Copies a chunked app artifact from a zip file in S3, and returns the
+    VersionId of the copied manifest. Only the chunks that are missing from
+    the destination bucket are read from the zip file, in the order they
+    are stored, and they are uploaded concurrently. Each chunk's hash is
+    checked before it is uploaded. The zip file is read in ranges of the
+    read size, so many small chunks are read with each request.
+
+    """
+
+    with open_s3_zip_file(
+        s3_client=source_s3_client,
+        bucket=source_bucket,
+        key=source_key,
+        buffer_size=read_size,
+    ) as zip_file:
+        manifest = json.loads(zip_file.read(APP_MANIFEST_FILENAME).decode("utf-8"))
+        chunks = {
+            chunk for file_chunks in manifest["Files"].values() for chunk in file_chunks
+        }
+        existing = set(list_s3_keys(s3_client, bucket, APP_CHUNK_PREFIX))
+        missing = [
+            zip_file.getinfo(APP_CHUNK_PREFIX + chunk)
+            for chunk in chunks
+            if APP_CHUNK_PREFIX + chunk not in existing
+        ]
+        missing.sort(key=lambda info: info.header_offset)
+        logger.info(
+            "CHUNKS",
+            Bytes=sum(info.file_size for info in missing),
+            Missing=len(missing),
+            Total=len(chunks),
+        )
+
+        # Read the chunks one at a time, while uploading them concurrently,
+        # with no more than max_concurrency chunks held in memory.
+        def put_chunk(chunk, data):
+            s3_client.put_object(Bucket=bucket, Key=APP_CHUNK_PREFIX + chunk, Body=data)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            running = set()
+            for info in missing:
+                chunk = info.filename[len(APP_CHUNK_PREFIX) :]
+                data = zip_file.read(info)
+                if hashlib.sha256(data).hexdigest() != chunk:
+                    raise ValueError(f"Chunk {chunk} does not match its hash")
+                if len(running) >= max_concurrency:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                running.add(executor.submit(put_chunk, chunk, data))
+            for future in running:
+                future.result()
+
+    # Store the manifest as the app version, with the prefix of its chunks.
+    manifest["ChunkPrefix"] = APP_CHUNK_PREFIX
+    response = s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(manifest).encode("utf-8"),
+        ContentType="application/json",
+        Metadata=metadata or {},
+    )
+    return response["VersionId"]
+
+
 def create_zip_file(files):
     """
-    Creates a temporary zip file on disk. The files parameter must be a
+    Creates a zip file in memory. The files parameter must be a
     dictionary of {filename: contents} which will be written to the zip
-    file. The zip file path is yielded as the context value.
+    file. The zip file contents are returned as bytes.
 
     """
 
-    with tempfile.NamedTemporaryFile() as temp_file:
-        with zipfile.ZipFile(temp_file.name, "w") as zip_file:
-            for filename, contents in files.items():
-                zip_file.writestr(filename, contents)
-        yield temp_file.name
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for filename, contents in files.items():
+            zip_file.writestr(filename, contents)
+    return buffer.getvalue()
 
 
 def get_artifact_s3_client(job):
@@ -73,12 +421,22 @@ def get_artifact_s3_client(job):
     """
 
     creds = job["data"]["artifactCredentials"]
-    session = boto3.Session(
-        aws_access_key_id=creds["accessKeyId"],
-        aws_secret_access_key=creds["secretAccessKey"],
-        aws_session_token=creds["sessionToken"],
-    )
-    return session.client("s3")
+    access_key_id = creds["accessKeyId"]
+    with cache_lock:
+        if access_key_id in artifact_client_cache:
+            cache_stats["hits"] += 1
+        else:
+            cache_stats["misses"] += 1
+            # Artifact credentials are issued per job and their expiry time
+            # is unknown, so only keep the client for the latest credentials.
+            artifact_client_cache.clear()
+            artifact_client_cache[access_key_id] = create_client(
+                "s3",
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=creds["secretAccessKey"],
+                aws_session_token=creds["sessionToken"],
+            )
+        return artifact_client_cache[access_key_id]
 
 
 def get_cloudformation_template(cfn_client, stack_name):
@@ -87,10 +445,108 @@ def get_cloudformation_template(cfn_client, stack_name):
 
     """
 
-    response = cfn_client.get_template(StackName=stack_name)
+    with metrics.timer("TemplateFetch"):
+        response = cfn_client.get_template(StackName=stack_name)
     return response["TemplateBody"]
 
 
+def get_cloudformation_template_artifact(
+    cfn_client, stack_name, template_filename, cache_bucket
+):
+    """
+    Returns a zip file containing the template body of a CloudFormation
+    stack, to be used as an output artifact. The template only changes when
+    Terraform updates the stack, which also changes its TemplateHash parameter,
+    so zip files are cached by that hash in memory and in the cache bucket.
+    The hash is read from the stack itself, because Terraform can update
+    the stack without updating the pipeline.
+
+    """
+
+    with metrics.timer("TemplateHash"):
+        response = cfn_client.describe_stacks(StackName=stack_name)
+    template_hash = {
+        param["ParameterKey"]: param["ParameterValue"]
+        for param in response["Stacks"][0].get("Parameters", [])
+    }.get("TemplateHash")
+
+    if not template_hash:
+        template = get_cloudformation_template(cfn_client, stack_name)
+        return create_zip_file({template_filename: template})
+
+    cache_key = (template_hash, template_filename)
+    with cache_lock:
+        if cache_key in template_cache:
+            cache_stats["hits"] += 1
+            return template_cache[cache_key]
+        cache_stats["misses"] += 1
+
+    s3_key = f"{TEMPLATE_CACHE_PREFIX}{template_hash}/{template_filename}.zip"
+    try:
+        with metrics.timer("TemplateCache"):
+            response = s3_client.get_object(Bucket=cache_bucket, Key=s3_key)
+            body = response["Body"].read()
+        logger.info("TEMPLATE_CACHE", Location=f"s3://{cache_bucket}/{s3_key}")
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ("AccessDenied", "NoSuchKey"):
+            raise
+        template = get_cloudformation_template(cfn_client, stack_name)
+        body = create_zip_file({template_filename: template})
+
+        # Only cache the template if it is the one that Terraform rendered,
+        # in case the stack has been changed by something else.
+        if hashlib.sha256(template.encode("utf-8")).hexdigest() != template_hash:
+            logger.warning(
+                "TEMPLATE_CACHE", Reason="Template does not match TemplateHash"
+            )
+            return body
+        with metrics.timer("TemplateCache"):
+            s3_client.put_object(Bucket=cache_bucket, Key=s3_key, Body=body)
+
+    with cache_lock:
+        if len(template_cache) >= TEMPLATE_CACHE_SIZE:
+            template_cache.pop(next(iter(template_cache)))
+        template_cache[cache_key] = body
+    return body
+
+
+def get_deployed_parameters(cfn_client, ssm_client, stack_name, parameter_names):
+    """
+    Returns the current values of the SSM parameters used by a CloudFormation
+    stack, as a dictionary of {key: value}. Values are only included if the
+    stack was successfully deployed using their current values, so that
+    unchanged deployments can be skipped.
+
+    """
+
+    with metrics.timer("ChangeDetection"):
+        names = sorted(group_parameter_names(parameter_names))
+        response = ssm_client.get_parameters(Names=names)
+        values = {param["Name"]: param["Value"] for param in response["Parameters"]}
+        response = cfn_client.describe_stacks(StackName=stack_name)
+
+    stack = response["Stacks"][0]
+    if stack["StackStatus"] not in ("CREATE_COMPLETE", "UPDATE_COMPLETE"):
+        return {}
+
+    # SSM parameter types are resolved when the stack is deployed,
+    # so the resolved values are the ones currently in use.
+    resolved = {
+        param["ParameterValue"]: param.get("ResolvedValue")
+        for param in stack.get("Parameters", [])
+    }
+
+    deployed = {}
+    for name, keys in group_parameter_names(parameter_names).items():
+        value = values.get(name)
+        if value is not None and resolved.get(name) == value:
+            if len(keys) > 1:
+                deployed.update(json.loads(value))
+            else:
+                deployed[keys[0]] = value
+    return deployed
+
+
 def get_input_artifact_location(job):
     """
     Returns the S3 location of the input artifact.
@@ -104,14 +560,74 @@ def get_input_artifact_location(job):
     return (input_bucket, input_key)
 
 
-def get_output_artifact_location(job):
+def get_input_artifact_revision(job):
     """
-    Returns the expected S3 destination location of the output artifact.
-    The Lambda function needs to place an output artifact there.
+    Returns the source revision of the input artifact, which is the S3 version
+    ID of the source object for S3 source actions, or None if it is unknown.
 
     """
 
-    output_artifact = job["data"]["outputArtifacts"][0]
+    input_artifact = job["data"]["inputArtifacts"][0]
+    return input_artifact.get("revision")
+
+
+def get_manifest_image(images, account_id, region):
+    """
+    Returns the image to deploy to an account and region, from the images
+    returned by get_manifest_images(). A build for the account is preferred
+    over one without an account ID, and the last build's image is used
+    if no build was for the region.
+
+    """
+
+    for key in ((account_id, region), (None, region), None):
+        if key in images:
+            return images[key]
+    raise ValueError("The manifest has no builds")
+
+
+def get_manifest_images(manifest):
+    """
+    Returns the images in a Packer manifest, indexed by (account_id, region).
+    Each build's artifact_id can list images for several regions, such as
+    "eu-west-1:ami-1,us-east-1:ami-2". Builds without an account ID in their
+    custom_data are indexed with an account ID of None. Later builds replace
+    earlier ones, and the first image of the last build is also indexed
+    with a key of None, to be used when no build matches.
+
+    """
+
+    images = {}
+    for build in manifest["builds"]:
+        custom_data = build.get("custom_data") or {}
+        account_id = custom_data.get(MANIFEST_ACCOUNT_ID_KEY)
+        image_name = None
+        for key in MANIFEST_IMAGE_NAME_KEYS:
+            if custom_data.get(key):
+                image_name = custom_data[key]
+                break
+        for index, artifact in enumerate(build["artifact_id"].split(",")):
+            region, image_id = artifact.strip().split(":", 1)
+            image = {"ImageId": image_id, "ImageName": image_name, "Region": region}
+            images[(account_id, region)] = image
+            if index == 0:
+                images[None] = image
+    return images
+
+
+def get_output_artifact_location(job, name=None):
+    """
+    Returns the expected S3 destination location of an output artifact.
+    The Lambda function needs to place an output artifact there. If a name
+    is not specified then the first output artifact is used.
+
+    """
+
+    output_artifacts = job["data"]["outputArtifacts"]
+    if name:
+        output_artifact = next(a for a in output_artifacts if a["name"] == name)
+    else:
+        output_artifact = output_artifacts[0]
     output_location = output_artifact["location"]["s3Location"]
     output_bucket = output_location["bucketName"]
     output_key = output_location["objectKey"]
@@ -120,21 +636,51 @@ def get_output_artifact_location(job):
 
 def get_session(role_arn, session_name, duration_seconds=900):
     """
-    Returns a boto3 session for the specified role.
+    Returns a session for the specified role. Sessions are cached
+    until shortly before their credentials expire, and reuse their clients.
+    Each role is assumed while holding a lock for that role only, so other
+    roles and caches can be used in the meantime.
 
     """
 
-    response = sts_client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName=session_name,
-        DurationSeconds=duration_seconds,
-    )
-    creds = response["Credentials"]
-    return boto3.Session(
-        aws_access_key_id=creds["AccessKeyId"],
-        aws_secret_access_key=creds["SecretAccessKey"],
-        aws_session_token=creds["SessionToken"],
-    )
+    cache_key = (role_arn, session_name)
+    with cache_lock:
+        session_lock = session_locks.setdefault(cache_key, threading.Lock())
+    with session_lock:
+        with cache_lock:
+            cached = session_cache.get(cache_key)
+            if cached and not cached.is_expired():
+                cache_stats["hits"] += 1
+                return cached
+            cache_stats["misses"] += 1
+        with metrics.timer("AssumeRole"):
+            response = sts_client.assume_role(
+                RoleArn=role_arn,
+                RoleSessionName=session_name,
+                DurationSeconds=duration_seconds,
+            )
+        creds = response["Credentials"]
+        cached = CachedSession(credentials=creds, expiration=creds["Expiration"])
+        with cache_lock:
+            session_cache[cache_key] = cached
+        return cached
+
+
+def get_targets(user_params):
+    """
+    Returns the list of targets to deploy to. The user parameters can have
+    the S3 location of a JSON file with a list of targets, a list of targets,
+    or the details of a single target at the top level.
+
+    """
+
+    if "TargetsLocation" in user_params:
+        location = user_params["TargetsLocation"]
+        response = s3_client.get_object(Bucket=location["Bucket"], Key=location["Key"])
+        user_params = json.loads(response["Body"].read())
+    if "Targets" in user_params:
+        return user_params["Targets"]
+    return [user_params]
 
 
 def get_user_parameters(job):
@@ -148,23 +694,161 @@ def get_user_parameters(job):
     )
 
 
-def log(title, message="", exception=None):
+def group_parameter_names(parameter_names):
     """
-    Logs a message, which will show up in CloudWatch Logs.
+    Groups a dictionary of {key: ssm_parameter_name} by parameter name.
+    Returns a dictionary of {ssm_parameter_name: [key, ...]}. Keys which
+    share a parameter name are stored together in it as a JSON document.
+
+    """
+
+    groups = {}
+    for key, name in sorted(parameter_names.items()):
+        groups.setdefault(name, []).append(key)
+    return groups
+
 
+def list_s3_keys(s3_client, bucket, prefix):
     """
+    Yields the keys of the current objects in S3 with the prefix.
 
-    parts = [str(title)]
-    for key, value in log.context.items():
-        parts.append(key)
-        parts.append(value)
-    if message != "":
-        parts.append(str(message))
-    value = " ".join(parts)
-    if exception:
-        value += "\n"
-        value += "\n".join(TracebackException.from_exception(exception).format())
-    print(value.replace("\n", "\r"))
+    """
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            yield item["Key"]
+
+
+@contextmanager
+def open_s3_zip_file(s3_client, bucket, key, buffer_size=64 * 1024):
+    """
+    Opens a zip file in S3 without downloading all of it. Only the central
+    directory and the members that are read get downloaded, using ranged
+    GET requests. The ZipFile object is yielded as the context value.
 
+    """
+
+    reader = io.BufferedReader(
+        S3ObjectReader(s3_client=s3_client, bucket=bucket, key=key),
+        buffer_size=buffer_size,
+    )
+    with zipfile.ZipFile(reader, "r") as zip_file:
+        yield zip_file
+
+
+def put_parameter(ssm_client, name, value):
+    """
+    Updates an SSM parameter, retrying with jittered exponential backoff
+    if SSM is throttling requests or the parameter is being updated
+    by something else at the same time.
+
+    """
+
+    for attempt in range(PUT_PARAMETER_ATTEMPTS):
+        try:
+            with metrics.timer("ParameterWrite"):
+                ssm_client.put_parameter(
+                    Name=name, Value=value, Type="String", Overwrite=True
+                )
+            return
+        except ClientError as error:
+            code = error.response["Error"]["Code"]
+            if code not in PUT_PARAMETER_RETRY_ERRORS:
+                raise
+            if attempt + 1 == PUT_PARAMETER_ATTEMPTS:
+                raise
+            delay = random.uniform(
+                0, min(PUT_PARAMETER_MAX_DELAY, PUT_PARAMETER_BASE_DELAY * 2 ** attempt)
+            )
+            logger.warning(
+                "PUT_PARAMETER_RETRY", Name=name, Code=code, Delay=round(delay, 1)
+            )
+            time.sleep(delay)
+
+
+def put_parameters(ssm_client, parameter_names, values, deployed):
+    """
+    Updates SSM parameters with new values. The parameter_names parameter
+    must be a dictionary of {key: ssm_parameter_name}, and values must be
+    a dictionary of {key: value}. Keys which share a parameter name are
+    written together as a JSON document. Parameters are skipped if all of
+    their values are already deployed, so that a stack update using them
+    would not change anything.
+
+    """
+
+    updates = {}
+    for name, keys in group_parameter_names(parameter_names).items():
+        if all(deployed.get(key) == values[key] for key in keys):
+            logger.info("UNCHANGED", Name=name)
+            continue
+        if len(keys) > 1:
+            updates[name] = json.dumps({key: values[key] for key in keys})
+        else:
+            updates[name] = values[keys[0]]
+
+    if updates:
+        with ThreadPoolExecutor(max_workers=len(updates)) as executor:
+            futures = [
+                executor.submit(put_parameter, ssm_client, name, value)
+                for name, value in sorted(updates.items())
+            ]
+            for future in futures:
+                future.result()
+
+
+def run_steps(steps, max_workers=8):
+    """
+    Runs steps concurrently while respecting their dependencies. The steps
+    parameter must be a dictionary of {name: (function, dependency_names)}.
+    Each function is called with the results of its dependencies as keyword
+    arguments, as soon as they are available. Returns a dictionary of
+    {name: result}. If a step fails, no more steps are started and the
+    exception is raised once running steps have finished.
+
+    """
+
+    for name, (func, dependencies) in steps.items():
+        for dependency in dependencies:
+            if dependency not in steps:
+                raise ValueError(f"Step {name} depends on unknown step {dependency}")
+
+    results = {}
+    pending = dict(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+
+            # Start any steps with all of their dependencies completed.
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    kwargs = {key: results[key] for key in dependencies}
+                    running[executor.submit(func, **kwargs)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Steps have circular dependencies: {sorted(pending)}")
+
+            # Wait for a step to finish and record its result.
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error:
+                    wait(running)
+                    raise error
+                results[name] = future.result()
+
+    return results
+
+
+def run_targets(targets, func):
+    """
+    Calls the function with each target, concurrently, and returns a list
+    of the results in the same order as the targets. If any of them fail,
+    the first exception is raised once they have all finished.
+
+    """
 
-log.context = {}
+    return call_targets([(target, partial(func, target)) for target in targets])
@@ -18,4 +18,18 @@ data "aws_iam_policy_document" "lambda" {
     actions   = ["ec2:DescribeImages"]
     resources = ["*"]
   }
+
+  statement {
+    sid       = "PrepareTargets"
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = ["${aws_s3_bucket.pipeline.arn}/prepare-targets/*"]
+  }
+
+  statement {
+    sid       = "TemplateCache"
+    effect    = "Allow"
+    actions   = ["s3:GetObject", "s3:PutObject"]
+    resources = ["${aws_s3_bucket.pipeline.arn}/template-cache/*"]
+  }
 }
@@ -2,6 +2,16 @@ resource "aws_s3_bucket" "pipeline" {
   bucket = "${var.name}-pipeline-${data.aws_caller_identity.current.account_id}"
   acl    = "private"
 
+  # Cached CloudFormation template artifacts are recreated when needed.
+  lifecycle_rule {
+    id      = "template-cache"
+    enabled = true
+    prefix  = "template-cache/"
+    expiration {
+      days = 30
+    }
+  }
+
   server_side_encryption_configuration {
     rule {
       apply_server_side_encryption_by_default {
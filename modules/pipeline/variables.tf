@@ -3,11 +3,53 @@ variable "name" {
   type        = string
 }
 
+variable "ami_copy" {
+  description = "Copy the AMI to the regions of targets that don't have an image for their region in the Packer manifest, in a Distribute stage before the targets are deployed. The copies are made in the target accounts, so the source AMI must be shared with them. Only used with type=ami."
+  type        = bool
+  default     = false
+}
+
+variable "ami_fast_snapshot_restore" {
+  description = "Enable EBS fast snapshot restore for the AMI's snapshots in the availability zones of each target's Auto Scaling Group, in a Distribute stage that waits until it is enabled before the targets are deployed. This makes the first instances launched from a new AMI boot as quickly as later ones. Fast snapshot restore is charged for every hour it is enabled, and is not disabled by the pipeline. Only used with type=ami."
+  type        = bool
+  default     = false
+}
+
+variable "app_artifact_format" {
+  description = "The format of app artifacts: \"zip\" to deploy the artifact as a single object, or \"chunks\" for artifacts with an app-manifest.json file listing the SHA-256 chunks of each file and the chunks stored as chunks/<sha256>. Chunks are stored once in the target S3 buckets, so each deployment only copies the chunks that have changed, and instances can download them in parallel. Only used with type=app."
+  type        = string
+  default     = "zip"
+}
+
+variable "app_copy_settings" {
+  description = "Customise how app artifacts are copied to the target S3 buckets by setting any of MaxConcurrency, MultipartThresholdMB, PartSizeMB. Artifacts larger than the threshold are copied in parts, concurrently. Only used with type=app."
+  type        = map(number)
+  default     = {}
+}
+
+variable "artifact_stores" {
+  description = "Artifact stores for targets in other regions than the pipeline, keyed by region. CodePipeline copies each target's template artifact to the store in its region for the Deploy action. Each store needs an S3 bucket in that region, named like \"<anything>-pipeline-<pipeline account id>\" so the asg module's pipeline role can read it, and a KMS key in that region in the pipeline account, which the target accounts can use."
+  type        = map(object({ bucket = string, kms_key_arn = string }))
+  default     = {}
+}
+
+variable "keep_app_versions" {
+  description = "The number of previous app versions to keep in the target S3 buckets, in addition to the version in use. Only used with type=app."
+  type        = number
+  default     = 0
+}
+
 variable "kms_key_arn" {
   description = "The KMS key to use for artifacts."
   type        = string
 }
 
+variable "log_level" {
+  description = "The minimum level of log records written by the Lambda functions: DEBUG, INFO, WARNING or ERROR. DEBUG includes whole events and manifests, with secrets redacted and large values truncated."
+  type        = string
+  default     = "INFO"
+}
+
 variable "source_location" {
   description = "The pipeline S3 source location. The pipeline will start when a file is uploaded here."
   type        = object({ bucket = string, key = string })
@@ -54,7 +96,25 @@ variable "targets" {
   }))
 }
 
+variable "targets_per_prepare_action" {
+  description = "The number of targets in a wave that each Prepare action handles, up to 5. A Prepare action reads the input artifact once, and then prepares its targets concurrently."
+  type        = number
+  default     = 1
+}
+
 variable "type" {
   description = "The type of pipeline to create, either 'ami' or 'app'."
   type        = string
 }
+
+variable "wave_bake_minutes" {
+  description = "The number of minutes to wait after deploying each wave of targets, before the next wave can start. The last wave is not followed by a wait."
+  type        = number
+  default     = 0
+}
+
+variable "wave_size" {
+  description = "The number of targets to deploy to in parallel, in a single pipeline stage. Targets are grouped into waves in the order they are listed. The default is to deploy to one target at a time."
+  type        = number
+  default     = 1
+}